@@ -0,0 +1,690 @@
+import asyncio
+import time
+import os
+import re
+import ssl
+from inbox import (
+    Mailbox,
+    ImapError,
+    _parse_raw_mail,
+    _parse_text_part,
+    _read_sync_state,
+    _write_sync_state,
+)
+
+# a response line that ends in a literal, e.g. b'* 1 FETCH (UID 5 RFC822 {1234}'
+_LITERAL = re.compile(rb"\{(\d+)\}$")
+# a response code sent with an OK/NO response, e.g. b'[UIDVALIDITY 3] UIDs valid'
+_RESPONSE_CODE = re.compile(rb"\[(?P<code>[A-Z-]+)(?: (?P<value>[^\]]*))?\]")
+
+
+# a minimal IMAP4rev1 client on asyncio streams, with just what an AsyncMailbox needs
+# responses are returned in the same shape imaplib uses, so that the Mailbox parsing helpers can be reused
+class AsyncImapClient:
+    def __init__(self, host, port=993, use_ssl=True, timeout=60):
+        self.__host = host
+        self.__port = port
+        self.__use_ssl = use_ssl
+        self.__timeout = timeout  # seconds to wait for the server's answer before giving up on the connection
+        self.__tag = 0
+        self._reader = None
+        self._writer = None
+        self.capabilities = ()
+        # set by select(), the response codes (UIDVALIDITY, HIGHESTMODSEQ, ...) of the last SELECT as {code: bytes}
+        self.select_codes = {}
+        self.__idling = False  # an IDLE is running, the server waits for DONE before taking any other command
+        # the server reported a new mail (EXISTS/RECENT) since the last SELECT, see idle()
+        self.__new_mail = False
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                self.__host,
+                self.__port,
+                ssl=ssl.create_default_context() if self.__use_ssl else None,
+            ),
+            self.__timeout,
+        )
+        greeting = await self._read_response()
+        if not greeting[0].startswith(b"* OK"):
+            raise AsyncImapError(f"unexpected greeting {greeting[0]!r}")
+        await self._refresh_capabilities()
+
+    async def _refresh_capabilities(self):
+        _, untagged = await self._command("CAPABILITY")
+        self.capabilities = tuple(
+            untagged.get("CAPABILITY", [b""])[-1].decode().upper().split()
+        )
+
+    async def login(self, username, password):
+        status, _ = await self._command(
+            "LOGIN", self._quote(username), self._quote(password)
+        )
+        if status != "OK":
+            raise AsyncImapError("LOGIN failed")
+        # servers may advertise more capabilities once logged in
+        await self._refresh_capabilities()
+
+    async def enable(self, capability):
+        return (await self._command("ENABLE", capability))[0]
+
+    async def select(self, folder):
+        status, untagged = await self._command("SELECT", self._quote(folder))
+        if status != "OK":
+            raise AsyncImapError(f"SELECT {folder} failed")
+        # the counts reported by the SELECT itself are no news
+        self.__new_mail = False
+        self.select_codes = {
+            code: values[-1]
+            for code, values in untagged.items()
+            if code in ("UIDVALIDITY", "HIGHESTMODSEQ", "UIDNEXT")
+        }
+        return untagged
+
+    # sends 'UID <command> <args>' and returns (status, untagged responses)
+    async def uid(self, command, *args):
+        return await self._command("UID", command.upper(), *args)
+
+    async def noop(self):
+        return (await self._command("NOOP"))[0]
+
+    async def logout(self):
+        try:
+            # the IDLE was cancelled halfway through
+            if self.__idling:
+                await self._send(b"DONE")
+                self.__idling = False
+            await self._command("LOGOUT")
+        finally:
+            self.close()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    # issues an IDLE and waits until the server reports new mail or the timeout expires
+    # returns True if new mail was reported (also before the IDLE, e.g. during a FETCH, or while it was ending) since the
+    # last SELECT, False if not and None if the server refused the IDLE
+    async def idle(self, timeout):
+        if self.__new_mail:
+            return True
+        tag = self._next_tag()
+        await self._send(tag + b" IDLE")
+        while True:
+            response = await self._read_response()
+            line = self._first_line(response)
+            if line.startswith(b"+"):
+                break
+            if line.startswith(tag + b" "):  # BAD/NO
+                return None
+        self.__idling = True
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                response = await asyncio.wait_for(
+                    self._read_response(timeout=None), remaining
+                )
+            except asyncio.TimeoutError:
+                break
+            untagged = {}
+            self._store_untagged(response, untagged)
+            if "EXISTS" in untagged or "RECENT" in untagged:
+                self.__new_mail = True
+                break
+        await self._send(b"DONE")
+        self.__idling = False
+        await self._collect(tag)
+        return self.__new_mail
+
+    def _next_tag(self):
+        self.__tag += 1
+        return f"A{self.__tag:04d}".encode()
+
+    async def _send(self, line):
+        self._writer.write(line + b"\r\n")
+        await self._writer.drain()
+
+    async def _command(self, *args):
+        tag = self._next_tag()
+        await self._send(tag + b" " + " ".join(args).encode())
+        return await self._collect(tag)
+
+    # reads responses up to the tagged one, returns (status, {response type: list of data}) like imaplib does
+    async def _collect(self, tag):
+        untagged = {}
+        while True:
+            response = await self._read_response()
+            line = self._first_line(response)
+            if line.startswith(tag + b" "):
+                status = line[len(tag) + 1 :].split(b" ", 1)[0].decode().upper()
+                if status == "BAD":
+                    raise AsyncImapError(line.decode("utf-8", "replace"))
+                if "EXISTS" in untagged or "RECENT" in untagged:
+                    self.__new_mail = True
+                return status, untagged
+            if line.startswith(b"* "):
+                self._store_untagged(response, untagged)
+
+    # reads one response, i.e. a line and the literals it carries
+    # returns a list of parts, every part ending in a literal is a tuple (line, literal bytes)
+    async def _read_response(self, timeout=-1):
+        timeout = self.__timeout if timeout == -1 else timeout
+        parts = []
+        line = await asyncio.wait_for(self._reader.readline(), timeout)
+        while True:
+            if line == b"":
+                raise ConnectionResetError("IMAP server closed the connection")
+            line = line.rstrip(b"\r\n")
+            match = _LITERAL.search(line)
+            if match == None:
+                parts.append(line)
+                return parts
+            literal = await asyncio.wait_for(
+                self._reader.readexactly(int(match.group(1))), self.__timeout
+            )
+            parts.append((line, literal))
+            line = await asyncio.wait_for(self._reader.readline(), self.__timeout)
+
+    @staticmethod
+    def _first_line(response):
+        return response[0][0] if isinstance(response[0], tuple) else response[0]
+
+    # adds an untagged response to 'untagged', stripped of the '* ' (and of the type, which becomes the key)
+    # '* 5 EXISTS' is stored as untagged['EXISTS'] = [b'5'] and '* 1 FETCH (...)' as untagged['FETCH'] = [b'1 (...']
+    @staticmethod
+    def _store_untagged(response, untagged):
+        first = AsyncImapClient._first_line(response)[2:]
+        words = first.split(b" ", 2)
+        if words[0].isdigit() and len(words) > 1:
+            kind = words[1].decode().upper()
+            data = words[0] + (b" " + words[2] if len(words) > 2 else b"")
+        else:
+            kind = words[0].decode().upper()
+            data = first[len(words[0]) + 1 :]
+            if kind in ("OK", "NO"):
+                match = _RESPONSE_CODE.match(data)
+                if match != None:
+                    untagged.setdefault(match.group("code").decode(), []).append(
+                        match.group("value")
+                    )
+        if isinstance(response[0], tuple):
+            response = [(data, response[0][1])] + response[1:]
+        else:
+            response = [data] + response[1:]
+        untagged.setdefault(kind, []).extend(response)
+
+    @staticmethod
+    def _quote(value):
+        return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+# cancels the task and waits for it to end
+# a cancellation that arrives just as an asyncio.wait_for() completes can get lost, so it is repeated until it sticks
+async def _cancel(task):
+    while not task.done():
+        task.cancel()
+        await asyncio.wait([task], timeout=0.1)
+
+
+# the asyncio counterpart of Mailbox: watches a single IMAP account/folder from a task of the running event loop
+# the mails found are put in the _queue (an asyncio.Queue), which can be shared between several AsyncMailboxes
+# (see AsyncInbox), a full _queue makes the refill task wait, so mails stay on the server until there is room for them
+class AsyncMailbox:
+    def __init__(
+        self,
+        folder="INBOX",
+        queue=None,
+        imap_server="imap.gmail.com",
+        port=993,
+        use_ssl=True,
+    ):
+        self.__folder = folder
+        self.__imap_server = imap_server
+        self.__port = port
+        self.__use_ssl = use_ssl
+        self._queue = queue if queue is not None else asyncio.Queue()
+        self.__username = None
+        self.__password = None
+        self.__refill_interval = None
+        self.__fetch_chunk_size = 100
+        self.__max_queued = None  # same as in Mailbox
+        # set whenever a mail is taken out of the _queue, so that a waiting refill task can continue
+        self.__queue_not_full = asyncio.Event()
+        self.__refill_task = None
+        self._imap = None
+        self.__logged_in = False
+        self.__idle = False
+        self.__idle_timeout = 29 * 60
+        self.__sync_state = {"uidvalidity": None, "last_uid": 0, "highestmodseq": None}
+        self.__state_file = None
+        self.__partial_fetch = True
+        self.__health_check_interval = 60
+        self.__max_reconnect_delay = 5 * 60
+        self.__connection_stats = {
+            "reconnects": 0,
+            "downtime": 0.0,
+            "disconnected_since": None,
+            "last_error": None,
+            "unexpected_errors": 0,
+        }
+        self.__unexpected_failures = 0  # since the last refill that went through
+
+    def logged_in(self):
+        return self.__logged_in
+
+    # same as Mailbox.alive(), with the refill task instead of the refill thread
+    def alive(self):
+        return self.__logged_in and not self.__refill_task.done()
+
+    def account(self):
+        return self.__username
+
+    def folder(self):
+        return self.__folder
+
+    def idling(self):
+        return self.__idle
+
+    # same as Mailbox.connection_stats()
+    def connection_stats(self):
+        stats = dict(self.__connection_stats)
+        if stats["disconnected_since"] is not None:
+            stats["downtime"] += time.time() - stats["disconnected_since"]
+        stats["connected"] = stats.pop("disconnected_since") is None
+        return stats
+
+    # same arguments as Mailbox.start(), except for the ones about threads and processes
+    async def start(
+        self,
+        refill_interval,
+        username,
+        password,
+        idle=True,
+        fetch_chunk_size=100,
+        state_file=None,
+        partial_fetch=True,
+        max_queued=None,
+        health_check_interval=60,
+    ):
+        if max_queued is not None and (
+            not isinstance(max_queued, int) or max_queued < 1
+        ):
+            raise ValueError(
+                "start() method argument 'max_queued' must be an integer greater than 0 or None"
+            )
+        for name, val in (
+            ("refill_interval", refill_interval),
+            ("fetch_chunk_size", fetch_chunk_size),
+            ("health_check_interval", health_check_interval),
+        ):
+            if not isinstance(val, int):
+                raise TypeError(
+                    f"start() method argument '{name}' must be of type 'int'"
+                )
+            if val < 1:
+                raise ValueError(
+                    f"start() method argument '{name}' must be an integer greater than 0"
+                )
+        self.__refill_interval = refill_interval
+        self.__fetch_chunk_size = fetch_chunk_size
+        self.__max_queued = max_queued
+        self.__health_check_interval = health_check_interval
+        self.__partial_fetch = partial_fetch
+        self.__state_file = state_file
+        self._load_sync_state()
+        self.__username = username
+        self.__password = password
+        await self._connect()
+        self.__logged_in = True
+        self.__idle = idle and "IDLE" in self._imap.capabilities
+        self.__refill_task = asyncio.create_task(self._refill_task())
+
+    async def stop(self):
+        if self.__logged_in is False:
+            raise IllegalAsyncLogoutError("User is not logged in")
+        await _cancel(self.__refill_task)
+        try:
+            await asyncio.wait_for(self._imap.logout(), 5)
+        except Exception:  # connection was already lost, or stuck in an IDLE
+            self._imap.close()
+        self.__logged_in = False
+
+    async def _connect(self):
+        imap = AsyncImapClient(self.__imap_server, self.__port, self.__use_ssl)
+        try:
+            await imap.connect()
+            await imap.login(self.__username, self.__password)
+        except Exception as e:
+            imap.close()
+            raise ImapError(e)
+        if "CONDSTORE" in imap.capabilities and "ENABLE" in imap.capabilities:
+            try:
+                await imap.enable("CONDSTORE")
+            except AsyncImapError:  # refill without the modseq shortcut
+                pass
+        self._imap = imap
+
+    # same as Mailbox._reconnect(), but sleeps without blocking the event loop
+    async def _reconnect(self, error):
+        stats = self.__connection_stats
+        stats["disconnected_since"] = time.time()
+        stats["last_error"] = str(error)
+        self._imap.close()
+        delay = 1
+        while True:
+            try:
+                await self._connect()
+                stats["reconnects"] += 1
+                break
+            except ImapError as e:
+                stats["last_error"] = str(e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.__max_reconnect_delay)
+        stats["downtime"] += time.time() - stats["disconnected_since"]
+        stats["disconnected_since"] = None
+
+    async def _refill_task(self):
+        while True:
+            try:
+                await self._watch_mailbox()
+            except (
+                AsyncImapError,
+                OSError,
+                asyncio.IncompleteReadError,
+                asyncio.TimeoutError,
+            ) as e:
+                await self._reconnect(e)
+            # same as in Mailbox._refill_thread()
+            except Exception as e:
+                self.__connection_stats["unexpected_errors"] += 1
+                self.__unexpected_failures += 1
+                await asyncio.sleep(
+                    min(
+                        2 ** (self.__unexpected_failures - 1),
+                        self.__max_reconnect_delay,
+                    )
+                )
+                await self._reconnect(f"{type(e).__name__}: {e}")
+
+    # refills the _queue at startup, then every time an IDLE reports new mail (or every refill_interval seconds if the
+    # server doesn't support IDLE), the IDLE is ended every health_check_interval seconds to check the connection
+    async def _watch_mailbox(self):
+        while self.__idle:
+            await self._refill_queue()
+            idle_start = time.time()
+            while True:
+                remaining = self.__idle_timeout - (time.time() - idle_start)
+                if remaining <= 0:
+                    break
+                new_mail = await self._imap.idle(
+                    min(remaining, self.__health_check_interval)
+                )
+                if new_mail == None:
+                    self.__idle = False
+                    break
+                if new_mail:
+                    break
+        while True:
+            await self._refill_queue()
+            await asyncio.sleep(self.__refill_interval)
+
+    # same as Mailbox._refill_queue()
+    async def _refill_queue(self):
+        uids = await self._fetch_new_mails()
+        while len(uids) != 0:
+            # the mails are marked as seen once fetched, so never fetch more than there is room for: a put() waiting for
+            # room could be cancelled, and the mails it held would never be fetched again
+            room = await self._wait_for_room()
+            chunk, uids = (
+                uids[: min(room, self.__fetch_chunk_size)],
+                uids[min(room, self.__fetch_chunk_size) :],
+            )
+            if self.__partial_fetch:
+                mails = await self._fetch_text_parts(chunk)
+            else:
+                mails = await self._fetch_full_mails(chunk)
+            for mail_details in mails:
+                mail_details["account"] = self.__username
+                mail_details["folder"] = self.__folder
+                await self._queue.put(mail_details)
+            self._save_sync_state(last_uid=int(chunk[-1]))
+        self.__unexpected_failures = 0
+
+    # same as Mailbox._wait_for_room(), the refill task is cancelled instead of stopped
+    async def _wait_for_room(self):
+        if self.__max_queued is None:
+            return self.__fetch_chunk_size
+        while True:
+            room = self.__max_queued - self._queue.qsize()
+            if room > 0:
+                return room
+            self.__queue_not_full.clear()
+            # wake up every second anyway, the _queue may be emptied by someone else than pop()
+            try:
+                await asyncio.wait_for(self.__queue_not_full.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+
+    # returns the UIDs of the unseen mails above the last processed one, oldest first
+    async def _fetch_new_mails(self):
+        await self._imap.select(self.__folder)
+        codes = self._imap.select_codes
+        uidvalidity = int(codes["UIDVALIDITY"]) if "UIDVALIDITY" in codes else None
+        highestmodseq = (
+            int(codes["HIGHESTMODSEQ"]) if "HIGHESTMODSEQ" in codes else None
+        )
+
+        state = self.__sync_state
+        if uidvalidity != state["uidvalidity"]:
+            self._save_sync_state(
+                uidvalidity=uidvalidity, last_uid=0, highestmodseq=None
+            )
+        elif highestmodseq is not None and highestmodseq == state["highestmodseq"]:
+            return []
+
+        last_uid = state["last_uid"]
+        status, untagged = await self._imap.uid(
+            "search", f"UID {last_uid + 1}:*", "UNSEEN"
+        )
+        if status != "OK":
+            return []
+        uids = [
+            uid
+            for line in untagged.get("SEARCH", [])
+            for uid in line.split()
+            if int(uid) > last_uid
+        ]
+        if len(uids) == 0:
+            self._save_sync_state(highestmodseq=highestmodseq)
+        return sorted(uids, key=int)
+
+    async def _fetch_full_mails(self, uids):
+        status, untagged = await self._imap.uid(
+            "fetch", Mailbox._to_sequence_set(uids), "(RFC822)"
+        )
+        if status != "OK":
+            return []
+        raw_mails = [
+            part[1] for part in untagged.get("FETCH", []) if isinstance(part, tuple)
+        ]
+        mails = [_parse_raw_mail(raw_mail) for raw_mail in raw_mails]
+        return [mail_details for mail_details in mails if mail_details != None]
+
+    # same as Mailbox._fetch_text_parts()
+    async def _fetch_text_parts(self, uids):
+        status, untagged = await self._imap.uid(
+            "fetch",
+            Mailbox._to_sequence_set(uids),
+            "(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM SUBJECT MESSAGE-ID)])",
+        )
+        if status != "OK":
+            return await self._fetch_full_mails(uids)
+        headers, sections, fallback_uids = Mailbox._sort_text_parts(
+            uids, Mailbox._parse_fetch_response(untagged.get("FETCH", []))
+        )
+
+        text_parts = []
+        for section, parts in sections.items():
+            status, untagged = await self._imap.uid(
+                "fetch",
+                Mailbox._to_sequence_set([uid for uid, _, _ in parts]),
+                f"(BODY.PEEK[{section}])",
+            )
+            fetched = (
+                Mailbox._parse_fetch_response(untagged.get("FETCH", []))
+                if status == "OK"
+                else {}
+            )
+            text_parts += Mailbox._text_parts_of(section, parts, headers, fetched)
+
+        seen_uids = [uid for uid in map(int, uids) if uid not in fallback_uids]
+        if seen_uids:
+            await self._imap.uid(
+                "store", Mailbox._to_sequence_set(seen_uids), "+FLAGS", "(\\Seen)"
+            )
+
+        mails = [_parse_text_part(*text_part) for text_part in text_parts]
+        valid_mails = [mail_details for mail_details in mails if mail_details != None]
+        if fallback_uids:
+            valid_mails += await self._fetch_full_mails(fallback_uids)
+        return valid_mails
+
+    # same state file as a Mailbox's
+    def _load_sync_state(self):
+        self.__sync_state = _read_sync_state(self.__state_file)
+
+    def _save_sync_state(self, **changes):
+        self.__sync_state.update(changes)
+        _write_sync_state(self.__state_file, self.__sync_state)
+
+    # returns the next mail, or None if no mail arrives within timeout seconds (timeout=None waits until there is one)
+    async def pop(self, timeout=None):
+        try:
+            if timeout == 0:
+                mail = self._queue.get_nowait()
+            else:
+                mail = await asyncio.wait_for(self._queue.get(), timeout)
+        except (asyncio.QueueEmpty, asyncio.TimeoutError):
+            return None
+        self._notify_room()
+        return mail
+
+    # lets the refill task know that there is room in the _queue again
+    def _notify_room(self):
+        self.__queue_not_full.set()
+
+    def size(self):
+        return self._queue.qsize()
+
+
+# the asyncio counterpart of InboxPool: any number of accounts/folders watched from one event loop, each on its own
+# connection, their mails merged into one _queue
+# max_queued limits the number of mails waiting in the _queue, the rest stay on the server until pop() makes room
+class AsyncInbox:
+    def __init__(
+        self, max_queued=None, imap_server="imap.gmail.com", port=993, use_ssl=True
+    ):
+        if max_queued is not None and (
+            not isinstance(max_queued, int) or max_queued < 1
+        ):
+            raise ValueError("'max_queued' must be an integer greater than 0 or None")
+        # like the InboxPool's, the _queue itself is unbounded and each mailbox stops fetching once it holds max_queued mails
+        self._queue = asyncio.Queue()
+        self.__max_queued = max_queued
+        self.__imap_server = imap_server
+        self.__port = port
+        self.__use_ssl = use_ssl
+        self.__mailboxes = []
+
+    def mailboxes(self):
+        return list(self.__mailboxes)
+
+    # same as InboxPool.start(), the mailboxes log in concurrently
+    async def start(self, refill_interval, accounts, state_file=None, **options):
+        if not isinstance(accounts, list) or len(accounts) == 0:
+            raise TypeError(
+                "start() method argument 'accounts' must be a non-empty 'list' of 'dict'"
+            )
+        for account in accounts:
+            if not isinstance(account, dict) or not (
+                "email" in account and "password" in account
+            ):
+                raise TypeError(
+                    "every account must be of type 'dict' with keys 'email' and 'password'"
+                )
+        mailboxes, starts = [], []
+        for account in accounts:
+            folder = account.get("folder", "INBOX")
+            mailbox = AsyncMailbox(
+                folder, self._queue, self.__imap_server, self.__port, self.__use_ssl
+            )
+            mailbox_state_file = None
+            if state_file is not None:
+                stem, extension = os.path.splitext(state_file)
+                mailbox_state_file = f"{stem}_{account['email']}_{folder}{extension}"
+            mailboxes.append(mailbox)
+            starts.append(
+                mailbox.start(
+                    refill_interval,
+                    account["email"],
+                    account["password"],
+                    state_file=mailbox_state_file,
+                    max_queued=self.__max_queued,
+                    **options,
+                )
+            )
+        results = await asyncio.gather(*starts, return_exceptions=True)
+        self.__mailboxes = [mailbox for mailbox in mailboxes if mailbox.logged_in()]
+        for result in results:
+            if isinstance(result, Exception):
+                # don't leave the mailboxes that did start running in the background
+                await self.stop()
+                raise result
+
+    async def stop(self):
+        await asyncio.gather(
+            *(mailbox.stop() for mailbox in self.__mailboxes if mailbox.logged_in())
+        )
+        self.__mailboxes = []
+
+    def logged_in(self):
+        return any(mailbox.logged_in() for mailbox in self.__mailboxes)
+
+    def alive(self):
+        return len(self.__mailboxes) != 0 and all(
+            mailbox.alive() for mailbox in self.__mailboxes
+        )
+
+    def connection_stats(self):
+        return {
+            (mailbox.account(), mailbox.folder()): mailbox.connection_stats()
+            for mailbox in self.__mailboxes
+        }
+
+    # returns the next mail of any of the mailboxes, or None if no mail arrives within timeout seconds
+    async def pop(self, timeout=None):
+        try:
+            if timeout == 0:
+                mail = self._queue.get_nowait()
+            else:
+                mail = await asyncio.wait_for(self._queue.get(), timeout)
+        except (asyncio.QueueEmpty, asyncio.TimeoutError):
+            return None
+        for mailbox in self.__mailboxes:
+            mailbox._notify_room()
+        return mail
+
+    def size(self):
+        return self._queue.qsize()
+
+
+class AsyncImapError(RuntimeError):
+    pass
+
+
+class IllegalAsyncLogoutError(RuntimeError):
+    pass
@@ -0,0 +1,420 @@
+import asyncio
+import time
+import ssl
+import base64
+import socket
+from collections import deque
+from email.utils import parseaddr
+from delivery_log import DeliveryLog
+from outbox import TokenBucket, _backoff_delay
+from async_inbox import _cancel
+
+
+# a minimal SMTP client on asyncio streams (EHLO, AUTH PLAIN, MAIL/RCPT/DATA, NOOP, QUIT), with just what an
+# AsyncOutbox needs
+class AsyncSmtpClient:
+    def __init__(self, host, port=465, use_ssl=True, timeout=60):
+        self.__host = host
+        self.__port = port
+        self.__use_ssl = use_ssl
+        self.__timeout = timeout
+        self._reader = None
+        self._writer = None
+        self.last_used = 0  # time.monotonic() of the last command
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                self.__host,
+                self.__port,
+                ssl=ssl.create_default_context() if self.__use_ssl else None,
+            ),
+            self.__timeout,
+        )
+        code, message = await self._read_reply()
+        if code != 220:
+            raise AsyncSmtpError(code, message)
+        await self._expect(f"EHLO {socket.gethostname()}", 250)
+
+    async def login(self, username, password):
+        credentials = base64.b64encode(f"\0{username}\0{password}".encode()).decode()
+        code, message = await self._command(f"AUTH PLAIN {credentials}")
+        if code != 235:
+            raise AsyncSmtpAuthenticationError(code, message)
+
+    # sends a mail to a single recipient, raises AsyncSmtpError if the server refuses it
+    # the addresses may come with a display name ('John <john@example.com>'), only the address itself goes in the envelope
+    async def sendmail(self, from_addr, to_addr, message):
+        try:
+            await self._expect(f"MAIL FROM:<{parseaddr(from_addr)[1]}>", 250)
+            await self._expect(f"RCPT TO:<{parseaddr(to_addr)[1]}>", 250, 251)
+            await self._expect("DATA", 354)
+        except AsyncSmtpError:
+            # leaves the session ready for the next mail
+            await self._command("RSET")
+            raise
+        # CRLF line endings, and lines starting with a dot get another one (RFC 5321, 4.5.2)
+        lines = message.replace("\r\n", "\n").split("\n")
+        data = "\r\n".join(
+            "." + line if line.startswith(".") else line for line in lines
+        )
+        self._writer.write(data.encode() + b"\r\n.\r\n")
+        await self._writer.drain()
+        code, reply = await self._read_reply()
+        if code != 250:
+            raise AsyncSmtpError(code, reply)
+
+    async def noop(self):
+        return (await self._command("NOOP"))[0]
+
+    async def quit(self):
+        try:
+            await self._command("QUIT")
+        finally:
+            self.close()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def _expect(self, line, *codes):
+        code, message = await self._command(line)
+        if code not in codes:
+            raise AsyncSmtpError(code, message)
+
+    async def _command(self, line):
+        self._writer.write(line.encode() + b"\r\n")
+        await self._writer.drain()
+        self.last_used = time.monotonic()
+        return await self._read_reply()
+
+    # returns (code, message) of a (possibly multi-line) reply
+    async def _read_reply(self):
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self._reader.readline(), self.__timeout)
+            if line == b"":
+                raise ConnectionResetError("SMTP server closed the connection")
+            line = line.decode("utf-8", "replace").rstrip("\r\n")
+            lines.append(line[4:])
+            # '250-...' is followed by more lines, '250 ...' is the last one
+            if len(line) < 4 or line[3] != "-":
+                return int(line[:3]), "\n".join(lines)
+
+
+# the asyncio counterpart of TokenBucket, waiting for a token doesn't block the event loop
+class AsyncTokenBucket(TokenBucket):
+    async def acquire(self):
+        while True:
+            wait_time = self._take()
+            if wait_time == 0:
+                return
+            await asyncio.sleep(wait_time)
+
+
+# the asyncio counterpart of the Outbox: push() hands a mail to sender tasks of the running event loop, each keeping its
+# own SMTP session open, instead of a flush thread
+# failed mails are retried with the same backoff as the Outbox, and kept as dead letters once out of attempts
+class AsyncOutbox:
+    def __init__(self, smtp_server="smtp.gmail.com", smtp_port=465, use_ssl=True):
+        self.__smtp_server = smtp_server
+        self.__smtp_port = smtp_port
+        self.__use_ssl = use_ssl
+        self._queue = None  # (mail, attempts) waiting for a sender task
+        self.__sender_credentials = {"email": None, "password": None}
+        self.__senders = []
+        self.__working = False
+        self.__max_attempts = 5
+        self.__retry_base_delay = 30
+        self.__retry_max_delay = 30 * 60
+        self.__retries = {}  # task sleeping until the retry is due -> (mail, attempts)
+        # (mail, attempts) of the retries still pending when the AsyncOutbox was stopped
+        self.__unsent = []
+        self.__smtp_error_occurred = False
+        self.__smtp_failures = 0
+        self.__smtp_down_until = 0
+        # same as in the Outbox
+        self.__auth_failures = 0
+        self.__max_auth_failures = 3
+        self.__rate_limit = None
+        self.__domain_rate_limit = None
+        self.__domain_buckets = {}
+        self.__dead_letters = []
+        self.__next_dead_letter_id = 1
+        self.__delivery_log = None
+        self.__sent = 0
+        self.__failed = 0
+        self.__sent_times = deque()
+        # sessions are checked with a NOOP before being used if they have been unused this long
+        self.__health_check_interval = 30
+
+    def is_working(self):
+        return self.__working
+
+    # whether the AsyncOutbox is still sending mails, i.e. it was started and none of its sender tasks has ended
+    def alive(self):
+        return self.__working and not any(task.done() for task in self.__senders)
+
+    # same as Outbox.smtp_error_occurred()
+    def smtp_error_occurred(self):
+        return self.__smtp_error_occurred
+
+    def size(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    # same counters as Outbox.delivery_stats()
+    def delivery_stats(self):
+        self._forget_old_sends()
+        return {
+            "sent": self.__sent,
+            "failed": self.__failed,
+            "sent_last_minute": len(self.__sent_times),
+            "retrying": len(self.__retries),
+            "dead_letters": len(self.__dead_letters),
+        }
+
+    # same as the arguments of Outbox.start() with the same names, max_queue_size is the number of mails push() lets
+    # wait for a sender task before it waits itself
+    async def start(
+        self,
+        sender_credentials,
+        sender_workers=1,
+        max_queue_size=100,
+        rate_limit=None,
+        domain_rate_limit=None,
+        max_attempts=5,
+        retry_base_delay=30,
+        retry_max_delay=30 * 60,
+        log_file=None,
+        max_auth_failures=3,
+    ):
+        if (
+            not isinstance(sender_credentials, dict)
+            or not isinstance(sender_credentials.get("email"), str)
+            or not isinstance(sender_credentials.get("password"), str)
+        ):
+            raise TypeError(
+                "start() method argument 'sender_credentials' must be of type 'dict' with 'str' keys 'email' and 'password'"
+            )
+        for name, val in (
+            ("sender_workers", sender_workers),
+            ("max_queue_size", max_queue_size),
+            ("max_attempts", max_attempts),
+            ("max_auth_failures", max_auth_failures),
+        ):
+            if not isinstance(val, int) or val < 1:
+                raise ValueError(
+                    f"start() method argument '{name}' must be an integer greater than 0"
+                )
+        self.__sender_credentials = dict(sender_credentials)
+        self.__max_attempts = max_attempts
+        self.__retry_base_delay = retry_base_delay
+        self.__retry_max_delay = retry_max_delay
+        self.__max_auth_failures = max_auth_failures
+        self.__rate_limit = (
+            None if rate_limit is None else AsyncTokenBucket(*rate_limit)
+        )
+        self.__domain_rate_limit = domain_rate_limit
+        self.__domain_buckets = {}
+        self.__smtp_error_occurred = False
+        self.__smtp_failures, self.__smtp_down_until = 0, 0
+        self.__auth_failures = 0
+        if log_file is not None:
+            self.__delivery_log = DeliveryLog(log_file)
+        self._queue = asyncio.Queue(maxsize=max_queue_size)
+        # the retries that were pending when the AsyncOutbox was stopped
+        unsent, self.__unsent = self.__unsent, []
+        for mail, attempts in unsent:
+            self._retry_later(mail, attempts, 0)
+        self.__senders = [
+            asyncio.create_task(self._sender_task()) for _ in range(sender_workers)
+        ]
+        self.__working = True
+
+    # waits for the queued mails to be dealt with and stops the sender tasks
+    # the mails waiting for a retry are kept, and tried again by the next start()
+    async def stop(self):
+        if self.__working is False:
+            raise IllegalAsyncStopError("AsyncOutbox was not started")
+        await self._queue.join()
+        for task, (mail, attempts) in list(self.__retries.items()):
+            task.cancel()
+            self.__unsent.append((mail, attempts))
+        self.__retries = {}
+        await asyncio.gather(*(_cancel(task) for task in self.__senders))
+        self.__senders = []
+        if self.__delivery_log is not None:
+            self.__delivery_log.close()
+            self.__delivery_log = None
+        self.__working = False
+
+    # waits while max_queue_size mails are waiting to be sent
+    async def push(self, mail):
+        if self.__working is False:
+            raise IllegalAsyncStopError("AsyncOutbox was not started")
+        await self._queue.put((mail, 0))
+
+    def dead_letters(self):
+        return [dict(letter) for letter in self.__dead_letters]
+
+    # same as Outbox.replay_dead_letters()
+    async def replay_dead_letters(self, ids=None):
+        letters = [
+            letter
+            for letter in self.__dead_letters
+            if ids is None or letter["id"] in ids
+        ]
+        self.__dead_letters = [
+            letter for letter in self.__dead_letters if letter not in letters
+        ]
+        for letter in letters:
+            await self._queue.put((letter["mail"], 0))
+        return len(letters)
+
+    async def _sender_task(self):
+        session = None
+        try:
+            while True:
+                mail, attempts = await self._queue.get()
+                try:
+                    session = await self._send_mail(session, mail, attempts)
+                finally:
+                    self._queue.task_done()
+        finally:
+            if session is not None:
+                try:
+                    await asyncio.wait_for(session.quit(), 5)
+                except Exception:
+                    session.close()
+
+    # sends the mail over the session (opening a new one if needed) and returns the session to use for the next mail
+    async def _send_mail(self, session, mail, attempts):
+        # the server was unreachable a moment ago, wait for it to come back before trying again
+        if time.time() < self.__smtp_down_until:
+            self._retry_later(mail, attempts, self.__smtp_down_until - time.time())
+            return session
+        await self._wait_for_rate_limits(mail["to"])
+
+        email_message = f"Subject:{mail['subject']}\nTo:{mail['to']}\n{mail['body']}"
+        logged_in = False
+        try:
+            session = await self._usable_session(session)
+            logged_in = True
+            self.__auth_failures = 0
+            await session.sendmail(
+                self.__sender_credentials["email"], mail["to"], email_message
+            )
+        except Exception as e:
+            # the server answered, the session is still fine
+            if not isinstance(e, AsyncSmtpError) or not logged_in:
+                if session is not None:
+                    session.close()
+                session = None
+            # not the mail's fault, it doesn't lose an attempt
+            if not logged_in:
+                self._smtp_unavailable(e)
+                self._retry_later(mail, attempts, self.__smtp_down_until - time.time())
+                return session
+            attempts += 1
+            if attempts >= self.__max_attempts:
+                self.__dead_letters.append(
+                    {
+                        "id": self.__next_dead_letter_id,
+                        "mail": mail,
+                        "attempts": attempts,
+                        "error": repr(e),
+                        "failed_at": time.time(),
+                    }
+                )
+                self.__next_dead_letter_id += 1
+                self.__failed += 1
+            else:
+                self._retry_later(mail, attempts, self._backoff(attempts))
+            return session
+
+        self.__smtp_error_occurred = False
+        self.__smtp_failures = 0
+        if self.__delivery_log is not None:
+            self.__delivery_log.record(mail)
+        self.__sent += 1
+        self.__sent_times.append(time.time())
+        self._forget_old_sends()
+        return session
+
+    # returns the given session if it is still alive, or a new logged in one
+    async def _usable_session(self, session):
+        if session is not None:
+            if time.monotonic() - session.last_used < self.__health_check_interval:
+                return session
+            try:
+                if await session.noop() == 250:
+                    return session
+            except Exception:
+                pass
+            session.close()
+        session = AsyncSmtpClient(self.__smtp_server, self.__smtp_port, self.__use_ssl)
+        try:
+            await session.connect()
+            await session.login(
+                self.__sender_credentials["email"],
+                self.__sender_credentials["password"],
+            )
+        except Exception:
+            session.close()
+            raise
+        return session
+
+    # same as Outbox._backoff()
+    def _backoff(self, failures):
+        return _backoff_delay(failures, self.__retry_base_delay, self.__retry_max_delay)
+
+    # same as Outbox._smtp_unavailable()
+    def _smtp_unavailable(self, error):
+        if isinstance(error, AsyncSmtpAuthenticationError) and error.code >= 500:
+            self.__auth_failures += 1
+            if self.__auth_failures >= self.__max_auth_failures:
+                self.__smtp_error_occurred = True
+        if time.time() >= self.__smtp_down_until:
+            self.__smtp_failures += 1
+            self.__smtp_down_until = time.time() + self._backoff(self.__smtp_failures)
+
+    def _retry_later(self, mail, attempts, delay):
+        task = asyncio.create_task(self._retry(mail, attempts, delay))
+        self.__retries[task] = (mail, attempts)
+
+    async def _retry(self, mail, attempts, delay):
+        await asyncio.sleep(max(delay, 0))
+        await self._queue.put((mail, attempts))
+        self.__retries.pop(asyncio.current_task(), None)
+
+    async def _wait_for_rate_limits(self, receiver_mail):
+        if self.__domain_rate_limit is not None:
+            # the recipient may be a whole header, like "John <john@example.com>"
+            domain = parseaddr(receiver_mail)[1].rpartition("@")[2].lower()
+            bucket = self.__domain_buckets.get(domain)
+            if bucket is None:
+                bucket = AsyncTokenBucket(*self.__domain_rate_limit)
+                self.__domain_buckets[domain] = bucket
+            await bucket.acquire()
+        if self.__rate_limit is not None:
+            await self.__rate_limit.acquire()
+
+    def _forget_old_sends(self):
+        minute_ago = time.time() - 60
+        while len(self.__sent_times) != 0 and self.__sent_times[0] < minute_ago:
+            self.__sent_times.popleft()
+
+
+class AsyncSmtpError(RuntimeError):
+    def __init__(self, code, message):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class AsyncSmtpAuthenticationError(AsyncSmtpError):
+    pass
+
+
+class IllegalAsyncStopError(RuntimeError):
+    pass
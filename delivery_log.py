@@ -0,0 +1,180 @@
+import threading
+import time
+import json
+import sqlite3
+from email.utils import parseaddr
+
+
+# record of the mails sent by the Outbox, kept in SQLite with indexes on the recipient and the time of sending,
+# so that questions like "did we reply to X?" don't need a scan of the whole log
+# rows are handed to a writer thread and inserted in batches, so that recording a mail never waits for the disk
+# retention_days / max_rows (optional) make the writer thread drop the oldest rows once they are too old / too many
+class DeliveryLog:
+    def __init__(self, path, flush_interval=1, retention_days=None, max_rows=None):
+        self.__path = path
+        # how long the writer thread waits for more rows to pile up before inserting them together
+        self.__flush_interval = flush_interval
+        self.__retention_days = retention_days
+        self.__max_rows = max_rows
+        self.__rows = []  # rows waiting to be inserted
+        self.__submitted = 0
+        self.__written = 0
+        self.__closing = False
+        self.__cond = threading.Condition()
+        self.__last_error = None
+
+        db = self._connect()
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS deliveries (id INTEGER PRIMARY KEY, sent_at REAL NOT NULL, recipient TEXT NOT NULL, subject TEXT NOT NULL, details TEXT NOT NULL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS deliveries_recipient ON deliveries (recipient, sent_at)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS deliveries_sent_at ON deliveries (sent_at)"
+            )
+        db.close()
+
+        self.__writer_thread = threading.Thread(target=self._writer_thread, daemon=True)
+        self.__writer_thread.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.__path)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    # queues a row for the mail, the mail dict itself is left untouched and its body is not logged
+    def record(self, mail, sent_at=None):
+        details = {
+            key: value
+            for key, value in mail.items()
+            if key not in ("to", "subject", "body")
+        }
+        row = (
+            time.time() if sent_at == None else sent_at,
+            self._address(mail["to"]),
+            mail["subject"],
+            json.dumps(details),
+        )
+        with self.__cond:
+            if self.__closing:
+                raise IllegalLogAccessError("DeliveryLog was closed")
+            self.__rows.append(row)
+            self.__submitted += 1
+            self.__cond.notify_all()
+
+    # the bare address of a recipient, lowercased, so that "John <John@example.com>" and "john@example.com" are the same
+    @staticmethod
+    def _address(recipient):
+        address = parseaddr(recipient)[1]
+        return (address if address != "" else recipient.strip()).lower()
+
+    # returns the mails sent to 'recipient' (all of them if None) between 'since' and 'until' (epoch seconds), newest first
+    # each one as a dict with the keys 'sent_at', 'to', 'subject' and whatever else the mail dict held (except 'body')
+    def query(self, recipient=None, since=None, until=None, limit=None):
+        conditions, params = [], []
+        if recipient != None:
+            conditions.append("recipient = ?")
+            params.append(self._address(recipient))
+        if since != None:
+            conditions.append("sent_at >= ?")
+            params.append(since)
+        if until != None:
+            conditions.append("sent_at < ?")
+            params.append(until)
+        sql = "SELECT sent_at, recipient, subject, details FROM deliveries"
+        if len(conditions) != 0:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY sent_at DESC"
+        if limit != None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        self.flush()
+        db = self._connect()
+        rows = db.execute(sql, params).fetchall()
+        db.close()
+        mails = []
+        for sent_at, recipient, subject, details in rows:
+            mail = json.loads(details)
+            mail.update({"sent_at": sent_at, "to": recipient, "subject": subject})
+            mails.append(mail)
+        return mails
+
+    # whether a mail was sent to 'recipient' (since 'since', if given)
+    def replied_to(self, recipient, since=None):
+        return len(self.query(recipient=recipient, since=since, limit=1)) != 0
+
+    # blocks until every row recorded so far has been written
+    def flush(self):
+        with self.__cond:
+            target = self.__submitted
+            while self.__written < target and self.__writer_thread.is_alive():
+                self.__cond.wait(timeout=1)
+
+    # writes the remaining rows and stops the writer thread
+    def close(self):
+        with self.__cond:
+            self.__closing = True
+            self.__cond.notify_all()
+        self.__writer_thread.join()
+
+    def last_error(self):
+        return self.__last_error
+
+    def _writer_thread(self):
+        db = self._connect()
+        self._prune(db)
+        last_prune = time.time()
+        while True:
+            with self.__cond:
+                while len(self.__rows) == 0 and not self.__closing:
+                    self.__cond.wait()
+                if len(self.__rows) == 0:  # closing and nothing left to write
+                    break
+            # let more rows pile up, they are all inserted in the same transaction
+            if not self.__closing:
+                with self.__cond:
+                    self.__cond.wait_for(
+                        lambda: self.__closing, timeout=self.__flush_interval
+                    )
+            with self.__cond:
+                rows, self.__rows = self.__rows, []
+            try:
+                with db:
+                    db.executemany(
+                        "INSERT INTO deliveries (sent_at, recipient, subject, details) VALUES (?, ?, ?, ?)",
+                        rows,
+                    )
+            # the mails were sent all the same, only their record is lost
+            except sqlite3.Error as e:
+                self.__last_error = str(e)
+            with self.__cond:
+                self.__written += len(rows)
+                self.__cond.notify_all()
+            if time.time() - last_prune >= 60 * 60:
+                self._prune(db)
+                last_prune = time.time()
+        db.close()
+
+    # drops the rows older than retention_days and the oldest rows beyond max_rows
+    def _prune(self, db):
+        try:
+            with db:
+                if self.__retention_days != None:
+                    db.execute(
+                        "DELETE FROM deliveries WHERE sent_at < ?",
+                        (time.time() - self.__retention_days * 24 * 60 * 60,),
+                    )
+                if self.__max_rows != None:
+                    db.execute(
+                        "DELETE FROM deliveries WHERE id <= (SELECT MAX(id) FROM deliveries) - ?",
+                        (self.__max_rows,),
+                    )
+        except sqlite3.Error as e:
+            self.__last_error = str(e)
+
+
+class IllegalLogAccessError(RuntimeError):
+    pass
@@ -1,22 +1,73 @@
 import threading
 import time
-from queue import Queue
+from queue import Queue, Empty
 import imaplib
 import email
 import ssl
+import select
+import json
+import os
+import re
+import base64
+import quopri
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from email.header import decode_header
 
+# imaplib does not know about the IDLE extension (RFC 2177), register it so that _command() accepts it
+imaplib.Commands.setdefault("IDLE", ("AUTH", "SELECTED"))
 
-class Inbox:
-    _queue = Queue()
-    __refill_interval = None
-    __refill_thread = None
-    __stop_refill_thread = False  # flag
-    _imap = None
-    __logged_in = False
+# splits a FETCH response into tokens: parentheses, quoted strings, literal markers {n} and atoms
+# an atom may end in a bracketed section, which can itself contain spaces, e.g. BODY[HEADER.FIELDS (FROM SUBJECT)]
+_FETCH_TOKEN = re.compile(
+    rb'\s*(?:(?P<paren>[()])|"(?P<quoted>(?:[^"\\]|\\.)*)"|\{(?P<literal>\d+)\}$|(?P<atom>[^\s()"\[]+(?:\[[^\]]*\])?))'
+)
 
-    @staticmethod
-    def _set_refill_interval(val):
+
+# watches a single IMAP account/folder on its own connection and refill thread
+# the mails found are put in the _queue, which can be shared between several Mailboxes (see InboxPool)
+class Mailbox:
+    def __init__(
+        self, folder="INBOX", queue=None, imap_server="imap.gmail.com", port=993
+    ):
+        self.__folder = folder
+        self.__imap_server = imap_server
+        self.__port = port
+        self._queue = queue if queue is not None else Queue()
+        self.__username = None
+        self.__password = None  # kept to log in again after a reconnect
+        self.__refill_interval = None
+        self.__fetch_chunk_size = 100  # number of mails fetched per UID FETCH command
+        self.__refill_thread = None
+        self.__stop_refill_thread = False  # flag
+        self._imap = None
+        self.__logged_in = False
+        self.__idle = False  # True when the refill thread waits for server pushes (IMAP IDLE) instead of polling
+        # RFC 2177 - servers may drop an IDLE after 30 mins of inactivity, so we re-issue it a bit before that
+        self.__idle_timeout = 29 * 60
+        # UID high-water mark of the folder, so that each refill only asks for mails newer than the last one processed
+        # highestmodseq is only used if the server supports CONDSTORE (RFC 7162), it lets us skip the search entirely when nothing changed
+        self.__sync_state = {"uidvalidity": None, "last_uid": 0, "highestmodseq": None}
+        self.__state_file = None  # the __sync_state is persisted here (if set) so that a restart resumes without rescanning the folder
+        self.__partial_fetch = True  # fetch only the headers and the text/plain part of a mail, instead of the whole message
+        self.__max_queued = None  # the refill thread stops fetching while the _queue holds this many mails (None for no limit)
+        # notified whenever a mail is taken out of the _queue, so that a waiting refill thread can continue
+        self.__queue_not_full = threading.Condition()
+        # process pool the fetched mails are parsed in (None parses them in the refill thread)
+        self.__parse_executor = None
+        self.__owns_parse_executor = False  # True if the executor was created by start() and must be shut down by stop()
+        # connection health, a NOOP is sent if the server hasn't been talked to for health_check_interval seconds
+        # a dead connection is re-established by the refill thread itself, retrying with exponential backoff
+        self.__health_check_interval = 60
+        # blocking reads on a dead connection give up after this long
+        self.__socket_timeout = 60
+        self.__max_reconnect_delay = 5 * 60
+        # unexpected errors since the last refill that went through, see _refill_thread
+        self.__unexpected_failures = 0
+        self.__last_contact = 0
+        self._reset_connection_stats()
+
+    def _set_refill_interval(self, val):
         if not isinstance(val, int):
             raise TypeError(
                 "start() method argument 'refill_interval' must be of type 'int'"
@@ -25,170 +76,925 @@ class Inbox:
             raise ValueError(
                 "start() method argument 'refill_interval' must be a positive integer"
             )
-        Inbox.__refill_interval = val
+        self.__refill_interval = val
 
-    @staticmethod
-    def logged_in():
-        return Inbox.__logged_in
+    def _set_fetch_chunk_size(self, val):
+        if not isinstance(val, int):
+            raise TypeError(
+                "start() method argument 'fetch_chunk_size' must be of type 'int'"
+            )
+        if val < 1:
+            raise ValueError(
+                "start() method argument 'fetch_chunk_size' must be an integer greater than 0"
+            )
+        self.__fetch_chunk_size = val
 
-    @staticmethod
-    def start(refill_interval, username, password):
-        Inbox._set_refill_interval(refill_interval)
-        imap_server = "imap.gmail.com"
+    def _set_max_queued(self, val):
+        if val is None:
+            self.__max_queued = None
+            return
+        if not isinstance(val, int):
+            raise TypeError(
+                "start() method argument 'max_queued' must be of type 'int' or None"
+            )
+        if val < 1:
+            raise ValueError(
+                "start() method argument 'max_queued' must be an integer greater than 0"
+            )
+        self.__max_queued = val
+
+    def _set_parse_executor(self, parse_workers, parse_executor):
+        if not isinstance(parse_workers, int):
+            raise TypeError(
+                "start() method argument 'parse_workers' must be of type 'int'"
+            )
+        if parse_workers < 0:
+            raise ValueError(
+                "start() method argument 'parse_workers' must be a positive integer"
+            )
+        self.__owns_parse_executor = parse_executor is None and parse_workers > 0
+        if self.__owns_parse_executor:
+            # spawn (rather than fork) the workers, forking a process that has other threads running can deadlock the children
+            parse_executor = ProcessPoolExecutor(
+                max_workers=parse_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        self.__parse_executor = parse_executor
+
+    def _reset_connection_stats(self):
+        self.__connection_stats = {
+            "reconnects": 0,
+            "downtime": 0.0,  # total seconds spent reconnecting
+            "disconnected_since": None,
+            "last_error": None,
+            "unexpected_errors": 0,  # errors other than connection/protocol ones, see _refill_thread
+        }
+
+    def _set_health_check_interval(self, val):
+        if not isinstance(val, int):
+            raise TypeError(
+                "start() method argument 'health_check_interval' must be of type 'int'"
+            )
+        if val < 1:
+            raise ValueError(
+                "start() method argument 'health_check_interval' must be an integer greater than 0"
+            )
+        self.__health_check_interval = val
+
+    def _load_sync_state(self):
+        self.__sync_state = _read_sync_state(self.__state_file)
+
+    def _save_sync_state(self, **changes):
+        self.__sync_state.update(changes)
+        _write_sync_state(self.__state_file, self.__sync_state)
+
+    def logged_in(self):
+        return self.__logged_in
+
+    # whether the Mailbox is still working: it is logged in and its refill thread is running
+    # a Mailbox that lost its connection counts as alive, its refill thread keeps reconnecting with backoff for as long
+    # as the server is down, and starting a new Mailbox wouldn't get through any sooner
+    def alive(self):
+        return self.__logged_in and self.__refill_thread.is_alive()
+
+    def account(self):
+        return self.__username
+
+    def folder(self):
+        return self.__folder
+
+    def idling(self):
+        return self.__idle
+
+    # returns the number of reconnects, the total time (in seconds) the Mailbox was disconnected, the last error and the
+    # number of unexpected errors the refill thread recovered from
+    def connection_stats(self):
+        stats = dict(self.__connection_stats)
+        if stats["disconnected_since"] is not None:  # currently reconnecting
+            stats["downtime"] += time.time() - stats["disconnected_since"]
+        stats["connected"] = stats.pop("disconnected_since") is None
+        return stats
+
+    # idle=True makes the Mailbox wait for the server to push new mails (IMAP IDLE) instead of polling it every few seconds
+    # if the server does not support IDLE, the Mailbox falls back to polling
+    # fetch_chunk_size is the number of unseen mails fetched per round-trip when refilling the _queue
+    # state_file is where the UID of the last processed mail is kept between restarts (None keeps it in memory only)
+    # partial_fetch=True downloads only the headers and the text/plain part of each mail (attachments are never transferred)
+    # max_queued limits the number of mails waiting in the _queue, the rest stay on the server until pop() makes room for them
+    # health_check_interval is the number of seconds without talking to the server after which the connection is checked
+    # parse_workers > 0 parses the fetched mails in that many worker processes, parse_executor can be given instead
+    # to share one pool between several Mailboxes
+    def start(
+        self,
+        refill_interval,
+        username,
+        password,
+        idle=True,
+        fetch_chunk_size=100,
+        state_file=None,
+        partial_fetch=True,
+        max_queued=None,
+        health_check_interval=60,
+        parse_workers=0,
+        parse_executor=None,
+    ):
+        self._set_refill_interval(refill_interval)
+        self._set_health_check_interval(health_check_interval)
+        self._set_fetch_chunk_size(fetch_chunk_size)
+        self._set_max_queued(max_queued)
+        self.__partial_fetch = partial_fetch
+        self.__state_file = state_file
+        self._load_sync_state()
+        self.__username = username
+        self.__password = password
+        self._set_parse_executor(parse_workers, parse_executor)
+        self._reset_connection_stats()
+        self._connect()
+        self.__logged_in = True
+        self.__idle = idle and "IDLE" in self._imap.capabilities
+        self.__stop_refill_thread = False
+        # we must ensure that we have logged in to the IMAP server before starting the refill thread which in runs refill_queue (which gets mail from gmail)
+        self.__refill_thread = threading.Thread(target=self._refill_thread, daemon=True)
+        self.__refill_thread.start()
+
+    # connects and logs in to the IMAP server
+    def _connect(self):
         context = ssl.create_default_context()
-        port = 993
         try:
-            Inbox._imap = imaplib.IMAP4_SSL(imap_server, port, ssl_context=context)
-            Inbox._imap.login(username, password)
-            Inbox.__logged_in = True
+            self._imap = imaplib.IMAP4_SSL(
+                self.__imap_server,
+                self.__port,
+                ssl_context=context,
+                timeout=self.__socket_timeout,
+            )
+            self._imap.login(self.__username, self.__password)
         except Exception as e:
             raise ImapError(e)
-        Inbox.__stop_refill_thread = False
-        # we must ensure that we have logged in to the IMAP server before starting the refill thread which in runs refill_queue (which gets mail from gmail)
-        Inbox.__refill_thread = threading.Thread(
-            target=Inbox._refill_thread, daemon=True
-        )
-        Inbox.__refill_thread.start()
+        self.__last_contact = time.time()
+        # ask the server to report HIGHESTMODSEQ on every SELECT
+        if (
+            "CONDSTORE" in self._imap.capabilities
+            and "ENABLE" in self._imap.capabilities
+        ):
+            try:
+                self._imap.enable("CONDSTORE")
+            except imaplib.IMAP4.error:  # refill without the modseq shortcut
+                pass
 
-    # must call this function when the Inbox is no longer used  otherwise the daemon thread will continue on running.
-    @staticmethod
-    def stop():
-        if Inbox.__logged_in is False:
+    # throws away the dead connection and connects again, waiting 1, 2, 4, ... seconds (up to max_reconnect_delay) between attempts
+    # returns once connected, or when the Mailbox is stopped
+    def _reconnect(self, error):
+        stats = self.__connection_stats
+        stats["disconnected_since"] = time.time()
+        stats["last_error"] = str(error)
+        try:
+            self._imap.shutdown()
+        except Exception:  # the socket is probably closed already
+            pass
+        delay = 1
+        while not self.__stop_refill_thread:
+            try:
+                self._connect()
+                stats["reconnects"] += 1
+                break
+            except (ImapError, imaplib.IMAP4.error, OSError) as e:
+                stats["last_error"] = str(e)
+            self._pause(delay)
+            delay = min(delay * 2, self.__max_reconnect_delay)
+        stats["downtime"] += time.time() - stats["disconnected_since"]
+        stats["disconnected_since"] = None
+
+    # sleeps in steps of a second so that stop() doesn't have to wait for the whole delay
+    def _pause(self, delay):
+        wait_until = time.time() + delay
+        while not self.__stop_refill_thread and time.time() < wait_until:
+            time.sleep(1)
+
+    # sends a NOOP if we haven't heard from the server in a while, a dead connection makes it raise
+    def _keep_alive(self):
+        if time.time() - self.__last_contact < self.__health_check_interval:
+            return
+        self._imap.noop()
+        self.__last_contact = time.time()
+
+    # must call this function when the Mailbox is no longer used  otherwise the daemon thread will continue on running.
+    def stop(self):
+        if self.__logged_in is False:
             raise IllegalImapLogoutError("User is not logged in")
-        Inbox.__stop_refill_thread = True
-        Inbox.__refill_thread.join()  # join the refill thread if you want it to finish its work before exiting. This ensures that even if the main thread calls it to stop, the refill thread wil stop only after finishing its work
-        Inbox._imap.logout()
-        Inbox.__logged_in = False
+        self.__stop_refill_thread = True
+        self.__refill_thread.join()  # join the refill thread if you want it to finish its work before exiting. This ensures that even if the main thread calls it to stop, the refill thread wil stop only after finishing its work
+        try:
+            self._imap.logout()
+        except (imaplib.IMAP4.error, OSError):  # connection was already lost
+            pass
+        if self.__owns_parse_executor:
+            self.__parse_executor.shutdown()
+        self.__parse_executor = None
+        self.__logged_in = False
 
     # the _queue will refill itself whenever it becomes empty (to be exact it will refill itself under 5 sec of being empty)
     # More so, the _queue will also refill itself after every refill_interval seconds, regardless of whether it is empty or not
-    @staticmethod
-    def _refill_thread():
-        while not Inbox.__stop_refill_thread:
+    # in IDLE mode, the _queue is refilled as soon as the server reports a new mail (see _idle_refill_thread)
+    # if the connection drops, the refill thread reconnects and carries on from where it was (see _reconnect)
+    def _refill_thread(self):
+        while not self.__stop_refill_thread:
+            try:
+                self._watch_mailbox()
+            except (imaplib.IMAP4.error, OSError) as e:
+                self._reconnect(e)
+            # anything else (e.g. a response we can't make sense of) would end the thread silently and the Mailbox
+            # would stop receiving mails, the connection may be in any state after it so start over on a new one
+            # the same error is likely to come back on the new connection, so wait 1, 2, 4, ... seconds (up to
+            # max_reconnect_delay) first, until a refill goes through again
+            except Exception as e:
+                self.__connection_stats["unexpected_errors"] += 1
+                self.__unexpected_failures += 1
+                self._pause(
+                    min(
+                        2 ** (self.__unexpected_failures - 1),
+                        self.__max_reconnect_delay,
+                    )
+                )
+                self._reconnect(f"{type(e).__name__}: {e}")
+
+    def _watch_mailbox(self):
+        if self.__idle:
+            self._idle_refill_thread()
+        while not self.__stop_refill_thread:
             st = time.time()
-            while time.time() - st < Inbox.__refill_interval:
-                if Inbox._queue.qsize() == 0:
-                    Inbox._refill_queue()
+            while time.time() - st < self.__refill_interval:
+                if self._queue.qsize() == 0:
+                    self._refill_queue()
+                else:
+                    self._keep_alive()
                 time.sleep(5)  # increase this to put less pressure on the CPU
-            Inbox._refill_queue()
+            self._refill_queue()
+
+    # refills the _queue once at startup and then every time an IDLE ends, i.e. when the server reports a new mail
+    # or when the IDLE has to be re-issued because of the 29 min limit (in case we missed something)
+    # the IDLE is also interrupted every health_check_interval seconds, the server has to answer the DONE, which tells us
+    # the connection is still alive
+    # returns when the Mailbox is stopped, or early if the server refuses the IDLE so that the caller can fall back to polling
+    def _idle_refill_thread(self):
+        while not self.__stop_refill_thread:
+            self._refill_queue()
+            idle_start = time.time()
+            while not self.__stop_refill_thread:
+                remaining = self.__idle_timeout - (time.time() - idle_start)
+                if remaining <= 0:
+                    break
+                new_mail = self._idle(min(remaining, self.__health_check_interval))
+                if new_mail == None:
+                    self.__idle = False
+                    return
+                if new_mail:
+                    break
+
+    # issues an IDLE command and blocks until the server reports new mail, the timeout expires or the Mailbox is stopped
+    # returns True if new mail was reported, False if not and None if the server refused the IDLE
+    def _idle(self, timeout):
+        imap = self._imap
+        if imap.state != "SELECTED":
+            imap.select(self.__folder)
+            # drop the counts reported by the SELECT, so that only the ones pushed from now on are looked at
+            imap.untagged_responses.pop("EXISTS", None)
+            imap.untagged_responses.pop("RECENT", None)
+        # the counts left by the last search are dropped by _fetch_new_mails, these came in after it (e.g. during a FETCH)
+        elif self._new_mail_reported(imap):
+            return True
+        tag = imap._command("IDLE")
+        # wait for the '+ idling' continuation response
+        while imap._get_response() is not None:
+            if imap.tagged_commands[tag]:  # server refused the IDLE (BAD/NO)
+                del imap.tagged_commands[tag]
+                return None
+        try:
+            start_time = time.time()
+            while not self.__stop_refill_thread and time.time() - start_time < timeout:
+                # wake up every second so that stop() doesn't have to wait for the IDLE to end
+                readable, _, _ = select.select([imap.sock], [], [], 1)
+                if not readable and not self._buffered(imap):
+                    continue
+                imap._get_response()
+                if self._new_mail_reported(imap):
+                    break
+        finally:
+            imap.send(b"DONE\r\n")
+            imap._command_complete("IDLE", tag)
+        self.__last_contact = time.time()
+        # the server may have reported a new mail while the IDLE was ending, the counts are dropped by the next search
+        return self._new_mail_reported(imap)
 
-    # refills the _queue with new unseen mails
     @staticmethod
-    def _refill_queue():
-        mail_ids = Inbox._fetch_new_mails()
+    def _new_mail_reported(imap):
+        return (
+            "EXISTS" in imap.untagged_responses or "RECENT" in imap.untagged_responses
+        )
+
+    # select() only sees the data still waiting on the socket, not the decrypted data buffered inside the SSL object or
+    # the lines the socket's file already read ahead, returns True if there is any of those
+    @staticmethod
+    def _buffered(imap):
+        if getattr(imap.sock, "pending", lambda: 0)() > 0:
+            return True
+        timeout = imap.sock.gettimeout()
+        imap.sock.settimeout(0)
+        try:
+            return len(imap.file.peek(1)) > 0
+        except (BlockingIOError, ssl.SSLWantReadError):  # nothing to read
+            return False
+        finally:
+            imap.sock.settimeout(timeout)
+
+    # refills the _queue with new unseen mails
+    # the unseen mails are fetched in chunks of fetch_chunk_size UIDs per FETCH command, and each chunk is parsed and
+    # put into the _queue before the next one is fetched, so only one chunk of raw mails is held in memory at a time
+    def _refill_queue(self):
+        mail_ids = self._fetch_new_mails()
+        self.__last_contact = time.time()
         # error getting mails
         if mail_ids == None:
+            self.__unexpected_failures = 0
             return  # RuntimeError('Error getting mail')
         # no new mails found
         if mail_ids[0] == 0:
+            self.__unexpected_failures = 0
             return
-        for mail_id in mail_ids[
-            1
-        ]:  # first element is just the number of mail_ids found
-            try:
-                mail_details = Inbox._get_mail_details(mail_id)
-                # skip invalid mails with empty body/subject or with scam links
-                if mail_details == None:
-                    continue
-                Inbox._queue.put(mail_details)
-            # mails with pictures, graphics (auto-generated / marketing mails) give decoding error, so skip them
-            except Exception:
-                continue
+        uids = mail_ids[1]  # first element is just the number of mail_ids found
+        while len(uids) != 0:
+            # never fetch more mails than the _queue has room for
+            room = self._wait_for_room()
+            if room == 0:  # Mailbox was stopped while waiting
+                return
+            chunk, uids = (
+                uids[: min(room, self.__fetch_chunk_size)],
+                uids[min(room, self.__fetch_chunk_size) :],
+            )
+            if self.__partial_fetch:
+                mails = self._fetch_text_parts(chunk)
+            else:
+                mails = self._fetch_full_mails(chunk)
+            for mail_details in mails:
+                # tag each mail with where it came from, as the _queue may be shared with other Mailboxes
+                mail_details["account"] = self.__username
+                mail_details["folder"] = self.__folder
+                self._queue.put(mail_details)
+            # the whole chunk has been processed, don't ask for these mails again
+            self._save_sync_state(last_uid=int(chunk[-1]))
+        self.__unexpected_failures = 0
 
-    @staticmethod
-    # searches for new, unseen emails in the INBOX
-    def _fetch_new_mails():
+    # blocks while the _queue is full and returns the number of mails that can be added to it
+    # returns 0 if the Mailbox is stopped in the meantime
+    def _wait_for_room(self):
+        if self.__max_queued is None:
+            return self.__fetch_chunk_size
+        while not self.__stop_refill_thread:
+            with self.__queue_not_full:
+                room = self.__max_queued - self._queue.qsize()
+                if room > 0:
+                    return room
+                # wake up every second to check whether the Mailbox was stopped
+                self.__queue_not_full.wait(timeout=1)
+            # the connection sits unused while we wait
+            self._keep_alive()
+        return 0
+
+    # searches for new, unseen emails in the INBOX, i.e. unseen mails with a UID above the last processed one
+    def _fetch_new_mails(self):
         # we will return this list, containing the number of unseen mails found as first element
-        # and a nested list of ID's of all unseen emails found (if any) as the second element
+        # and a nested list of UID's of all unseen emails found (if any) as the second element
         mail_ids = []
 
         # select a mailbox
-        Inbox._imap.select("INBOX")  # use imap.list() see all the available mailboxes
+        # use imap.list() see all the available mailboxes
+        self._imap.select(self.__folder)
+        # the search below finds every mail the server has counted so far, only the counts reported after it matter to
+        # _idle
+        self._imap.untagged_responses.pop("EXISTS", None)
+        self._imap.untagged_responses.pop("RECENT", None)
+        uidvalidity = self._get_select_response("UIDVALIDITY")
+        highestmodseq = self._get_select_response("HIGHESTMODSEQ")
+
+        state = self.__sync_state
+        if uidvalidity != state["uidvalidity"]:
+            # the UIDs we kept belong to an older incarnation of the mailbox, start over
+            self._save_sync_state(
+                uidvalidity=uidvalidity, last_uid=0, highestmodseq=None
+            )
+        elif highestmodseq is not None and highestmodseq == state["highestmodseq"]:
+            # nothing in the mailbox has changed since the last search
+            mail_ids.append(0)
+            return mail_ids
 
-        # Search for new/unseen emails
-        status, email_ids = Inbox._imap.search(None, "UNSEEN")
+        # Search for new/unseen emails (UIDs, unlike sequence numbers, stay valid if mails are expunged in between fetches)
+        last_uid = state["last_uid"]
+        status, email_ids = self._imap.uid(
+            "search", None, f"UID {last_uid + 1}:*", "UNSEEN"
+        )
         if status == "OK":
-            email_ids = email_ids[0].split()
+            # 'n:*' always matches the last mail of the mailbox, even if its UID is below n
+            email_ids = [uid for uid in email_ids[0].split() if int(uid) > last_uid]
             num_unseen = len(email_ids)
             mail_ids.append(num_unseen)
 
             if (
                 num_unseen == 0
             ):  # return a single element list with only 0 if no unseen mails found
+                # only remember the modseq once everything up to it has been processed
+                self._save_sync_state(highestmodseq=highestmodseq)
                 return mail_ids
 
-            mail_ids.append(email_ids)
+            mail_ids.append(sorted(email_ids, key=int))
             return mail_ids
 
         else:  # if status is not 'OK', return None to signal
             return None
 
+    # returns the value of a response code (like UIDVALIDITY or HIGHESTMODSEQ) sent by the server on the last SELECT, as an int
+    def _get_select_response(self, code):
+        typ, data = self._imap.response(code)
+        if data[-1] is None:
+            return None
+        return int(data[-1])
+
+    # fetches the given UIDs with a single UID FETCH command and returns a list with the raw bytes of each mail
+    def _fetch_mails(self, uids):
+        status, response = self._imap.uid(
+            "fetch", self._to_sequence_set(uids), "(RFC822)"
+        )
+        if status != "OK":
+            return []
+        # each fetched mail comes as a tuple (b'<seq> (UID <uid> RFC822 {<size>}', b'<raw mail>'), followed by a b')'
+        return [part[1] for part in response if isinstance(part, tuple)]
+
+    # downloads the whole of each mail and returns the details of the valid ones
+    def _fetch_full_mails(self, uids):
+        mails = self._parse(_parse_raw_mail, self._fetch_mails(uids))
+        # skip invalid mails with empty body/subject or with scam links
+        return [mail_details for mail_details in mails if mail_details != None]
+
+    # returns the details of the valid mails among the given UIDs, while downloading only what is needed to build them
+    # first the BODYSTRUCTURE and the From/Subject headers of every mail are fetched (one round-trip), then only the
+    # text/plain part of each mail (one round-trip per distinct section, e.g. '1' or '1.1')
+    # mails whose structure couldn't be understood are downloaded whole
+    def _fetch_text_parts(self, uids):
+        status, response = self._imap.uid(
+            "fetch",
+            self._to_sequence_set(uids),
+            "(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM SUBJECT MESSAGE-ID)])",
+        )
+        if status != "OK":
+            return self._fetch_full_mails(uids)
+        headers, sections, fallback_uids = self._sort_text_parts(
+            uids, self._parse_fetch_response(response)
+        )
+
+        # (raw header, raw body, transfer encoding, charset) of each mail
+        text_parts = []
+        for section, parts in sections.items():
+            status, response = self._imap.uid(
+                "fetch",
+                self._to_sequence_set([uid for uid, _, _ in parts]),
+                f"(BODY.PEEK[{section}])",
+            )
+            fetched = self._parse_fetch_response(response) if status == "OK" else {}
+            text_parts += self._text_parts_of(section, parts, headers, fetched)
+
+        # the mails were only peeked at, mark them as seen like a full fetch would have
+        seen_uids = [uid for uid in map(int, uids) if uid not in fallback_uids]
+        if seen_uids:
+            self._imap.uid(
+                "store", self._to_sequence_set(seen_uids), "+FLAGS", "(\\Seen)"
+            )
+
+        mails = self._parse(_parse_text_part, *zip(*text_parts)) if text_parts else []
+        # skip mails with empty subject/body or with scam links
+        valid_mails = [mail_details for mail_details in mails if mail_details != None]
+        if fallback_uids:
+            valid_mails += self._fetch_full_mails(fallback_uids)
+        return valid_mails
+
+    # sorts the mails by the section their text/plain part is in, from the BODYSTRUCTURE and headers fetched for them
+    # returns ({uid: raw header fields}, {section: list of (uid, transfer encoding, charset)}, UIDs of the mails whose
+    # structure couldn't be understood), the mails without a text/plain part are left out (we have nothing to reply to)
+    # shared with AsyncMailbox, like the other static helpers
     @staticmethod
-    # return a dict in the format {'subject':str, 'sender':str, 'body':str} with the email details
-    def _get_mail_details(email_id):
-        details = {"subject": None, "sender": None, "body": None}
-        # fetch the email message by ID
-        res, msg = Inbox._imap.fetch(email_id, "(RFC822)")  # res is unused here
-        for response in msg:
-            if isinstance(response, tuple):
-                # parse a bytes email into a message object
-                msg = email.message_from_bytes(response[1])
-                # decode the email subject
-                subject, encoding = decode_header(msg["Subject"])[0]
-                if isinstance(subject, bytes):
-                    # if it's a bytes, decode to str
-                    subject = subject.decode(encoding)
-                details["subject"] = subject
-
-                # skip mails with empty subject
-                if details["subject"].strip() == "":
-                    return None
-
-                # decode email sender
-                sender, encoding = decode_header(msg.get("From"))[0]
-                if isinstance(sender, bytes):
-                    sender = sender.decode(encoding)
-                details["sender"] = sender
-                # if the email message is multipart
-                if msg.is_multipart():
-                    # iterate over email parts
-                    for part in msg.walk():
-                        # extract content type of email
-                        content_type = part.get_content_type()
-                        try:
-                            # get the email body
-                            body = part.get_payload(decode=True).decode()
-                        except:
-                            pass
-                        if content_type == "text/plain":
-                            details["body"] = body
+    def _sort_text_parts(uids, fetched):
+        headers = {}
+        sections = {}
+        fallback_uids = []
+        for uid in map(int, uids):
+            try:
+                items = fetched[uid]
+                header = next(
+                    value
+                    for key, value in items.items()
+                    if key.startswith("BODY[HEADER")
+                )
+                text_part = Mailbox._find_text_part(items["BODYSTRUCTURE"])
+            except Exception:
+                fallback_uids.append(uid)
+                continue
+            if text_part == None:
+                continue
+            section, encoding, charset = text_part
+            headers[uid] = header
+            sections.setdefault(section, []).append((uid, encoding, charset))
+        return headers, sections, fallback_uids
+
+    # (raw header, raw body, transfer encoding, charset) of each of the parts fetched for a section
+    @staticmethod
+    def _text_parts_of(section, parts, headers, fetched):
+        text_parts = []
+        for uid, encoding, charset in parts:
+            body = fetched.get(uid, {}).get(f"BODY[{section}]")
+            if body != None:
+                text_parts.append((headers[uid], body, encoding, charset))
+        return text_parts
+
+    # runs func over the given fetched data, in the parse executor's worker processes if there is one
+    # so that the refill thread only waits on the network (and on the workers) instead of doing MIME parsing itself
+    def _parse(self, func, *iterables):
+        if self.__parse_executor is None:
+            return list(map(func, *iterables))
+        return list(self.__parse_executor.map(func, *iterables))
+
+    @staticmethod
+    # returns (section, transfer encoding, charset) of the first text/plain part in a parsed BODYSTRUCTURE
+    # that is not an attachment, or None if the mail has no such part
+    def _find_text_part(structure, section=""):
+        # multipart bodies start with the list of their sub-parts, which are numbered from 1
+        if isinstance(structure[0], list):
+            for i, part in enumerate(structure):
+                if not isinstance(part, list):
+                    break
+                text_part = Mailbox._find_text_part(
+                    part, f"{section}.{i + 1}" if section else str(i + 1)
+                )
+                if text_part != None:
+                    return text_part
+            return None
+
+        # body type, subtype, parameters, id, description, encoding, size, lines, md5, disposition, ...
+        if structure[0].lower() != "text" or structure[1].lower() != "plain":
+            return None
+        if (
+            len(structure) > 9
+            and isinstance(structure[9], list)
+            and structure[9][0].lower() == "attachment"
+        ):
+            return None
+        params = structure[2] or []
+        params = {
+            params[i].lower(): params[i + 1] for i in range(0, len(params) - 1, 2)
+        }
+        # a single part mail has its body in section 1
+        return section or "1", (structure[5] or "7bit").lower(), params.get("charset")
+
+    @staticmethod
+    # undoes the content transfer encoding of a body part and decodes it to str
+    def _decode_body(body, encoding, charset):
+        if encoding == "base64":
+            body = base64.b64decode(body)
+        elif encoding == "quoted-printable":
+            body = quopri.decodestring(body)
+        return body.decode(charset or "utf-8")
+
+    @staticmethod
+    # parses the response of a UID FETCH command into a dict {uid: {item name: value}}
+    # lists become python lists, strings become str, literals stay bytes and NIL becomes None
+    def _parse_fetch_response(response):
+        tokens = []
+        for line in response:
+            if isinstance(
+                line, tuple
+            ):  # a line ending in a literal, followed by the literal's bytes
+                line, literal = line
+            else:
+                literal = None
+            for match in _FETCH_TOKEN.finditer(line):
+                if match.group("literal") != None:
+                    tokens.append(("literal", literal))
+                elif match.group("quoted") != None:
+                    tokens.append(("string", match.group("quoted")))
                 else:
-                    # extract content type of email
-                    content_type = msg.get_content_type()
+                    tokens.append(
+                        ("token", match.group("paren") or match.group("atom"))
+                    )
+
+        def parse(pos):
+            kind, value = tokens[pos]
+            if kind == "literal":
+                return value, pos + 1
+            if kind == "string":
+                return (
+                    re.sub(rb"\\(.)", rb"\1", value).decode("utf-8", "replace"),
+                    pos + 1,
+                )
+            if value == b"(":
+                items = []
+                pos += 1
+                while tokens[pos] != ("token", b")"):
+                    item, pos = parse(pos)
+                    items.append(item)
+                return items, pos + 1
+            value = value.decode("utf-8", "replace")
+            return (None if value.upper() == "NIL" else value), pos + 1
+
+        fetched = {}
+        pos = 0
+        while pos < len(tokens):
+            # every mail comes as '<seq> (<name> <value> <name> <value> ...)'
+            _, pos = parse(pos)
+            items, pos = parse(pos)
+            items = {
+                items[i].upper(): items[i + 1] for i in range(0, len(items) - 1, 2)
+            }
+            fetched[int(items["UID"])] = items
+        return fetched
+
+    @staticmethod
+    # collapses a list of UIDs into an IMAP sequence set, e.g. [1, 2, 3, 7, 9, 10] -> '1:3,7,9:10'
+    def _to_sequence_set(uids):
+        uids = sorted(int(uid) for uid in uids)
+        ranges = []
+        start = prev = uids[0]
+        for uid in uids[1:] + [None]:
+            if uid is not None and uid == prev + 1:
+                prev = uid
+                continue
+            ranges.append(str(start) if start == prev else f"{start}:{prev}")
+            start = prev = uid
+        return ",".join(ranges)
+
+    @staticmethod
+    # return a dict in the format {'subject':str, 'sender':str, 'body':str} with the email details
+    def _get_mail_details(raw_mail):
+        # parse a bytes email into a message object
+        msg = email.message_from_bytes(raw_mail)
+        details = Mailbox._get_header_details(msg)
+        # skip mails with empty subject
+        if details == None:
+            return None
+        # if the email message is multipart
+        if msg.is_multipart():
+            # iterate over email parts
+            for part in msg.walk():
+                # extract content type of email
+                content_type = part.get_content_type()
+                try:
                     # get the email body
-                    body = msg.get_payload(decode=True).decode()
-                    if content_type == "text/plain":
-                        details["body"] = body
+                    body = part.get_payload(decode=True).decode()
+                except:
+                    pass
+                if content_type == "text/plain":
+                    details["body"] = body
+        else:
+            # extract content type of email
+            content_type = msg.get_content_type()
+            # get the email body
+            body = msg.get_payload(decode=True).decode()
+            if content_type == "text/plain":
+                details["body"] = body
 
         # skip mails with empty body or with scam links
-        if (
+        if not Mailbox._has_valid_body(details):
+            return None
+
+        return details
+
+    @staticmethod
+    # return a dict in the format {'subject':str, 'sender':str, 'body':None} with the decoded subject and sender of a message
+    # returns None for mails with an empty subject
+    def _get_header_details(msg):
+        details = {"subject": None, "sender": None, "body": None}
+        # decode the email subject
+        subject, encoding = decode_header(msg["Subject"])[0]
+        if isinstance(subject, bytes):
+            # if it's a bytes, decode to str
+            subject = subject.decode(encoding)
+        details["subject"] = subject
+
+        # skip mails with empty subject
+        if details["subject"].strip() == "":
+            return None
+
+        # decode email sender
+        sender, encoding = decode_header(msg.get("From"))[0]
+        if isinstance(sender, bytes):
+            sender = sender.decode(encoding)
+        details["sender"] = sender
+        return details
+
+    @staticmethod
+    # checks that the body is not empty and has no (scam) links
+    def _has_valid_body(details):
+        return not (
             details["body"].strip() == ""
             or "http" in details["body"]
             or "https" in details["body"]
-        ):
+        )
+
+    # returns the next mail in the _queue, or None if no mail arrives within timeout seconds
+    # timeout=0 returns immediately and timeout=None waits until there is a mail
+    def pop(self, timeout=0):
+        try:
+            mail = self._queue.get(block=timeout != 0, timeout=timeout)
+        except Empty:
             return None
+        self._notify_room()
+        return mail
 
-        return details
+    # lets the refill thread know that there is room in the _queue again
+    def _notify_room(self):
+        with self.__queue_not_full:
+            self.__queue_not_full.notify()
 
-    @staticmethod
-    def pop():
-        if Inbox._queue.empty():
+    def size(self):
+        return self._queue.qsize()
+
+
+# the UID high-water mark of a folder, as kept in the state file of a Mailbox or an AsyncMailbox (None keeps it in memory
+# only), so either can resume from the other's state
+def _read_sync_state(state_file):
+    state = {"uidvalidity": None, "last_uid": 0, "highestmodseq": None}
+    if state_file is None or not os.path.exists(state_file):
+        return state
+    try:
+        with open(state_file, "r") as file:
+            state.update(json.load(file))
+    # unreadable/corrupted state file, start from scratch
+    except (OSError, ValueError):
+        pass
+    return state
+
+
+def _write_sync_state(state_file, state):
+    if state_file is None:
+        return
+    # write to a temporary file first, so that a crash mid-write can't leave a corrupted state file behind
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, "w") as file:
+        json.dump(state, file)
+    os.replace(tmp_file, state_file)
+
+
+# the parsing done for the refill thread, kept at module level so that they can be sent to worker processes
+# both return a dict in the format {'subject':str, 'sender':str, 'body':str}, or None for invalid mails
+def _parse_raw_mail(raw_mail):
+    try:
+        return Mailbox._get_mail_details(raw_mail)
+    # mails with pictures, graphics (auto-generated / marketing mails) give decoding error, so skip them
+    except Exception:
+        return None
+
+
+def _parse_text_part(header, body, encoding, charset):
+    try:
+        mail_details = Mailbox._get_header_details(email.message_from_bytes(header))
+        # skip mails with empty subject
+        if mail_details == None:
             return None
-        return Inbox._queue.get()
+        mail_details["body"] = Mailbox._decode_body(body, encoding, charset)
+        # skip mails with empty body or with scam links
+        if not Mailbox._has_valid_body(mail_details):
+            return None
+        return mail_details
+    except Exception:
+        return None
+
+
+# watches the INBOX of a single account, through a default Mailbox
+# kept so that the bot (and anything else using the static Inbox API) doesn't have to create Mailboxes itself
+class Inbox:
+    _default = Mailbox()
+
+    @staticmethod
+    def start(refill_interval, username, password, **options):
+        options.setdefault("state_file", "inbox_state.json")
+        Inbox._default.start(refill_interval, username, password, **options)
+
+    @staticmethod
+    def stop():
+        Inbox._default.stop()
+
+    @staticmethod
+    def logged_in():
+        return Inbox._default.logged_in()
+
+    @staticmethod
+    def alive():
+        return Inbox._default.alive()
+
+    @staticmethod
+    def idling():
+        return Inbox._default.idling()
+
+    @staticmethod
+    def connection_stats():
+        return Inbox._default.connection_stats()
+
+    @staticmethod
+    def pop(timeout=0):
+        return Inbox._default.pop(timeout)
 
     @staticmethod
     def size():
-        return Inbox._queue.qsize()
+        return Inbox._default.size()
+
+
+# watches several accounts/folders at once, each on its own connection (Mailbox), and merges their mails into one _queue
+# each mail popped from the pool has 'account' and 'folder' keys telling where it came from
+class InboxPool:
+    def __init__(self):
+        self._queue = Queue()
+        self.__mailboxes = []
+        self.__parse_executor = None
+
+    def mailboxes(self):
+        return list(self.__mailboxes)
+
+    # accounts is a list of dicts with keys 'email', 'password' and optionally 'folder' (defaults to 'INBOX')
+    # options are passed on to Mailbox.start(), state_file (if given) is used as a prefix for a state file per mailbox
+    # parse_workers > 0 starts one pool of worker processes that parses the mails of all the mailboxes
+    def start(
+        self, refill_interval, accounts, state_file=None, parse_workers=0, **options
+    ):
+        if not isinstance(accounts, list) or len(accounts) == 0:
+            raise TypeError(
+                "start() method argument 'accounts' must be a non-empty 'list' of 'dict'"
+            )
+        for account in accounts:
+            if not isinstance(account, dict) or not (
+                "email" in account and "password" in account
+            ):
+                raise TypeError(
+                    "every account must be of type 'dict' with keys 'email' and 'password'"
+                )
+        if parse_workers > 0:
+            self.__parse_executor = ProcessPoolExecutor(
+                max_workers=parse_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        for account in accounts:
+            folder = account.get("folder", "INBOX")
+            mailbox = Mailbox(folder=folder, queue=self._queue)
+            mailbox_state_file = None
+            if state_file is not None:
+                stem, extension = os.path.splitext(state_file)
+                mailbox_state_file = f"{stem}_{account['email']}_{folder}{extension}"
+            try:
+                mailbox.start(
+                    refill_interval,
+                    account["email"],
+                    account["password"],
+                    state_file=mailbox_state_file,
+                    parse_executor=self.__parse_executor,
+                    **options,
+                )
+            except ImapError:
+                # don't leave the mailboxes that did start running in the background
+                self.stop()
+                raise
+            self.__mailboxes.append(mailbox)
+
+    def stop(self):
+        for mailbox in self.__mailboxes:
+            if mailbox.logged_in():
+                mailbox.stop()
+        self.__mailboxes = []
+        if self.__parse_executor is not None:
+            self.__parse_executor.shutdown()
+            self.__parse_executor = None
+
+    def logged_in(self):
+        return any(mailbox.logged_in() for mailbox in self.__mailboxes)
+
+    # whether every mailbox is alive (see Mailbox.alive())
+    def alive(self):
+        return len(self.__mailboxes) != 0 and all(
+            mailbox.alive() for mailbox in self.__mailboxes
+        )
+
+    # returns the connection_stats() of every mailbox, keyed by (account, folder)
+    def connection_stats(self):
+        return {
+            (mailbox.account(), mailbox.folder()): mailbox.connection_stats()
+            for mailbox in self.__mailboxes
+        }
+
+    # same as Mailbox.pop(), but takes the next mail of any of the mailboxes
+    def pop(self, timeout=0):
+        try:
+            mail = self._queue.get(block=timeout != 0, timeout=timeout)
+        except Empty:
+            return None
+        for mailbox in self.__mailboxes:
+            mailbox._notify_room()
+        return mail
+
+    def size(self):
+        return self._queue.qsize()
 
 
 class ImapError(RuntimeError):
@@ -4,13 +4,44 @@ from outbox import Outbox
 import outbox
 import gpt_scraper
 import time
+import threading
+import os
 import re
 import sys
 import csv
 from datetime import datetime
 import spam_detection
+from pipeline import Pipeline
+from reply_cache import ReplyCache
+from near_duplicates import NearDuplicateIndex
+from prompt_compactor import PromptCompactor
+from query_scheduler import QueryScheduler
+from supervisor import Supervisor
+from reply_backends import ScraperBackend, HttpChatBackend, ChatGPTPool
 
 responseBot = None
+# what answers the mails: "scraper" drives ChatGPT's website in Chrome, "http" talks to a chat completions API (its
+# key is read from the 'openai_api_key' column of credentials.csv), "pool" drives several ChatGPT sessions at once
+REPLY_BACKEND = "scraper"
+HTTP_BACKEND_OPTIONS = {
+    "base_url": "https://api.openai.com/v1",
+    "model": "gpt-3.5-turbo",
+    "max_concurrency": 4,  # queries answered at the same time
+    "stream": True,
+    "timeout": 60,
+    "query_quota": None,  # (queries, per seconds) to pace the queries under, None sends them as they come
+    "limit_cooldown": 60,  # seconds the queries are held back for after a 429
+}
+# the "pool" backend logs in to every account in POOL_ACCOUNTS_FILE (columns: email, password), or to the account of
+# credentials.csv if there is no such file
+POOL_ACCOUNTS_FILE = "openai_accounts.csv"
+POOL_OPTIONS = {
+    "sessions_per_account": 1,  # more than 1 makes ChatGPT complain about multiple prompts
+    "limit_cooldown": 30 * 60,
+    "busy_cooldown": 5 * 60,
+}
+# held while the responseBot is queried or swapped for a new one
+bot_lock = threading.Lock()
 credentials = {}
 
 
@@ -25,21 +56,50 @@ def read_credentials():
 # prepares the responseBot so that it is ready to take queries
 def set_bot():
     global responseBot
-    responseBot = gpt_scraper.ChatGPT(
-        hidden=True
-    )  # set hidden to True to run chromeDriver in headless mode
-
-    # login to ChatGPT
-    my_openai_credentails = {
-        "email": credentials["openai_email"],
-        "password": credentials["openai_password"],
-    }
-    responseBot.set_credentials(
-        my_openai_credentails["email"], my_openai_credentails["password"]
-    )
+    responseBot = new_bot()
+
+
+# swaps the responseBot for a new one, the old one keeps answering until the new one has logged in (and the query it is
+# working on is done), so no query has to wait for the browser to start
+def refresh_bot():
+    global responseBot
+    bot = new_bot()
+    with bot_lock:
+        old_bot, responseBot = responseBot, bot
+    if old_bot != None and old_bot.logged_in():
+        try:
+            old_bot.logout(clear_chats=True)
+        except TimeoutError:  # error clearing chats, rest is fine
+            pass
+
+
+# starts a new session with the REPLY_BACKEND and logs in
+def new_bot():
+    if REPLY_BACKEND == "http":
+        bot = HttpChatBackend(
+            api_key=credentials.get("openai_api_key"), **HTTP_BACKEND_OPTIONS
+        )
+    elif REPLY_BACKEND == "pool":
+        bot = ChatGPTPool(read_pool_accounts(), hidden=True, **POOL_OPTIONS)
+    elif REPLY_BACKEND == "scraper":
+        bot = ScraperBackend(
+            hidden=True
+        )  # set hidden to True to run chromeDriver in headless mode
+    else:
+        raise RuntimeError(f"Unknown reply backend '{REPLY_BACKEND}'")
+
+    # login to ChatGPT (the "http" backend only needs its API key, the "pool" reads its accounts in read_pool_accounts())
+    if REPLY_BACKEND == "scraper":
+        my_openai_credentails = {
+            "email": credentials["openai_email"],
+            "password": credentials["openai_password"],
+        }
+        bot.set_credentials(
+            my_openai_credentails["email"], my_openai_credentails["password"]
+        )
     try:
-        responseBot.login()
-        return
+        bot.login()
+        return bot
     except TimeoutError as e:  # if a button/web-element was not found, try again
         raise RuntimeError(e)
     except (
@@ -48,6 +108,22 @@ def set_bot():
         raise RuntimeError(e)
 
 
+# the accounts of the "pool" backend
+def read_pool_accounts():
+    if not os.path.exists(POOL_ACCOUNTS_FILE):
+        return [
+            {
+                "email": credentials["openai_email"],
+                "password": credentials["openai_password"],
+            }
+        ]
+    with open(POOL_ACCOUNTS_FILE, "r") as file:
+        return [
+            {"email": row["email"], "password": row["password"]}
+            for row in csv.DictReader(file)
+        ]
+
+
 # used to logout from the chatGPT website
 def bot_logout():
     global responseBot
@@ -60,6 +136,11 @@ def bot_logout():
 
 # sets INBOX and OUTBOX
 def set_mail_boxes():
+    set_inbox()
+    set_outbox()
+
+
+def set_inbox():
     my_gmail_credentials = {
         "email": credentials["gmail"],
         "password": credentials["gmail_password"],
@@ -67,28 +148,119 @@ def set_mail_boxes():
     # set up the INBOX
     try:
         # refill_interval is used to set the loop interval after which the Inbox refills itself with new mails
+        # idle=True lets gmail push new mails to us instead (refill_interval is then only used if IDLE is not supported)
         Inbox.start(
             refill_interval=30,
             username=my_gmail_credentials["email"],
             password=my_gmail_credentials["password"],
+            idle=True,
+            fetch_chunk_size=100,  # number of mails fetched per round-trip when draining a backlog
+            state_file="inbox_state.json",  # lets the Inbox resume from the last processed mail after a restart
+            partial_fetch=True,  # download only the text part of mails (skips attachments)
+            max_queued=20,  # mails beyond this stay on the server until the bot catches up
+            parse_workers=0,  # > 0 parses mails in that many separate processes (helps with big backlogs)
         )
     except inbox.ImapError as e:
         raise RuntimeError(e)  # bot cannot run if we can't login to IMAP
 
+
+def set_outbox():
+    my_gmail_credentials = {
+        "email": credentials["gmail"],
+        "password": credentials["gmail_password"],
+    }
     # set up the OUTBOX
     # no need to catch any exception here
     # 'flush_interval' is used to set the interval after which the Outbox flushes/sends the mails inside of it
     # However, if the Outbox reaches 'max_queue_size', it flushes the mails out even though the flush_interval is not reached
+    # 'max_latency' makes sure that a reply never waits longer than that in the Outbox, however few replies there are
     Outbox.start(
-        flush_interval=30, max_queue_size=5, sender_credentials=my_gmail_credentials
+        flush_interval=30,
+        max_queue_size=5,
+        sender_credentials=my_gmail_credentials,
+        max_latency=5,
+        spool_file="outbox_spool.db",  # replies not sent yet survive a restart/crash and are sent by the next start()
+        sender_workers=4,
+        # stay under Gmail's sending limits, however many replies pile up
+        rate_limit=(20, 60),
+        domain_rate_limit=(10, 60),
+        log_file="mail_logs.db",  # every reply sent, see Outbox.sent_mails()
+        log_retention_days=90,
+        # replies that can't be sent are retried with a growing delay, after 'max_attempts' they are kept as dead letters
+        # (Outbox.dead_letters()) instead of being dropped, a failing SMTP login doesn't stop the bot anymore
+        max_attempts=5,
     )
 
 
-# this functin runs the whole script
+# number of worker threads of each stage of the pipeline run() builds, 'generate' must stay at 1 (queries are sent one
+# at a time, a backend that answers several at once, like the pool, gets them all through query_many())
+STAGE_WORKERS = {
+    "ingest": 1,
+    "filter": 2,
+    "compact": 1,
+    "prompt": 1,
+    "generate": 1,
+    "parse": 1,
+    "deliver": 1,
+}
+PIPELINE_QUEUE_SIZE = 10  # mails each stage can hold waiting for a worker
+
+pipeline = None  # the pipeline of the current run(), see pipeline_stats()
+# responses of the bot to recent mails, a repeated mail is answered from here instead of querying the bot again
+# kept across runs, and saved to disk so that it survives a restart too
+reply_cache = None
+# responses of the bot to recent mails, a mail nearly the same as one of them (e.g. the same inquiry from someone else)
+# is answered with that response, adapted to the new mail, kept across runs
+near_duplicates = None
+# max number of bits the SimHashes of two mail bodies can differ in, for the mails to count as near-duplicates
+NEAR_DUPLICATE_DISTANCE = 6
+
+# the 'generate' stage asks the bot to answer up to BATCH_SIZE mails in one prompt (each query takes a while and
+# counts towards ChatGPT's hourly limit), waiting at most BATCH_WAIT seconds for a batch to fill up, 1 turns it off
+BATCH_SIZE = 4
+BATCH_WAIT = 2
+# appended to the base prompt in batch mode, ChatGPT gets the prompt on a single line, so the delimiters must not rely
+# on line breaks
+BATCH_INSTRUCTIONS = (
+    " This time I'm giving you {count} mails, each one starts with [[MAIL n]] and ends with [[END MAIL n]], n being"
+    " its number. Answer every one of them separately, start each reply with [[REPLY n]], n being the number of the"
+    " mail it answers, and end it with [[END REPLY n]], and use the Subject/Body format in every reply. Here are the"
+    " mails - "
+)
+batch_counts = {"batches": 0, "batched_mails": 0, "fallbacks": 0}
+
+# how many times a mail is sent back to the bot because its response had no Subject/Body that could be made out,
+# after that the mail is skipped
+MAX_REQUERIES = 2
+# responses parsed as they were (strict), parsed after fixing up their format (recovered), not parsable (failed), and
+# mails sent back to the bot (requeried) or skipped (given_up) because of that
+parse_counts = {"strict": 0, "recovered": 0, "failed": 0, "requeried": 0, "given_up": 0}
+
+# max (estimated) number of tokens of a prompt, longer mails are cut to fit, and a batch holds only as many mails as fit
+PROMPT_TOKEN_BUDGET = 3000
+compactor = None  # strips quoted history, signatures and footers off the mails before they are put in a prompt
+
+# paces the queries under the reply backend's message cap (its query_quota) and holds them back for its limit_cooldown
+# when the cap is hit anyway, see query_stats()
+scheduler = None
+
+# the browser session is recycled this often (seconds), while the Inbox and the Outbox keep working, the mail boxes are
+# only refreshed when they stop working (they reconnect by themselves otherwise)
+BOT_REFRESH_INTERVAL = 3 * 60 * 60
+SUPERVISOR_CHECK_INTERVAL = 30  # seconds between two health checks of the bot's parts
+# refreshes the parts of the bot of the current run(), see supervisor_stats()
+supervisor = None
+
+
+# this functin runs the whole script, for RUNTIME seconds (None runs it until an error it can't recover from)
 def run(RUNTIME=(6 * 60 * 60)):
     # * first we set the bot and the mail boes
+    # * a supervisor keeps them fresh, each one on its own (the browser is recycled every few hours, a mail box that stopped
+    #   working is started again), without stopping the others, so the mails keep being answered meanwhile
     # * INBOX is running on another thread of the CPU and is continously checking for any new mails, which if found are added to its queue
-    # * Now we will dequeue these mails one by one from the INBOX, send a query to the bot, get the reponse, format it and then enqueue it to the OUTBOX's queue. This all is happening in the main thread
+    # * Now the mails go through a pipeline of stages, each running on its own threads: the mails are dequeued from the INBOX (ingest),
+    #   spam is skipped (filter), quotes/signatures are stripped (compact), the prompt is built (prompt), the bot is queried (generate),
+    #   the reply is taken out of its response (parse) and enqueued to the OUTBOX's queue (deliver). While the bot is answering one mail, the next ones are already being filtered
     # * Similar to the INBOX, the OUTBOX is also working on its own thread. It constantly checks its queue for any mails, and periodicly flushes them out to the respective receivers
 
     try:
@@ -101,133 +273,460 @@ def run(RUNTIME=(6 * 60 * 60)):
     with open("base_prompt.txt", "r") as file:
         base_prompt = file.read()
 
-    global responseBot
+    global pipeline, reply_cache, near_duplicates, compactor, scheduler, supervisor
     spam_filter = spam_detection.Spam_Detection_Model()
+    if reply_cache == None:
+        reply_cache = ReplyCache(
+            max_entries=1000, ttl=24 * 60 * 60, path="reply_cache.json"
+        )
+    # a scheduler of an earlier run is kept as long as the quota is the same, the queries it let through still count
+    if scheduler == None or scheduler.quota() != responseBot.query_quota:
+        quota, window = responseBot.query_quota or (None, None)
+        scheduler = QueryScheduler(quota=quota, window=window)
+    if compactor == None:
+        compactor = PromptCompactor(token_budget=PROMPT_TOKEN_BUDGET)
+    if near_duplicates == None:
+        near_duplicates = NearDuplicateIndex(
+            max_distance=NEAR_DUPLICATE_DISTANCE, max_entries=1000
+        )
 
-    # we will continue to check for new mails until RUNTIME
-    start_time = time.time()
-    while time.time() - start_time < RUNTIME:
-        # if unable to login to Outbox (needs to be catched here via a flag beacuse this exception occurs in the flush_thread)
+    pipeline = Pipeline(queue_size=PIPELINE_QUEUE_SIZE)
+    pipeline.set_source("ingest", ingest_mail, STAGE_WORKERS["ingest"])
+    pipeline.add_stage(
+        "filter", lambda item: filter_mail(item, spam_filter), STAGE_WORKERS["filter"]
+    )
+    pipeline.add_stage(
+        "compact",
+        lambda item: compact_mail(item, base_prompt),
+        STAGE_WORKERS["compact"],
+    )
+    pipeline.add_stage(
+        "prompt", lambda item: build_prompt(item, base_prompt), STAGE_WORKERS["prompt"]
+    )
+    if BATCH_SIZE > 1:
+        pipeline.add_stage(
+            "generate",
+            lambda items: generate_replies(items, base_prompt),
+            STAGE_WORKERS["generate"],
+            batch_size=BATCH_SIZE,
+            batch_wait=BATCH_WAIT,
+        )
+    else:
+        pipeline.add_stage("generate", generate_reply, STAGE_WORKERS["generate"])
+    pipeline.add_stage("parse", parse_reply, STAGE_WORKERS["parse"])
+    pipeline.add_stage("deliver", deliver_reply, STAGE_WORKERS["deliver"])
+    pipeline.start()
+
+    supervisor = Supervisor(check_interval=SUPERVISOR_CHECK_INTERVAL)
+    supervisor.add_component(
+        "bot",
+        refresh_bot,
+        healthy=lambda: responseBot.logged_in(),
+        max_age=BOT_REFRESH_INTERVAL,
+    )
+    supervisor.add_component("inbox", refresh_inbox, healthy=Inbox.alive)
+    supervisor.add_component("outbox", refresh_outbox, healthy=Outbox.alive)
+    supervisor.start()
+
+    # we will continue to process new mails until RUNTIME, unless a stage runs into an error the bot can't recover from, or
+    # a part of the bot can't be refreshed
+    deadline = None if RUNTIME == None else time.time() + RUNTIME
+    smtp_error = None
+    while not supervisor.wait(timeout=0):
+        # the Outbox keeps retrying on its own threads, but a login the SMTP server keeps refusing won't get anywhere
         if Outbox.smtp_error_occurred():
-            # shutdown('Outbox - SMTP error occured')
-            raise RuntimeError("Outbox - SMTP error occured")
+            smtp_error = RuntimeError("Outbox - SMTP login keeps being refused")
+            break
+        timeout = 1 if deadline == None else min(max(deadline - time.time(), 0), 1)
+        if pipeline.wait(timeout=timeout):
+            break
+        if deadline != None and time.time() >= deadline:
+            break
+    supervisor.stop()
+    # let the mails already taken from the Inbox get their replies (if the pipeline failed, it just stops)
+    pipeline.stop()
+    reply_cache.save()
+    if pipeline.error() != None:
+        raise pipeline.error()
+    if supervisor.error() != None:
+        raise supervisor.error()
+    if smtp_error != None:
+        raise smtp_error
+
+
+# starts the Inbox again, the Outbox keeps sending meanwhile
+def refresh_inbox():
+    if Inbox.logged_in():
+        Inbox.stop()
+    set_inbox()
 
-        # get mail from Inbox
-        mail = Inbox.pop()
-        if mail == None:  # if Inbox is empty
-            time.sleep(2)
-            continue
-        if credentials["gmail"] in mail["sender"]:  # don't reply to your own emails
-            continue
 
-        # pass the mail through spam filter
-        if spam_filter.classify(mail["subject"]) == "spam":
-            # print('spam skipped')
-            continue
+# starts the Outbox again (replies it didn't send yet are kept in its spool), the Inbox keeps polling meanwhile
+def refresh_outbox():
+    if Outbox.is_working():
+        Outbox.stop()
+    set_outbox()
 
-        # prepare prompt
-        mail_body = f'From: {mail["sender"]}\n'
-        mail_body += f'Subject: {mail["subject"]}\n'
-        mail_body += mail["body"]
-
-        prompt = base_prompt + mail_body
-
-        # keep querying until the reply is given in proper format
-        while True:
-            # try to get a response from the bot, shutdown if no reponse was given after 5 tries
-            response = ""
-            for _ in range(5):
-                error = ""
-                try:
-                    # ask query to ChatGPT
-                    response = responseBot.query(prompt)
-                    break
-
-                except (
-                    gpt_scraper.HourlyLimitReachedError
-                ) as e:  # freeze the whole bot for half an hour, restart the bot and then try again. If still gives error, shutdown
-                    error = e
-                    freeze(30 * 60)  # 30 mins
-                    try:
-                        set_bot()
-                        set_mail_boxes()
-                        continue
-                    except RuntimeError as e:
-                        raise e
-                except (
-                    gpt_scraper.PromptTooLongError
-                ):  # if prompt is too long, then skip this prompt/mail (though you need to logout of gpt and relogin first)
-                    try:
-                        bot_logout()
-                        set_bot()
-                        break  # gets the next mail
-                    except RuntimeError as e:
-                        raise e
-                except (
-                    gpt_scraper.MultiplePromptsError
-                ) as e:  # if someone else is using your chatGPT account, logout, sleep for 5 mins, relogin and try again (max 5 times)
-                    error = e
-                    try:
-                        bot_logout()
-                        time.sleep(5 * 60)
-                        set_bot()
-                        continue
-                    except RuntimeError as e:
-                        raise e
-                except (
-                    TimeoutError
-                ) as e:  # if a button/web-element was not found, try again
-                    error = e
-                    time.sleep(1)
-                    continue
-                except RuntimeError as e:  # if some unkown error occurs, shutdowm
-                    raise e
-
-            # if couldn't get a response even after trying 5 times, raise Runtime error
-            if error != "":
-                raise RuntimeError(error)
-
-            # this handles the break from PromptTooLongError (because it doen't changes str 'error', so we catch it by looking at response)
-            if response == "":
-                break
-
-            # Extracting subject from the response
-            subject_match = re.search(r"Subject:(.+)", response)
-            reply_subject = subject_match.group(1) if subject_match else ""
-
-            # Extracting body from the response
-            body_match = re.search(r"Body:(.+)", response, re.DOTALL)
-            reply_body = body_match.group(1) if body_match else ""
-
-            # continue asking chatgpt for a response, until it gives one in the proper format
-            if reply_subject == "" or reply_body == "":
-                continue
 
-            # prepare and send the reply to the original sender
-            reply_mail = {
-                "to": mail["sender"],
-                "subject": reply_subject,
-                "body": reply_body,
-            }
-            Outbox.push(reply_mail)
-            break  # gets the next mail
+# age, refreshes and failed refreshes of every part of the bot
+def supervisor_stats():
+    return supervisor.stats() if supervisor != None else {}
 
 
-# logs out of all the places and then freezes the bot for the time specified - used for restart
-def freeze(sleep_time):
-    global responseBot
+# queue depth, worker usage and timing of every stage of the running pipeline
+def pipeline_stats():
+    return pipeline.stats() if pipeline != None else {}
 
-    if Inbox.logged_in():
-        Inbox.stop()
-    if Outbox.is_working():
-        Outbox.stop()
-    if responseBot.logged_in():
+
+# hits and misses of the reply cache
+def reply_cache_stats():
+    return reply_cache.stats() if reply_cache != None else {}
+
+
+# hits and misses of the near-duplicate index, and the near-duplicates whose response couldn't be adapted safely
+def near_duplicate_stats():
+    return near_duplicates.stats() if near_duplicates != None else {}
+
+
+# queries sent in the current window of the message cap, and the predicted time until the next one can be sent
+def query_stats():
+    return scheduler.stats() if scheduler != None else {}
+
+
+# per session utilization of the reply backend (if it keeps any numbers, like the pool does)
+def backend_stats():
+    return responseBot.stats() if responseBot != None else {}
+
+
+# prompt size before and after the compaction (characters and estimated tokens)
+def prompt_stats():
+    return compactor.stats() if compactor != None else {}
+
+
+# batches sent to the bot, mails answered in them, and mails that had to be asked for one at a time after a batch
+def batch_stats():
+    return dict(batch_counts)
+
+
+# how the bot's responses were parsed, and the share of badly formatted ones that were recovered without asking again
+def parse_stats():
+    stats = dict(parse_counts)
+    malformed = stats["recovered"] + stats["failed"]
+    stats["recovery_rate"] = stats["recovered"] / malformed if malformed != 0 else 0.0
+    return stats
+
+
+# the stages of the pipeline, each one gets a dict {'mail': mail dict} and fills it up on the way to the Outbox
+
+
+# gets a mail from the Inbox (waits for one to arrive, but not for too long, so that the pipeline can be stopped)
+def ingest_mail():
+    mail = Inbox.pop(timeout=1)
+    if mail == None:  # if Inbox is empty
+        return None
+    return {"mail": mail}
+
+
+def filter_mail(item, spam_filter):
+    mail = item["mail"]
+    if credentials["gmail"] in mail["sender"]:  # don't reply to your own emails
+        return None
+
+    # pass the mail through spam filter
+    if spam_filter.classify(mail["subject"]) == "spam":
+        # print('spam skipped')
+        return None
+    return item
+
+
+# drops the quoted history, signature and footers of the mail and cuts it to fit in PROMPT_TOKEN_BUDGET
+def compact_mail(item, base_prompt):
+    mail = item["mail"]
+    headers = f'From: {mail["sender"]}\n'
+    headers += f'Subject: {mail["subject"]}\n'
+
+    item["mail_text"] = compactor.compact(base_prompt, headers, mail["body"])
+    return item
+
+
+def build_prompt(item, base_prompt):
+    item["prompt"] = base_prompt + item["mail_text"]
+    return item
+
+
+# answers the mails that can be answered from the reply cache/near-duplicate index, the rest are put in one prompt, the
+# mails that the bot's response has no proper reply for, that don't fit in the budget and that were sent back by 'parse'
+# are asked for one at a time
+def generate_replies(items, base_prompt):
+    pending = [item for item in items if not reuse_reply(item)]
+    if responseBot.max_concurrency > 1 and len(pending) > 1:
+        return query_concurrently(items, pending)
+    # the others were answered already, they are passed through as they are
+    pending_ids = {id(item) for item in pending}
+    # as many mails as fit in the token budget, the others are asked for one at a time
+    batch = []
+    tokens = compactor.estimate_tokens(base_prompt + BATCH_INSTRUCTIONS)
+    for item in pending:
+        mail_tokens = compactor.estimate_tokens(
+            f"[[MAIL 0]] {item['mail_text']} [[END MAIL 0]] "
+        )
+        if (
+            not item.get("requery", False)
+            and tokens + mail_tokens <= PROMPT_TOKEN_BUDGET
+        ):
+            batch.append(item)
+            tokens += mail_tokens
+    if len(batch) < 2:
+        return [
+            generate_reply(item, reuse=False) if id(item) in pending_ids else item
+            for item in items
+        ]
+
+    prompt = base_prompt + BATCH_INSTRUCTIONS.format(count=len(batch))
+    for number, item in enumerate(batch, start=1):
+        prompt += f"[[MAIL {number}]] {item['mail_text']} [[END MAIL {number}]] "
+    response = query_bot(prompt)
+    batch_counts["batches"] += 1
+
+    # the text after every [[REPLY n]] marker, up to its end marker or the next reply
+    replies = {}
+    for match in re.finditer(
+        r"\[\[REPLY (\d+)\]\](.*?)(?=\[\[END REPLY \d+\]\]|\[\[REPLY \d+\]\]|\Z)",
+        response,
+        re.DOTALL,
+    ):
+        replies.setdefault(int(match.group(1)), match.group(2).strip())
+
+    numbers = {id(item): number for number, item in enumerate(batch, start=1)}
+    results = []
+    for item in items:
+        if id(item) in numbers:
+            reply = replies.get(numbers[id(item)], "")
+            if "" not in split_reply(reply)[:2]:
+                item["response"] = reply
+                batch_counts["batched_mails"] += 1
+                results.append(item)
+                continue
+            batch_counts["fallbacks"] += 1
+        results.append(
+            generate_reply(item, reuse=False) if id(item) in pending_ids else item
+        )
+    return results
+
+
+# a backend that can answer several prompts at once gets every mail's own prompt instead of a batch prompt, the mails
+# it fails on are asked for again one at a time (with query_bot()'s error handling)
+def query_concurrently(items, pending):
+    prompts = [item["prompt"] for item in pending]
+    for _ in prompts:
+        scheduler.acquire()
+    with bot_lock:
+        responses = responseBot.query_many(prompts)
+    batch_counts["batches"] += 1
+
+    answered = set()
+    for item, response in zip(pending, responses):
+        if isinstance(response, str) and response != "":
+            item["response"] = response
+            answered.add(id(item))
+            batch_counts["batched_mails"] += 1
+        else:
+            batch_counts["fallbacks"] += 1
+    pending_ids = {id(item) for item in pending}
+    return [
+        (
+            generate_reply(item, reuse=False)
+            if id(item) in pending_ids and id(item) not in answered
+            else item
+        )
+        for item in items
+    ]
+
+
+# reuse=False skips the reply cache/near-duplicate lookup, for the mails generate_replies() already looked up
+def generate_reply(item, reuse=True):
+    if reuse and reuse_reply(item):
+        return item
+
+    response = query_bot(item["prompt"])
+    # this handles the break from PromptTooLongError (see query_bot())
+    if response == "":
+        return None
+
+    item["response"] = response
+    return item
+
+
+# the same mail, or one nearly the same, was answered recently (only the mails that passed the spam filter get here)
+# a reused response that couldn't be parsed is sent back with 'requery' set, the bot is asked then
+def reuse_reply(item):
+    if "response" in item and item.get("cached", False):
+        return True
+    if item.get("requery", False):
+        return False
+    cached_response = reply_cache.get(item["mail"])
+    if cached_response == None:
+        cached_response = near_duplicates.find(item["mail"])
+    if cached_response == None:
+        return False
+    item["response"] = cached_response
+    item["cached"] = True
+    return True
+
+
+# returns the bot's response to the prompt, or "" if the prompt was too long
+def query_bot(prompt):
+    # try to get a response from the bot, shutdown if no reponse was given after 5 tries
+    response = ""
+    for _ in range(5):
+        error = ""
         try:
-            responseBot.logout(clear_chats=True)
-        except TimeoutError:  # error clearing chats
-            pass
+            # wait for a free slot under the message cap, then ask query to ChatGPT
+            scheduler.acquire()
+            with bot_lock:
+                response = responseBot.query(prompt)
+            break
+
+        # hold back the queries for the backend's cooldown (the Inbox and the Outbox keep working) and then try again
+        # If still gives error, shutdown
+        except gpt_scraper.HourlyLimitReachedError as e:
+            error = e
+            scheduler.limit_reached(responseBot.limit_cooldown)
+            continue
+        except (
+            gpt_scraper.PromptTooLongError
+        ):  # if prompt is too long, then skip this prompt/mail (though you need to logout of gpt and relogin first)
+            try:
+                # a backend that recovers by itself (e.g. the pool, which logs only that session out and in again) is kept
+                if not responseBot.recovers_itself:
+                    refresh_bot()
+                break  # gets the next mail
+            except RuntimeError as e:
+                raise e
+        except (
+            gpt_scraper.MultiplePromptsError
+        ) as e:  # if someone else is using your chatGPT account, logout, sleep for 5 mins, relogin and try again (max 5 times)
+            error = e
+            try:
+                with bot_lock:
+                    bot_logout()
+                time.sleep(5 * 60)
+                refresh_bot()
+                continue
+            except RuntimeError as e:
+                raise e
+        except TimeoutError as e:  # if a button/web-element was not found, try again
+            error = e
+            time.sleep(1)
+            continue
+        except RuntimeError as e:  # if some unkown error occurs, shutdowm
+            raise e
+
+    # if couldn't get a response even after trying 5 times, raise Runtime error
+    if error != "":
+        raise RuntimeError(error)
+
+    # the break from PromptTooLongError doesn't change str 'error', the caller catches it by looking at the response
+    return response
+
+
+# returns the subject and the body of the reply in the response, "" for the ones that are missing
+# the third value tells if the format of the response had to be fixed up for that
+def split_reply(response):
+    # Extracting subject from the response
+    subject_match = re.search(r"Subject:(.+)", response)
+    reply_subject = subject_match.group(1) if subject_match else ""
+
+    # Extracting body from the response
+    body_match = re.search(r"Body:(.+)", response, re.DOTALL)
+    reply_body = body_match.group(1) if body_match else ""
+
+    # missing, or left with markdown around the labels (e.g. "**Subject:** ..."), markdown at the start of a value
+    # (e.g. "Body: *Thanks* for ...") is part of the reply
+    if (
+        reply_subject.strip() == ""
+        or reply_body.strip() == ""
+        or _MARKDOWN_LABEL.search(response) != None
+    ):
+        reply_subject, reply_body = repair_reply(response)
+        return reply_subject, reply_body, True
+    return reply_subject, reply_body, False
+
+
+# a label with markdown in front of it (**Subject:**, *Body*:, ## Subject)
+_MARKDOWN_LABEL = re.compile(
+    r"^[ \t>]*(?:#+[ \t]*|[*_]+)(?:subject|body)\b", re.IGNORECASE | re.MULTILINE
+)
+# the labels the way ChatGPT tends to get them wrong: markdown (**Subject:**, ## Subject), "Subject line -", no colon...
+# only the markers that close the ones opening the label (group 1) are taken off after it, the value may start with
+# markdown of its own
+_SUBJECT_LABEL = re.compile(
+    r"^[ \t>#]*([*_]+)?[ \t]*subject(?: line)?[ \t]*(?(1)(?:\1)?)[ \t]*"
+    r"(?:[:\-\u2013](?(1)(?:[ \t]*\1)?)[ \t]*(.*?))?(?(1)[*_]*)[ \t]*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+_BODY_LABEL = re.compile(
+    r"^[ \t>#]*([*_]+)?[ \t]*body[ \t]*(?(1)(?:\1)?)[ \t]*[:\-\u2013](?(1)(?:[ \t]*\1)?)[ \t]*",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+# makes out the subject and the body of a response that isn't in the "Subject: ...\nBody: ..." format, ignoring any
+# preamble before the subject, "" for the ones that can't be found
+def repair_reply(response):
+    response = response.replace("\r\n", "\n")
+    subject_match = _SUBJECT_LABEL.search(response)
+    if subject_match == None:
+        return "", ""
+    reply_subject = (subject_match.group(2) or "").strip(" \t\"'")
+    rest = response[subject_match.end() :]
+    # the subject is on its own line, below the label
+    if reply_subject == "":
+        lines = rest.lstrip("\n").split("\n", 1)
+        if _BODY_LABEL.match(lines[0]) == None:
+            reply_subject = lines[0].strip(" \t*_\"'")
+            rest = lines[1] if len(lines) == 2 else ""
+
+    # the body follows its label, or (if there is no label) everything after the subject
+    body_match = _BODY_LABEL.search(rest)
+    reply_body = rest[body_match.end() :] if body_match != None else rest
+    return reply_subject, reply_body.strip()
+
+
+def parse_reply(item):
+    response = item["response"]
+    reply_subject, reply_body, repaired = split_reply(response)
+
+    # ask chatgpt for a response again, until it gives one in a usable format, at most MAX_REQUERIES times
+    if reply_subject == "" or reply_body == "":
+        parse_counts["failed"] += 1
+        if item.get("requeries", 0) >= MAX_REQUERIES:
+            parse_counts["given_up"] += 1
+            return None
+        parse_counts["requeried"] += 1
+        item["requeries"] = item.get("requeries", 0) + 1
+        item["requery"] = True
+        item.pop("cached", None)
+        pipeline.send_back("generate", item)
+        return None
+    parse_counts["recovered" if repaired else "strict"] += 1
+
+    if not item.get("cached", False):
+        reply_cache.put(item["mail"], response)
+        near_duplicates.add(item["mail"], response)
+
+    # prepare the reply to the original sender
+    item["reply"] = {
+        "to": item["mail"]["sender"],
+        "subject": reply_subject,
+        "body": reply_body,
+    }
+    return item
 
-    time.sleep(sleep_time)
+
+def deliver_reply(item):
+    Outbox.push(item["reply"])
+    return item
 
 
 # called when bot needs to be stopped
@@ -268,12 +767,13 @@ def shutdown(message):
     sys.exit()
 
 
-try:
-    read_credentials()
-    while True:
-        run(RUNTIME=(3 * 60 * 60))  # we restart the bot every 3 hours
-        freeze(10)
-except KeyboardInterrupt as e:
-    shutdown(str(e))
-except Exception as e:
-    shutdown(str(e))
\ No newline at end of file
+# the guard keeps the bot from starting again inside the Inbox's mail parsing worker processes (they import this module)
+if __name__ == "__main__":
+    try:
+        read_credentials()
+        # runs until an error the bot can't recover from, the parts of the bot are refreshed on the way (see run())
+        run(RUNTIME=None)
+    except KeyboardInterrupt as e:
+        shutdown(str(e))
+    except Exception as e:
+        shutdown(str(e))
@@ -0,0 +1,206 @@
+import threading
+import re
+import hashlib
+import difflib
+from collections import OrderedDict
+from email.utils import parseaddr
+
+_WORD = re.compile(r"\w+")
+_DIGIT = re.compile(r"\d")
+# words that are never swapped in a response, even capitalized (e.g. at the start of a sentence)
+_COMMON_WORDS = frozenset(
+    """a an the this that these those my your our their his her its i you we they he she it me us them and or but if
+    so as at by for from in into of on to with about dear hi hello hey thanks thank regards best please yes no not
+    is are was were be been am have has had do does did will would can could should may might must""".split()
+)
+
+
+# finds mails that are nearly the same as one the bot already answered (e.g. templated inquiries where only a name
+# or an order number changes), so that the earlier response can be reused instead of querying the bot again
+# every body gets a 64 bit SimHash of its words (with the digits masked, so that order numbers, dates etc. don't count),
+# two mails are near-duplicates if their SimHashes differ in at most max_distance bits
+# the index splits the SimHashes in max_distance + 1 bands: two SimHashes that close always have a band in common, so
+# only the mails sharing a band with the new one have to be compared to it
+# only the last max_entries responses are kept, and bodies shorter than min_words words are never matched
+class NearDuplicateIndex:
+    def __init__(self, max_distance=6, max_entries=1000, min_words=8):
+        if not isinstance(max_distance, int) or not 0 <= max_distance < 16:
+            raise ValueError("'max_distance' must be an integer between 0 and 15")
+        self.__max_distance = max_distance
+        self.__max_entries = max_entries
+        self.__min_words = min_words
+        self.__band_count = max_distance + 1
+        self.__band_width = 64 // self.__band_count
+        self.__entries = OrderedDict()  # id -> entry dict, oldest first
+        # per band: band value -> ids of the entries with that value
+        self.__bands = [{} for _ in range(self.__band_count)]
+        self.__next_id = 0
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__ambiguous = 0  # near-duplicates found, but not reused, see _adapt()
+
+    # the words of the text as written, the SimHash and the matching are done on their lowercased form
+    @staticmethod
+    def _tokens(text):
+        return _WORD.findall(text)
+
+    # 64 bit SimHash of the words, every bit is set if most of the words' hashes have it set
+    @staticmethod
+    def simhash(words):
+        counts = [0] * 64
+        for word in words:
+            feature = _DIGIT.sub("0", word)
+            value = int.from_bytes(
+                hashlib.blake2b(feature.encode(), digest_size=8).digest(), "big"
+            )
+            for bit in range(64):
+                counts[bit] += 1 if value >> bit & 1 else -1
+        return sum(1 << bit for bit in range(64) if counts[bit] > 0)
+
+    def _band_values(self, signature):
+        mask = (1 << self.__band_width) - 1
+        return [
+            signature >> (band * self.__band_width) & mask
+            for band in range(self.__band_count)
+        ]
+
+    # returns the response given to a near-duplicate of the mail, with its template values (order numbers, names, ...
+    # see _adapt()) swapped for the new mail's ones, or None if there is no near-duplicate or its response can't be
+    # adapted safely
+    def find(self, mail):
+        tokens = self._tokens(mail["body"])
+        if len(tokens) < self.__min_words:
+            return None
+        signature = self.simhash(word.lower() for word in tokens)
+        with self.__lock:
+            best = None
+            candidates = set()
+            for band, value in enumerate(self._band_values(signature)):
+                candidates |= self.__bands[band].get(value, set())
+            for entry_id in candidates:
+                entry = self.__entries[entry_id]
+                distance = (entry["signature"] ^ signature).bit_count()
+                if distance <= self.__max_distance and (
+                    best == None or distance < best[0]
+                ):
+                    best = (distance, entry)
+            if best == None:
+                self.__misses += 1
+                return None
+            entry = best[1]
+        response = self._adapt(
+            entry["response"],
+            entry["tokens"],
+            tokens,
+            entry["sender_name"],
+            self._sender_name(mail),
+        )
+        with self.__lock:
+            if response == None:
+                self.__ambiguous += 1
+            else:
+                self.__hits += 1
+        return response
+
+    def add(self, mail, response):
+        tokens = self._tokens(mail["body"])
+        if len(tokens) < self.__min_words:
+            return
+        signature = self.simhash(word.lower() for word in tokens)
+        with self.__lock:
+            entry_id = self.__next_id
+            self.__next_id += 1
+            self.__entries[entry_id] = {
+                "signature": signature,
+                "tokens": tokens,
+                "sender_name": self._sender_name(mail),
+                "response": response,
+            }
+            for band, value in enumerate(self._band_values(signature)):
+                self.__bands[band].setdefault(value, set()).add(entry_id)
+            while len(self.__entries) > self.__max_entries:
+                old_id, old_entry = self.__entries.popitem(last=False)
+                for band, value in enumerate(self._band_values(old_entry["signature"])):
+                    bucket = self.__bands[band][value]
+                    bucket.discard(old_id)
+                    if len(bucket) == 0:
+                        del self.__bands[band][value]
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "ambiguous": self.__ambiguous,
+                "entries": len(self.__entries),
+            }
+
+    @staticmethod
+    def _sender_name(mail):
+        name, address = parseaddr(mail["sender"])
+        return name.strip()
+
+    # whether a word that differs between the two mails is a template value (like a name or an order number) that can be
+    # swapped in the response: it has digits, or it is capitalized and not a common word
+    @staticmethod
+    def _is_template_value(word):
+        if _DIGIT.search(word) != None:
+            return True
+        return word[:1].isupper() and word.lower() not in _COMMON_WORDS
+
+    # swaps the template values of the old mail that were replaced by other ones in the new mail (same position, same
+    # number of words) and the sender's name in the response, other differing words are left alone (swapping e.g. 'a'
+    # for 'the' everywhere would garble the response)
+    # returns None if a swap is ambiguous: an old value that was replaced by two different ones, or that is also still
+    # in the new mail, can't be told apart in the response, and a value that was added or removed has no counterpart
+    @staticmethod
+    def _adapt(response, old_tokens, new_tokens, old_name, new_name):
+        old_words = [word.lower() for word in old_tokens]
+        new_words = [word.lower() for word in new_tokens]
+        pairs = []  # (old value, new value) of every swap
+        kept = set()  # the words both mails have in common
+        matcher = difflib.SequenceMatcher(a=old_words, b=new_words, autojunk=False)
+        is_value = NearDuplicateIndex._is_template_value
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                kept.update(old_words[i1:i2])
+            elif tag == "replace" and i2 - i1 == j2 - j1:
+                for old_word, new_word in zip(old_tokens[i1:i2], new_tokens[j1:j2]):
+                    if is_value(old_word) and is_value(new_word):
+                        pairs.append((old_word, new_word))
+                    # a value replaced by an ordinary word, or the other way round
+                    elif is_value(old_word) or is_value(new_word):
+                        return None
+            # a value added or removed, there is nothing to swap it with
+            elif any(map(is_value, old_tokens[i1:i2] + new_tokens[j1:j2])):
+                return None
+        if old_name != "" and new_name != "":
+            pairs += zip(old_name.split(), new_name.split())
+
+        substitutions = {}
+        for old_word, new_word in pairs:
+            old_word = old_word.lower()
+            if old_word == new_word.lower():
+                continue
+            if old_word in kept or (
+                substitutions.get(old_word, new_word).lower() != new_word.lower()
+            ):
+                return None
+            substitutions[old_word] = new_word
+        if len(substitutions) == 0:
+            return response
+
+        # all at once, so that a swapped in word is never swapped again
+        def swap(match):
+            word = match.group(0)
+            new_word = substitutions[word.lower()]
+            # keep the capitalization of the response
+            if word[:1].isupper() and not word.isupper():
+                return new_word[:1].upper() + new_word[1:]
+            return new_word
+
+        pattern = "|".join(
+            re.escape(word) for word in sorted(substitutions, key=len, reverse=True)
+        )
+        return re.sub(rf"\b(?:{pattern})\b", swap, response, flags=re.IGNORECASE)
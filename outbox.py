@@ -1,9 +1,147 @@
 import threading
 import time
+import heapq
+import random
+import itertools
 from queue import Queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 import smtplib, ssl
-import csv
-from datetime import datetime
+from contextlib import contextmanager
+from email.utils import parseaddr
+from spool import Spool
+from delivery_log import DeliveryLog
+
+
+# keeps authenticated SMTP sessions open between uses, so that sending a mail doesn't cost a TLS handshake and a login every time
+# sessions are checked with a NOOP before being handed out, and replaced by a fresh one if the server has dropped them
+class SmtpPool:
+    def __init__(self, max_idle_per_account=2):
+        self.__max_idle_per_account = max_idle_per_account
+        # (smtp_server, smtp_port, sender_email) -> list of logged in sessions not in use
+        self.__idle = {}
+        self.__lock = threading.Lock()
+
+    # use as 'with pool.connection(...) as email:', the session goes back to the pool at the end of the block
+    @contextmanager
+    def connection(self, smtp_server, smtp_port, sender_email, email_password):
+        key = (smtp_server, smtp_port, sender_email)
+        session = self._acquire(key, email_password)
+        try:
+            yield session
+        # the server answered, it just refused the mail (smtplib resets the session for the next one), every
+        # SMTPException is an OSError too so this has to come first
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            self._release(key, session)
+            raise
+        except (smtplib.SMTPServerDisconnected, OSError):
+            # the session is dead, don't give it back to the pool
+            self._close(session)
+            raise
+        except Exception:
+            self._release(key, session)
+            raise
+        else:
+            self._release(key, session)
+
+    # lets the pool keep more sessions per account, e.g. one for every thread sending mails at the same time
+    def set_max_idle_per_account(self, val):
+        with self.__lock:
+            self.__max_idle_per_account = val
+
+    # closes all the idle sessions
+    def close_all(self):
+        with self.__lock:
+            sessions = [s for idle in self.__idle.values() for s in idle]
+            self.__idle = {}
+        for session in sessions:
+            self._close(session)
+
+    def _acquire(self, key, email_password):
+        while True:
+            with self.__lock:
+                idle = self.__idle.get(key)
+                session = idle.pop() if idle else None
+            if session is None:
+                break
+            if self._is_alive(session):
+                return session
+            self._close(session)
+        smtp_server, smtp_port, sender_email = key
+        session = smtplib.SMTP_SSL(
+            smtp_server, smtp_port, context=ssl.create_default_context()
+        )
+        try:
+            session.login(sender_email, email_password)
+        except Exception:
+            self._close(session)
+            raise
+        return session
+
+    def _release(self, key, session):
+        with self.__lock:
+            idle = self.__idle.setdefault(key, [])
+            if len(idle) < self.__max_idle_per_account:
+                idle.append(session)
+                return
+        self._close(session)
+
+    @staticmethod
+    def _is_alive(session):
+        try:
+            return session.noop()[0] == 250
+        except Exception:  # SMTPServerDisconnected, socket errors, ...
+            return False
+
+    @staticmethod
+    def _close(session):
+        try:
+            session.quit()
+        except Exception:
+            session.close()
+
+
+# shared by the Outbox and send_email()
+_smtp_pool = SmtpPool()
+
+
+# lets through at most 'rate' mails every 'per' seconds on average, in bursts of up to 'rate' mails
+class TokenBucket:
+    def __init__(self, rate, per):
+        self.__capacity = rate
+        self.__fill_rate = rate / per  # tokens per second
+        self.__tokens = float(rate)
+        self.__last_fill = time.monotonic()
+        self.__lock = threading.Lock()
+
+    # blocks until a token is available, then takes it
+    def acquire(self):
+        while True:
+            wait_time = self._take()
+            if wait_time == 0:
+                return
+            time.sleep(wait_time)
+
+    # takes a token if there is one and returns 0, otherwise returns the number of seconds until there will be one
+    def _take(self):
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(
+                self.__capacity,
+                self.__tokens + (now - self.__last_fill) * self.__fill_rate,
+            )
+            self.__last_fill = now
+            if self.__tokens >= 1:
+                self.__tokens -= 1
+                return 0
+            return (1 - self.__tokens) / self.__fill_rate
+
+
+# exponential backoff with jitter, so that mails that failed together aren't all retried at the same moment
+# (shared with the AsyncOutbox)
+def _backoff_delay(failures, base_delay, max_delay):
+    delay = min(max_delay, base_delay * 2 ** (failures - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
 
 
 class Outbox:
@@ -15,6 +153,41 @@ class Outbox:
     __stop_flush_thread = False  # flag
     __smtp_error_occurred = False
     __working = False
+    # if set, a mail is sent at most this many seconds after being pushed
+    __max_latency = None
+    __pending_since = None  # time of the first push since the last flush
+    # notified by push() and stop(), wakes the flush thread up
+    __pushed = threading.Condition()
+    __spool = None  # on-disk copy of the _queue (see spool.Spool), None if the Outbox runs in memory only
+    __sender_workers = 1
+    __executor = None  # runs the sender workers
+    __rate_limit = None  # TokenBucket shared by all the mails, None if not limited
+    # (rate, per) applied to each recipient domain, None if not limited
+    __domain_rate_limit = None
+    __domain_buckets = {}  # recipient domain -> TokenBucket
+    __domain_lock = threading.Lock()
+    __stats_lock = threading.Lock()  # guards the counters below
+    __sent = 0
+    __failed = 0
+    __sent_times = deque()  # when each mail of the last minute was sent
+    __delivery_log = None  # record of the mails sent (see delivery_log.DeliveryLog)
+    __max_attempts = 5
+    __retry_base_delay = (
+        30  # seconds before the first retry, doubled for every attempt after that
+    )
+    __retry_max_delay = 30 * 60
+    # (due time, tie breaker, spool_id, mail, attempts) of the mails waiting to be sent again, guarded by __pushed
+    __retries = []
+    __retry_ids = itertools.count()
+    # the SMTP server refused the connection/login, no mail is tried again before __smtp_down_until
+    __smtp_failures = 0
+    __smtp_down_until = 0
+    # the SMTP server refused the login this many times in a row, smtp_error_occurred() once it reaches __max_auth_failures
+    __auth_failures = 0
+    __max_auth_failures = 3
+    # id -> (spool_id, dead letter dict) of the mails that ran out of attempts, guarded by __pushed
+    __dead_letters = {}
+    __dead_letter_ids = itertools.count(1)
 
     @staticmethod
     def _set_flush_interval(val):
@@ -40,6 +213,95 @@ class Outbox:
             )
         Outbox.__max__queue_size = val
 
+    @staticmethod
+    def _set_max_latency(val):
+        if val is None:
+            Outbox.__max_latency = None
+            return
+        if not isinstance(val, (int, float)):
+            raise TypeError(
+                "start() method argument 'max_latency' must be of type 'int', 'float' or None"
+            )
+        if val <= 0:
+            raise ValueError(
+                "start() method argument 'max_latency' must be a positive number"
+            )
+        Outbox.__max_latency = val
+
+    @staticmethod
+    def _set_sender_workers(val):
+        if not isinstance(val, int):
+            raise TypeError(
+                "start() method argument 'sender_workers' must be of type 'int'"
+            )
+        if val < 1:
+            raise ValueError(
+                "start() method argument 'sender_workers' must be an integer greater than 0"
+            )
+        Outbox.__sender_workers = val
+
+    # returns the (rate, per) limit after checking it, 'name' is the start() argument it was passed as
+    @staticmethod
+    def _check_rate_limit(val, name):
+        if val is None:
+            return None
+        if (
+            not isinstance(val, tuple)
+            or len(val) != 2
+            or not isinstance(val[0], int)
+            or not isinstance(val[1], (int, float))
+        ):
+            raise TypeError(
+                f"start() method argument '{name}' must be a tuple of type '(int, int | float)' or None"
+            )
+        if val[0] < 1 or val[1] <= 0:
+            raise ValueError(
+                f"start() method argument '{name}' must be a (mails, seconds) tuple of positive numbers"
+            )
+        return val
+
+    @staticmethod
+    def _set_rate_limits(rate_limit, domain_rate_limit):
+        rate_limit = Outbox._check_rate_limit(rate_limit, "rate_limit")
+        Outbox.__domain_rate_limit = Outbox._check_rate_limit(
+            domain_rate_limit, "domain_rate_limit"
+        )
+        Outbox.__rate_limit = None if rate_limit is None else TokenBucket(*rate_limit)
+        Outbox.__domain_buckets = {}
+
+    @staticmethod
+    def _set_retry_policy(
+        max_attempts, retry_base_delay, retry_max_delay, max_auth_failures
+    ):
+        for name, val in (
+            ("max_attempts", max_attempts),
+            ("max_auth_failures", max_auth_failures),
+        ):
+            if not isinstance(val, int):
+                raise TypeError(
+                    f"start() method argument '{name}' must be of type 'int'"
+                )
+            if val < 1:
+                raise ValueError(
+                    f"start() method argument '{name}' must be an integer greater than 0"
+                )
+        for name, val in (
+            ("retry_base_delay", retry_base_delay),
+            ("retry_max_delay", retry_max_delay),
+        ):
+            if not isinstance(val, (int, float)):
+                raise TypeError(
+                    f"start() method argument '{name}' must be of type 'int' or 'float'"
+                )
+            if val <= 0:
+                raise ValueError(
+                    f"start() method argument '{name}' must be a positive number"
+                )
+        Outbox.__max_attempts = max_attempts
+        Outbox.__retry_base_delay = retry_base_delay
+        Outbox.__retry_max_delay = retry_max_delay
+        Outbox.__max_auth_failures = max_auth_failures
+
     @staticmethod
     def _set_credentials(credentials):
         if (
@@ -59,6 +321,9 @@ class Outbox:
         Outbox.__sender_credentials["email"] = credentials["email"]
         Outbox.__sender_credentials["password"] = credentials["password"]
 
+    # whether the SMTP server refused the login max_auth_failures times in a row, i.e. the credentials are most likely
+    # wrong, the Outbox keeps the mails and retries, but won't get anywhere until it is started with working ones
+    # an unreachable server isn't reported, the Outbox waits for it to come back on its own
     @staticmethod
     def smtp_error_occurred():
         return Outbox.__smtp_error_occurred
@@ -67,13 +332,81 @@ class Outbox:
     def is_working():
         return Outbox.__working
 
+    # whether the Outbox is still sending mails, i.e. it was started and its flush thread is running
+    @staticmethod
+    def alive():
+        return Outbox.__working and Outbox.__flush_thread.is_alive()
+
+    # mails sent/failed since start(), and how many were sent during the last minute
     @staticmethod
-    def start(flush_interval, max_queue_size, sender_credentials):
+    def delivery_stats():
+        with Outbox.__stats_lock:
+            Outbox._forget_old_sends()
+            return {
+                "sent": Outbox.__sent,
+                "failed": Outbox.__failed,
+                "sent_last_minute": len(Outbox.__sent_times),
+                "retrying": len(Outbox.__retries),
+                "dead_letters": len(Outbox.__dead_letters),
+            }
+
+    # the Outbox flushes as soon as it holds max_queue_size mails, and every flush_interval seconds otherwise
+    # max_latency (optional) makes it flush earlier, so that no mail waits more than max_latency seconds in the _queue
+    # spool_file (optional) keeps a copy of the queued mails on disk, the ones not sent yet are pushed again by the next start()
+    # a flush hands the mails to 'sender_workers' threads, each sending over its own SMTP session
+    # rate_limit and domain_rate_limit (optional) are (mails, seconds) tuples, they cap how fast mails are sent overall and
+    # to each recipient domain, mails over the limit wait for their turn
+    # every mail sent is recorded in log_file, rows older than log_retention_days (optional) are dropped
+    # a mail that can't be sent is tried again later, after retry_base_delay seconds and twice as long after every
+    # attempt (up to retry_max_delay), once it has failed max_attempts times it becomes a dead letter (see dead_letters())
+    # a login refused max_auth_failures times in a row is reported by smtp_error_occurred()
+    @staticmethod
+    def start(
+        flush_interval,
+        max_queue_size,
+        sender_credentials,
+        max_latency=None,
+        spool_file=None,
+        sender_workers=1,
+        rate_limit=None,
+        domain_rate_limit=None,
+        log_file="mail_logs.db",
+        log_retention_days=None,
+        max_attempts=5,
+        retry_base_delay=30,
+        retry_max_delay=30 * 60,
+        max_auth_failures=3,
+    ):
         Outbox._set_flush_interval(flush_interval)
         Outbox._set_max_size(max_queue_size)
+        Outbox._set_max_latency(max_latency)
         Outbox._set_credentials(sender_credentials)
+        Outbox._set_sender_workers(sender_workers)
+        Outbox._set_rate_limits(rate_limit, domain_rate_limit)
+        Outbox._set_retry_policy(
+            max_attempts, retry_base_delay, retry_max_delay, max_auth_failures
+        )
+        with Outbox.__pushed:
+            # dead letters of a previous run that live in its spool are loaded again from the spool
+            Outbox.__dead_letters = {
+                letter_id: (spool_id, letter)
+                for letter_id, (spool_id, letter) in Outbox.__dead_letters.items()
+                if spool_id is None
+            }
+            Outbox.__smtp_failures, Outbox.__smtp_down_until = 0, 0
+            Outbox.__auth_failures = 0
+        if spool_file is not None:
+            Outbox._open_spool(spool_file)
+        Outbox.__delivery_log = DeliveryLog(log_file, retention_days=log_retention_days)
         Outbox.__stop_flush_thread = False
         Outbox.__smtp_error_occurred = False
+        with Outbox.__stats_lock:
+            Outbox.__sent, Outbox.__failed = 0, 0
+            Outbox.__sent_times.clear()
+        _smtp_pool.set_max_idle_per_account(max(2, Outbox.__sender_workers))
+        Outbox.__executor = ThreadPoolExecutor(
+            max_workers=Outbox.__sender_workers, thread_name_prefix="outbox-sender"
+        )
         Outbox.__flush_thread = threading.Thread(
             target=Outbox._flush_thread, daemon=True
         )
@@ -84,82 +417,288 @@ class Outbox:
     def stop():
         if Outbox.__working is False:
             raise IllegalStopError("Outbox was not started")
-        Outbox.__stop_flush_thread = True
+        with Outbox.__pushed:
+            Outbox.__stop_flush_thread = True
+            Outbox.__pushed.notify()
         Outbox.__flush_thread.join()
+        Outbox.__executor.shutdown(wait=True)
+        # mails waiting for a retry are tried again by the next start() (spooled ones are replayed from the spool)
+        # the spool is taken out under the lock, a push() coming in meanwhile (the Outbox may be restarted while the bot
+        # keeps pushing) keeps its mail in memory and the next start() spools it
+        with Outbox.__pushed:
+            for _, _, spool_id, mail, attempts in Outbox.__retries:
+                Outbox._queue.put((spool_id, mail, attempts))
+            Outbox.__retries = []
+            spool, Outbox.__spool = Outbox.__spool, None
+        # don't keep sessions open while the Outbox isn't running
+        _smtp_pool.close_all()
+        if spool is not None:
+            spool.close()
+        Outbox.__delivery_log.close()
         Outbox.__working = False
 
+    # sleeps until the next flush is due, then flushes, whatever is left in the _queue when the Outbox is stopped is flushed too
+    # mails whose retry is due are flushed along with the others
     @staticmethod
     def _flush_thread():
+        last_flush = time.time()
         while not Outbox.__stop_flush_thread:
-            start_time = time.time()
-            while time.time() - start_time < Outbox.__flush_interval:
-                if Outbox._queue.qsize() == Outbox.__max__queue_size:
-                    Outbox._flush_queue()
-                time.sleep(10)
+            with Outbox.__pushed:
+                while not Outbox.__stop_flush_thread:
+                    deadline = Outbox._next_flush_time(last_flush)
+                    if deadline is None or time.time() >= deadline:
+                        break
+                    Outbox.__pushed.wait(timeout=deadline - time.time())
+                Outbox.__pending_since = None
+                Outbox._requeue_due_retries()
             if Outbox._queue.qsize() != 0:
                 Outbox._flush_queue()
+            last_flush = time.time()
+
+    # returns the time at which the next flush is due, or None if it is due right now (the _queue is full)
+    # must be called with the __pushed lock held
+    @staticmethod
+    def _next_flush_time(last_flush):
+        if Outbox._queue.qsize() >= Outbox.__max__queue_size:
+            return None
+        deadline = last_flush + Outbox.__flush_interval
+        if Outbox.__max_latency is not None and Outbox.__pending_since is not None:
+            deadline = min(deadline, Outbox.__pending_since + Outbox.__max_latency)
+        if len(Outbox.__retries) != 0:
+            deadline = min(deadline, Outbox.__retries[0][0])
+        return deadline
 
+    # moves the mails whose retry is due to the _queue
+    # must be called with the __pushed lock held
+    @staticmethod
+    def _requeue_due_retries():
+        now = time.time()
+        while len(Outbox.__retries) != 0 and Outbox.__retries[0][0] <= now:
+            _, _, spool_id, mail, attempts = heapq.heappop(Outbox.__retries)
+            Outbox._queue.put((spool_id, mail, attempts))
+
+    # opens the spool, puts the mails a previous run didn't send back in the _queue and loads its dead letters
+    @staticmethod
+    def _open_spool(spool_file):
+        spool = Spool(spool_file)
+        with Outbox.__pushed:
+            Outbox.__spool = spool
+            # mails pushed while the Outbox was stopped aren't in the spool yet, the others will be replayed from it
+            unspooled = []
+            while not Outbox._queue.empty():
+                spool_id, mail, attempts = Outbox._queue.get()
+                if spool_id is None:
+                    unspooled.append((mail, attempts))
+            for spool_id, mail in Outbox.__spool.pending():
+                Outbox._queue.put((spool_id, mail, 0))
+            for mail, attempts in unspooled:
+                Outbox._queue.put((Outbox.__spool.append(mail), mail, attempts))
+            for spool_id, mail, attempts, error, failed_at in Outbox.__spool.dead():
+                Outbox._add_dead_letter(spool_id, mail, attempts, error, failed_at)
+            if not Outbox._queue.empty():
+                Outbox.__pending_since = time.time()
+
+    # sends the mails in the _queue in parallel and returns once they have all been dealt with
     @staticmethod
     def _flush_queue():
-        Outbox._send_mails()
+        mails = [Outbox._queue.get() for _ in range(Outbox._queue.qsize())]
+        wait(
+            [
+                Outbox.__executor.submit(Outbox._send_mail, spool_id, mail, attempts)
+                for spool_id, mail, attempts in mails
+            ]
+        )
 
+    # runs on a sender worker, 'attempts' is how many times the mail has failed so far
     @staticmethod
-    def _send_mails(
+    def _send_mail(
+        spool_id,
+        mail,
+        attempts,
         smtp_server="smtp.gmail.com",
         smtp_port=465,
     ):
+        # the server was unreachable a moment ago, wait for it to come back before trying again
+        if time.time() < Outbox.__smtp_down_until:
+            Outbox._schedule_retry(spool_id, mail, attempts, Outbox.__smtp_down_until)
+            return
+
         sender_email, email_password = (
             Outbox.__sender_credentials["email"],
             Outbox.__sender_credentials["password"],
         )
+        email_message = f"Subject:{mail['subject']}\nTo:{mail['to']}\n{mail['body']}"
+        receiver_mail = mail["to"]
+        Outbox._wait_for_rate_limits(receiver_mail)
 
+        logged_in = False
         try:
-            with smtplib.SMTP_SSL(
-                smtp_server, smtp_port, context=ssl.create_default_context()
+            # reuses a session of an earlier mail if it is still alive
+            with _smtp_pool.connection(
+                smtp_server, smtp_port, sender_email, email_password
             ) as email:
-                email.login(sender_email, email_password)
-
-                for _ in range(Outbox._queue.qsize()):
-                    mail = Outbox._queue.get()
-                    email_message = (
-                        f"Subject:{mail['subject']}\nTo:{mail['to']}\n{mail['body']}"
+                logged_in = True
+                Outbox.__auth_failures = 0
+                email.sendmail(sender_email, receiver_mail, email_message)
+        except Exception as e:
+            # not the mail's fault, it doesn't lose an attempt
+            if not logged_in:
+                Outbox._smtp_unavailable(e)
+                Outbox._schedule_retry(
+                    spool_id, mail, attempts, Outbox.__smtp_down_until
+                )
+                return
+            attempts += 1
+            if attempts >= Outbox.__max_attempts:
+                failed_at = time.time()
+                with Outbox.__pushed:
+                    Outbox._add_dead_letter(
+                        spool_id, mail, attempts, repr(e), failed_at
                     )
-                    receiver_mail = mail["to"]
-                    # if the first time the mail is not sent, try once more
-                    for _ in range(2):
-                        try:
-                            email.sendmail(sender_email, receiver_mail, email_message)
-                            Outbox._keep_log(mail)  # keeps a record of the mails sent
-                            break
-                        except Exception:
-                            continue
-        except Exception:
-            Outbox.__smtp_error_occurred = True
-            # raise SmtpError(e)
+                    if spool_id is not None:
+                        Outbox.__spool.mark_dead(spool_id, attempts, repr(e), failed_at)
+                with Outbox.__stats_lock:
+                    Outbox.__failed += 1
+            else:
+                Outbox._schedule_retry(
+                    spool_id, mail, attempts, time.time() + Outbox._backoff(attempts)
+                )
+            return
+
+        with Outbox.__pushed:
+            Outbox.__smtp_error_occurred = False
+            Outbox.__smtp_failures = 0
+        if spool_id is not None:
+            Outbox.__spool.mark_done(spool_id)
+        Outbox.__delivery_log.record(mail)  # keeps a record of the mails sent
+        with Outbox.__stats_lock:
+            Outbox.__sent += 1
+            Outbox.__sent_times.append(time.time())
+            Outbox._forget_old_sends()
 
     @staticmethod
-    def _keep_log(mail_dict):
-        copy_dict = mail_dict
-        copy_dict["datetime"] = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-        # Remove commas from the 'subject' key
-        copy_dict["subject"] = copy_dict["subject"].replace(",", "")
-        # Filter out key-value pairs related to 'body'
-        copy_dict = {
-            key: value for key, value in sorted(copy_dict.items()) if key != "body"
-        }
-        with open("mail_logs.csv", mode="a", newline="") as file:
-            writer = csv.DictWriter(file, fieldnames=copy_dict.keys())
+    def _backoff(failures):
+        return _backoff_delay(
+            failures, Outbox.__retry_base_delay, Outbox.__retry_max_delay
+        )
 
-            # Check if the file is empty
-            if file.tell() == 0:
-                writer.writeheader()
+    @staticmethod
+    def _schedule_retry(spool_id, mail, attempts, due):
+        with Outbox.__pushed:
+            heapq.heappush(
+                Outbox.__retries,
+                (due, next(Outbox.__retry_ids), spool_id, mail, attempts),
+            )
+            Outbox.__pushed.notify()
 
-            # Append the data row
-            writer.writerow(copy_dict)
+    # called when connecting/logging in fails, backs off for longer the longer the server stays unavailable
+    # a refused login is counted apart, as unlike a network error it won't go away by waiting, but only a permanent (5xx)
+    # refusal: smtplib raises SMTPAuthenticationError for temporary ones too (e.g. Gmail's '454 4.7.0 Too many login
+    # attempts'), and those just back off like a network error
+    @staticmethod
+    def _smtp_unavailable(error):
+        with Outbox.__pushed:
+            if (
+                isinstance(error, smtplib.SMTPAuthenticationError)
+                and error.smtp_code >= 500
+            ):
+                Outbox.__auth_failures += 1
+                if Outbox.__auth_failures >= Outbox.__max_auth_failures:
+                    Outbox.__smtp_error_occurred = True
+            # the other workers that failed at the same time don't extend the backoff again
+            if time.time() >= Outbox.__smtp_down_until:
+                Outbox.__smtp_failures += 1
+                Outbox.__smtp_down_until = time.time() + Outbox._backoff(
+                    Outbox.__smtp_failures
+                )
+
+    # must be called with the __pushed lock held
+    @staticmethod
+    def _add_dead_letter(spool_id, mail, attempts, error, failed_at):
+        letter_id = next(Outbox.__dead_letter_ids)
+        Outbox.__dead_letters[letter_id] = (
+            spool_id,
+            {
+                "id": letter_id,
+                "mail": mail,
+                "attempts": attempts,
+                "error": error,
+                "failed_at": failed_at,
+            },
+        )
+
+    # returns the mails that ran out of attempts, as dicts with the keys 'id', 'mail', 'attempts', 'error' (of the last
+    # attempt) and 'failed_at', oldest first
+    @staticmethod
+    def dead_letters():
+        with Outbox.__pushed:
+            letters = [dict(letter) for _, letter in Outbox.__dead_letters.values()]
+        return sorted(letters, key=lambda letter: letter["failed_at"])
+
+    # pushes the dead letters with the given ids (all of them if None) again, with a fresh set of attempts
+    # returns how many were pushed
+    @staticmethod
+    def replay_dead_letters(ids=None):
+        if Outbox.__working is False:
+            raise IllegalReplayError("Outbox was not started")
+        with Outbox.__pushed:
+            if ids is None:
+                ids = list(Outbox.__dead_letters.keys())
+            replayed = 0
+            for letter_id in ids:
+                if letter_id not in Outbox.__dead_letters:
+                    continue
+                spool_id, letter = Outbox.__dead_letters.pop(letter_id)
+                if spool_id is not None:
+                    Outbox.__spool.revive(spool_id)
+                Outbox._queue.put((spool_id, letter["mail"], 0))
+                replayed += 1
+            if replayed != 0 and Outbox.__pending_since is None:
+                Outbox.__pending_since = time.time()
+            Outbox.__pushed.notify()
+        return replayed
+
+    # blocks until the mail may be sent without going over the global or the recipient domain's rate limit
+    @staticmethod
+    def _wait_for_rate_limits(receiver_mail):
+        if Outbox.__domain_rate_limit is not None:
+            # the recipient may be a whole header, like "John <john@example.com>"
+            domain = parseaddr(receiver_mail)[1].rpartition("@")[2].lower()
+            with Outbox.__domain_lock:
+                bucket = Outbox.__domain_buckets.get(domain)
+                if bucket is None:
+                    bucket = TokenBucket(*Outbox.__domain_rate_limit)
+                    Outbox.__domain_buckets[domain] = bucket
+            bucket.acquire()
+        if Outbox.__rate_limit is not None:
+            Outbox.__rate_limit.acquire()
+
+    # must be called with the __stats_lock held
+    @staticmethod
+    def _forget_old_sends():
+        minute_ago = time.time() - 60
+        while len(Outbox.__sent_times) != 0 and Outbox.__sent_times[0] < minute_ago:
+            Outbox.__sent_times.popleft()
+
+    # returns the mails sent to 'recipient' (all of them if None) between 'since' and 'until' (epoch seconds), newest first
+    # works while the Outbox is stopped too, as long as it was started once
+    @staticmethod
+    def sent_mails(recipient=None, since=None, until=None, limit=None):
+        if Outbox.__delivery_log is None:
+            raise IllegalLogQueryError("Outbox was never started")
+        return Outbox.__delivery_log.query(recipient, since, until, limit)
 
     @staticmethod
     def push(mail):
-        Outbox._queue.put(mail)
+        with Outbox.__pushed:
+            spool_id = None
+            if Outbox.__spool is not None:
+                spool_id = Outbox.__spool.append(mail)
+            Outbox._queue.put((spool_id, mail, 0))
+            if Outbox.__pending_since is None:
+                Outbox.__pending_since = time.time()
+            # lets the flush thread check whether a flush is due now
+            Outbox.__pushed.notify()
 
     @staticmethod
     def size():
@@ -182,10 +721,9 @@ def send_email(
     email_message = f"Subject:{subject}\nTo:{receiver_mail}\n{message}"
 
     try:
-        with smtplib.SMTP_SSL(
-            smtp_server, smtp_port, context=ssl.create_default_context()
+        with _smtp_pool.connection(
+            smtp_server, smtp_port, sender_email, email_password
         ) as email:
-            email.login(sender_email, email_password)
             email.sendmail(sender_email, receiver_mail, email_message)
     except Exception as e:
         raise e
@@ -197,3 +735,11 @@ class SmtpError(RuntimeError):
 
 class IllegalStopError(RuntimeError):
     pass
+
+
+class IllegalLogQueryError(RuntimeError):
+    pass
+
+
+class IllegalReplayError(RuntimeError):
+    pass
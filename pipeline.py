@@ -0,0 +1,243 @@
+import threading
+import time
+from queue import Queue, Empty, Full
+
+
+# a chain of stages connected by bounded queues, every stage runs on its own worker threads
+# the source stage produces the items, every other stage gets an item from the stage before it and returns the item for
+# the next stage, or None to drop it, so a slow stage only holds up the items behind it and not the other stages
+# a stage that is full makes the ones before it wait (the queues are bounded), so nothing piles up in memory
+class Pipeline:
+    def __init__(self, queue_size=10, fatal_errors=(RuntimeError,)):
+        self.__queue_size = queue_size
+        # errors raised by a stage that stop the whole pipeline, other errors only drop the item
+        self.__fatal_errors = fatal_errors
+        self.__stages = []  # in order, the first one is the source
+        self.__threads = []
+        self.__stop_source = False
+        self.__stopped = False
+        self.__error = None
+        self.__failed = threading.Event()
+        self.__in_flight = (
+            0  # items produced by the source that didn't leave the pipeline yet
+        )
+        self.__cond = threading.Condition()  # guards __in_flight and the stats
+        # counted up by send_back(), tells the worker how many of its items were sent back and not dropped
+        self.__local = threading.local()
+
+    # func() returns a new item, or None if there is none right now (it should wait a little in that case)
+    def set_source(self, name, func, workers=1):
+        if len(self.__stages) != 0:
+            raise IllegalPipelineError("the source must be set before the other stages")
+        self.__stages.append(self._new_stage(name, func, workers))
+
+    # func(item) returns the item for the next stage (or for nobody if it's the last stage), or None to drop it
+    # with a batch_size greater than 1, func gets a list of up to batch_size items instead (a worker waits at most
+    # batch_wait seconds for the list to fill up) and returns a list with the result (an item or None) for each of them
+    def add_stage(self, name, func, workers=1, batch_size=1, batch_wait=1):
+        if len(self.__stages) == 0:
+            raise IllegalPipelineError("the source must be set before the other stages")
+        if name in (stage["name"] for stage in self.__stages):
+            raise IllegalPipelineError(f"there already is a stage named '{name}'")
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError(
+                f"stage '{name}' must have an integer batch size greater than 0"
+            )
+        stage = self._new_stage(name, func, workers)
+        stage["batch_size"] = batch_size
+        stage["batch_wait"] = batch_wait
+        self.__stages.append(stage)
+
+    def _new_stage(self, name, func, workers):
+        if not isinstance(workers, int) or workers < 1:
+            raise ValueError(
+                f"stage '{name}' must have an integer number of workers greater than 0"
+            )
+        return {
+            "name": name,
+            "func": func,
+            "workers": workers,
+            "batch_size": 1,
+            "batch_wait": 0,
+            "queue": Queue(maxsize=self.__queue_size),
+            # items sent back to this stage by a later one, not bounded so that sending back never blocks
+            "sent_back": Queue(),
+            "busy": 0,
+            "processed": 0,
+            "dropped": 0,
+            "errors": 0,
+            "requeued": 0,
+            "total_time": 0.0,
+        }
+
+    def start(self):
+        if len(self.__stages) == 0:
+            raise IllegalPipelineError("the pipeline has no stages")
+        for index, stage in enumerate(self.__stages):
+            for worker in range(stage["workers"]):
+                thread = threading.Thread(
+                    target=self._worker_thread,
+                    args=(index,),
+                    name=f"pipeline-{stage['name']}-{worker}",
+                    daemon=True,
+                )
+                thread.start()
+                self.__threads.append(thread)
+
+    # stops the source, lets the items already in the pipeline get through (for at most 'timeout' seconds, if given)
+    # and then stops the workers
+    def stop(self, timeout=None):
+        deadline = None if timeout == None else time.time() + timeout
+        with self.__cond:
+            self.__stop_source = True
+            while self.__in_flight != 0 and not self.__failed.is_set():
+                if deadline != None and time.time() >= deadline:
+                    break
+                self.__cond.wait(timeout=0.5)
+            self.__stopped = True
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+    # blocks until a stage raises one of the fatal_errors, or for 'timeout' seconds, returns True in the first case
+    def wait(self, timeout=None):
+        return self.__failed.wait(timeout)
+
+    # the fatal error that stopped the pipeline, None if there was none
+    def error(self):
+        return self.__error
+
+    # hands the item back to an earlier (or the same) stage, e.g. to do that step again
+    # meant to be called by a stage's func, which then returns None
+    def send_back(self, stage_name, item):
+        for stage in self.__stages[1:]:
+            if stage["name"] == stage_name:
+                with self.__cond:
+                    stage["requeued"] += 1
+                self.__local.sent_back += 1
+                stage["sent_back"].put(item)
+                return
+        raise IllegalPipelineError(f"there is no stage named '{stage_name}'")
+
+    # per stage: number of workers, how many of them are busy, how many items wait in its queue, how many it processed,
+    # dropped, failed on and got sent back, and the average time (in seconds) it took per item
+    def stats(self):
+        with self.__cond:
+            return {
+                stage["name"]: {
+                    "workers": stage["workers"],
+                    "busy": stage["busy"],
+                    "queue_depth": stage["queue"].qsize() + stage["sent_back"].qsize(),
+                    "processed": stage["processed"],
+                    "dropped": stage["dropped"],
+                    "errors": stage["errors"],
+                    "requeued": stage["requeued"],
+                    "avg_time": (
+                        stage["total_time"] / stage["processed"]
+                        if stage["processed"] != 0
+                        else 0.0
+                    ),
+                }
+                for stage in self.__stages
+            }
+
+    def _worker_thread(self, index):
+        stage = self.__stages[index]
+        is_source = index == 0
+        next_stage = (
+            self.__stages[index + 1] if index + 1 < len(self.__stages) else None
+        )
+        while not self.__stopped:
+            if is_source:
+                if self.__stop_source:
+                    return
+                items = []
+            else:
+                items = self._next_items(stage)
+                if len(items) == 0:
+                    continue
+
+            with self.__cond:
+                stage["busy"] += 1
+            self.__local.sent_back = 0
+            start = time.perf_counter()
+            try:
+                if is_source:
+                    results = [stage["func"]()]
+                elif stage["batch_size"] == 1:
+                    results = [stage["func"](items[0])]
+                else:
+                    results = list(stage["func"](items))
+                    if len(results) != len(items):
+                        raise IllegalPipelineError(
+                            f"stage '{stage['name']}' returned {len(results)} results for {len(items)} items"
+                        )
+                error = None
+            except Exception as e:
+                results, error = [None] * max(len(items), 1), e
+            elapsed = time.perf_counter() - start
+
+            with self.__cond:
+                stage["busy"] -= 1
+                passed = [result for result in results if result != None]
+                # items that were neither passed on nor sent back
+                gone = len(results) - len(passed) - self.__local.sent_back
+                if error != None:
+                    stage["errors"] += len(items) if not is_source else 1
+                elif not (is_source and len(passed) == 0):
+                    stage["processed"] += len(results)
+                    stage["total_time"] += elapsed
+                    stage["dropped"] += gone
+                if is_source:
+                    self.__in_flight += len(passed)
+                # the items leave the pipeline
+                else:
+                    if next_stage == None:
+                        gone += len(passed)
+                    if gone != 0:
+                        self.__in_flight -= gone
+                        self.__cond.notify_all()
+
+            if error != None and isinstance(error, self.__fatal_errors):
+                self.__error = error
+                self.__failed.set()
+                with self.__cond:
+                    self.__cond.notify_all()
+                return
+            if next_stage != None:
+                for result in passed:
+                    self._put(next_stage, result)
+
+    # waits for up to batch_size items, sent back items go first, returns an empty list if there were none for a while
+    def _next_items(self, stage):
+        items = []
+        while len(items) < stage["batch_size"]:
+            try:
+                items.append(stage["sent_back"].get_nowait())
+            except Empty:
+                break
+        if len(items) == 0:
+            try:
+                items.append(stage["queue"].get(timeout=0.5))
+            except Empty:
+                return items
+        # fill up the batch, waiting at most batch_wait seconds for the items to arrive
+        deadline = time.time() + stage["batch_wait"]
+        while len(items) < stage["batch_size"] and not self.__stop_source:
+            try:
+                items.append(stage["queue"].get(timeout=max(deadline - time.time(), 0)))
+            except Empty:
+                break
+        return items
+
+    def _put(self, stage, item):
+        while not self.__stopped:
+            try:
+                stage["queue"].put(item, timeout=0.5)
+                return
+            except Full:  # try again, unless the pipeline was stopped
+                continue
+
+
+class IllegalPipelineError(RuntimeError):
+    pass
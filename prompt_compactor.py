@@ -0,0 +1,105 @@
+import threading
+import re
+
+# the line the quoted history of a reply starts at: "On <date>, <someone> wrote:" (sometimes wrapped over two lines),
+# Outlook's "-----Original Message-----" or its "From: ... Sent: ..." header
+_HISTORY = re.compile(
+    r"^(?:On\b[^\n]*(?:\n[^\n]*)?\bwrote:[ \t]*$"
+    r"|-{2,}[ \t]*Original Message[ \t]*-{2,}"
+    r"|From:[^\n]*\n(?:Sent|Date):)",
+    re.MULTILINE | re.IGNORECASE,
+)
+# the line a signature or a footer starts at: the "-- " signature separator, "Sent from my ...", legal disclaimers
+_SIGNATURE = re.compile(
+    r"^(?:--[ \t]*$"
+    r"|Sent from my\b"
+    r"|(?:CONFIDENTIALITY NOTICE|DISCLAIMER)\b"
+    r"|This (?:e-?mail|message)(?: and any attachments?)? (?:is|are|may contain)\b[^\n]*confidential)",
+    re.MULTILINE | re.IGNORECASE,
+)
+
+
+# makes the mails shorter before they are put in a prompt: drops the quoted history of reply chains (">" lines,
+# "On ... wrote:" blocks), signatures and legal footers, collapses whitespace, and cuts the mail so that the whole prompt
+# fits in token_budget (estimated) tokens, a shorter prompt is answered faster and doesn't run into PromptTooLongError
+class PromptCompactor:
+    def __init__(self, token_budget=3000, chars_per_token=4):
+        if not isinstance(token_budget, int) or token_budget < 1:
+            raise ValueError("'token_budget' must be an integer greater than 0")
+        self.__token_budget = token_budget
+        self.__chars_per_token = chars_per_token
+        self.__lock = threading.Lock()  # guards the stats
+        self.__mails = 0
+        self.__truncated = 0
+        self.__chars_before = 0
+        self.__chars_after = 0
+        self.__tokens_before = 0
+        self.__tokens_after = 0
+
+    # rough number of tokens the text takes up (ChatGPT's tokenizer averages about 4 characters per token for english)
+    def estimate_tokens(self, text):
+        return -(-len(text) // self.__chars_per_token)
+
+    # the body without quoted history, signature and footers, with its whitespace collapsed
+    @staticmethod
+    def strip_body(body):
+        body = body.replace("\r\n", "\n")
+        history = _HISTORY.search(body)
+        if history != None:
+            body = body[: history.start()]
+        signature = _SIGNATURE.search(body)
+        if signature != None:
+            body = body[: signature.start()]
+        lines = [
+            " ".join(line.split())
+            for line in body.split("\n")
+            if not line.lstrip().startswith(">")
+        ]
+        # at most one empty line between two paragraphs
+        return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+    # returns the compacted mail text (headers + body) for a prompt that starts with 'prefix', only the body is stripped
+    def compact(self, prefix, headers, body):
+        before = prefix + headers + body
+        stripped = self.strip_body(body)
+        # nothing but quotes/signature, keep the original text then
+        if stripped == "":
+            stripped = " ".join(body.split())
+
+        text = headers + stripped
+        max_chars = (
+            self.__token_budget * self.__chars_per_token - len(prefix) - len(" [...]")
+        )
+        truncated = len(text) > max_chars
+        if truncated:
+            text = text[: max(max_chars, 0)]
+            # cut at the last whole word
+            if " " in text:
+                text = text[: text.rindex(" ")]
+            text += " [...]"
+
+        with self.__lock:
+            self.__mails += 1
+            self.__truncated += 1 if truncated else 0
+            self.__chars_before += len(before)
+            self.__chars_after += len(prefix) + len(text)
+            self.__tokens_before += self.estimate_tokens(before)
+            self.__tokens_after += self.estimate_tokens(prefix + text)
+        return text
+
+    # number of mails compacted (and truncated), total prompt size before and after in characters and estimated tokens
+    def stats(self):
+        with self.__lock:
+            return {
+                "mails": self.__mails,
+                "truncated": self.__truncated,
+                "chars_before": self.__chars_before,
+                "chars_after": self.__chars_after,
+                "tokens_before": self.__tokens_before,
+                "tokens_after": self.__tokens_after,
+                "saved": (
+                    1 - self.__chars_after / self.__chars_before
+                    if self.__chars_before != 0
+                    else 0.0
+                ),
+            }
@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import deque
+
+
+# paces the queries to ChatGPT so that they stay under its message cap, instead of finding out about the cap by running
+# into HourlyLimitReachedError: at most 'quota' queries are let through in any 'window' seconds, the first half of the
+# quota can go out at once, after that the queries are spread evenly over the window
+# when the cap is hit anyway, limit_reached() holds back the queries (and only the queries) for a while
+# quota=None is for a backend without a message cap, the queries are let through as they come then (but for the
+# cooldowns of limit_reached())
+class QueryScheduler:
+    def __init__(self, quota=25, window=60 * 60):
+        if quota != None and (not isinstance(quota, int) or quota < 1):
+            raise ValueError("'quota' must be an integer greater than 0")
+        if quota != None and (not isinstance(window, (int, float)) or window <= 0):
+            raise ValueError("'window' must be a number greater than 0")
+        self.__quota = quota
+        self.__window = window
+        # times of the queries let through in the last 'window' seconds, oldest first
+        self.__sent = deque()
+        self.__cooldown_until = 0
+        self.__cond = threading.Condition()
+        self.__waited = 0.0  # total seconds the queries were held back
+        self.__limit_hits = 0
+
+    # blocks until a query can be sent and counts it as sent
+    def acquire(self):
+        start = time.time()
+        with self.__cond:
+            while True:
+                wait = self._time_until_slot(time.time())
+                if wait <= 0:
+                    break
+                self.__cond.wait(timeout=wait)
+            if self.__quota != None:
+                self.__sent.append(time.time())
+            self.__waited += time.time() - start
+
+    # the predicted number of seconds until a query would be let through (0 if it would be right now)
+    def time_until_slot(self):
+        with self.__cond:
+            return max(self._time_until_slot(time.time()), 0)
+
+    # (queries, seconds) of the message cap, None if there is none
+    def quota(self):
+        return None if self.__quota == None else (self.__quota, self.__window)
+
+    def _time_until_slot(self, now):
+        if self.__quota == None:
+            return self.__cooldown_until - now
+        while len(self.__sent) != 0 and now - self.__sent[0] >= self.__window:
+            self.__sent.popleft()
+
+        wait = self.__cooldown_until - now
+        if len(self.__sent) >= self.__quota:
+            # the oldest query has to leave the window first
+            wait = max(wait, self.__sent[0] + self.__window - now)
+        elif len(self.__sent) != 0 and len(self.__sent) >= self.__quota // 2:
+            wait = max(wait, self.__sent[-1] + self.__window / self.__quota - now)
+        return wait
+
+    # the cap was hit anyway (e.g. by queries sent before the bot started), holds back the queries for 'cooldown'
+    # seconds
+    def limit_reached(self, cooldown):
+        with self.__cond:
+            self.__limit_hits += 1
+            self.__cooldown_until = max(self.__cooldown_until, time.time() + cooldown)
+            self.__cond.notify_all()
+
+    # the quota, queries sent in the current window, seconds until the next query slot is free and left of the
+    # cooldown, how many times the cap was hit, and the total seconds the queries were held back
+    def stats(self):
+        with self.__cond:
+            now = time.time()
+            next_slot_in = max(self._time_until_slot(now), 0)
+            return {
+                "quota": self.__quota,
+                "window": self.__window,
+                "sent_in_window": len(self.__sent),
+                "next_slot_in": next_slot_in,
+                "cooldown_left": max(self.__cooldown_until - now, 0),
+                "limit_hits": self.__limit_hits,
+                "waited": self.__waited,
+            }
@@ -0,0 +1,510 @@
+import threading
+import time
+import json
+from abc import ABC, abstractmethod
+import http.client
+from queue import LifoQueue, Empty
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import gpt_scraper
+
+
+# what the bot asks for its replies, every backend has the same interface as gpt_scraper.ChatGPT (set_credentials(),
+# login(), logged_in(), logout(), query()) plus query_many(), so the rest of the bot doesn't care which one it talks to
+# the errors are the ones gpt_scraper raises: HourlyLimitReachedError when the backend won't take more queries for a
+# while, PromptTooLongError when the prompt is too long for it, TimeoutError when it's worth trying again
+class ReplyBackend(ABC):
+    max_concurrency = 1  # how many queries the backend can work on at the same time
+    # the backend's message cap (queries, per seconds) the bot paces its queries under, None if it has none
+    query_quota = None
+    # seconds the bot holds back its queries for after an HourlyLimitReachedError
+    limit_cooldown = 30 * 60
+    # True if the backend gets back in shape after a failed query by itself, otherwise the bot replaces it with a new
+    # one after a PromptTooLongError (the scraper has to log out and in again)
+    recovers_itself = False
+
+    def set_credentials(self, email, password):
+        pass
+
+    @abstractmethod
+    def login(self):
+        pass
+
+    @abstractmethod
+    def logged_in(self):
+        pass
+
+    @abstractmethod
+    def logout(self, clear_chats=True):
+        pass
+
+    @abstractmethod
+    def query(self, prompt):
+        pass
+
+    # returns the response to every prompt, or the error querying it raised, in the same order as the prompts
+    def query_many(self, prompts):
+        results = []
+        for prompt in prompts:
+            try:
+                results.append(self.query(prompt))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    # usage numbers of the backend, if it keeps any
+    def stats(self):
+        return {}
+
+
+# ChatGPT's website, through gpt_scraper (a Chrome instance), one query at a time
+class ScraperBackend(ReplyBackend):
+    query_quota = (25, 60 * 60)  # ChatGPT's message cap, per account
+
+    def __init__(self, hidden=True):
+        self.__bot = gpt_scraper.ChatGPT(hidden=hidden)
+
+    def set_credentials(self, email, password):
+        self.__bot.set_credentials(email, password)
+
+    def login(self):
+        self.__bot.login()
+
+    def logged_in(self):
+        return self.__bot.logged_in()
+
+    def logout(self, clear_chats=True):
+        self.__bot.logout(clear_chats=clear_chats)
+
+    def query(self, prompt):
+        return self.__bot.query(prompt)
+
+
+# an OpenAI style chat completions API (POST <base_url>/chat/completions), over up to max_concurrency keep-alive
+# connections that are reused from one query to the next, the response is streamed in as it is generated (stream=True)
+# so that a long reply doesn't run into the read timeout
+# the API's rate limits are per minute and it answers 429 when they are hit, so there is no pacing (query_quota=None)
+# and the queries are only held back for limit_cooldown seconds after a 429
+class HttpChatBackend(ReplyBackend):
+    def __init__(
+        self,
+        base_url="https://api.openai.com/v1",
+        model="gpt-3.5-turbo",
+        api_key=None,
+        max_concurrency=4,
+        stream=True,
+        timeout=60,
+        query_quota=None,
+        limit_cooldown=60,
+    ):
+        if not isinstance(max_concurrency, int) or max_concurrency < 1:
+            raise ValueError("'max_concurrency' must be an integer greater than 0")
+        url = urlsplit(base_url)
+        if url.scheme not in ("http", "https") or url.hostname == None:
+            raise ValueError(f"'{base_url}' is not a valid http(s) url")
+        self.__https = url.scheme == "https"
+        self.__host = url.hostname
+        self.__port = url.port
+        self.__path = url.path.rstrip("/") + "/chat/completions"
+        self.__model = model
+        self.__api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.__stream = stream
+        self.__timeout = timeout
+        self.query_quota = None if query_quota == None else tuple(query_quota)
+        self.limit_cooldown = limit_cooldown
+        # connections not in use, the most recently used one first
+        self.__idle = LifoQueue()
+        self.__slots = threading.BoundedSemaphore(max_concurrency)
+        self.__executor = None  # runs query_many()'s queries, started on login()
+        self.__logged_in = False
+
+    recovers_itself = True
+
+    def login(self):
+        if self.__api_key == None:
+            raise gpt_scraper.InvalidCredentialsError("No API key was given")
+        self.__executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        self.__logged_in = True
+
+    def logged_in(self):
+        return self.__logged_in
+
+    # there are no chats to clear, closes the connections
+    def logout(self, clear_chats=True):
+        if not self.__logged_in:
+            raise gpt_scraper.IllegalLogoutError("Not logged in")
+        self.__logged_in = False
+        self.__executor.shutdown(wait=True)
+        while True:
+            try:
+                self.__idle.get_nowait().close()
+            except Empty:
+                break
+
+    def query(self, prompt):
+        if not self.__logged_in:
+            raise gpt_scraper.IllegalQueryError("Login before sending a query")
+        prompt = prompt.strip()
+        if prompt == "":
+            raise gpt_scraper.InvalidPromptError("Prompt was empty")
+
+        body = json.dumps(
+            {
+                "model": self.__model,
+                "messages": [{"role": "user", "content": prompt}],
+                "stream": self.__stream,
+            }
+        )
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.__api_key}",
+        }
+        with self.__slots:
+            # a kept-alive connection may have been closed by the server meanwhile, try once more on a new one then
+            for _ in range(2):
+                connection, reused = self._connection()
+                try:
+                    connection.request("POST", self.__path, body=body, headers=headers)
+                    response = connection.getresponse()
+                    if response.status != 200:
+                        error = self._error(response.status, response.read())
+                    elif self.__stream:
+                        text = self._read_stream(response)
+                    else:
+                        text = self._read_completion(response)
+                    break
+                except (OSError, http.client.HTTPException) as e:
+                    connection.close()
+                    if reused:
+                        continue
+                    raise TimeoutError(f"Chat completions request failed: {e}")
+                except ValueError as e:  # not the JSON we expected
+                    connection.close()
+                    raise TimeoutError(f"Malformed chat completions response: {e}")
+            else:
+                raise TimeoutError("Chat completions request failed: connection closed")
+            if response.will_close:
+                connection.close()
+            else:
+                self.__idle.put(connection)
+
+        if response.status != 200:
+            raise error
+        return text
+
+    # runs the prompts on up to max_concurrency connections at once
+    def query_many(self, prompts):
+        if not self.__logged_in:
+            raise gpt_scraper.IllegalQueryError("Login before sending a query")
+        futures = [self.__executor.submit(self.query, prompt) for prompt in prompts]
+        results = []
+        for future in futures:
+            error = future.exception()
+            results.append(error if error != None else future.result())
+        return results
+
+    # an idle connection if there is one, a new one otherwise, and whether it was used before
+    def _connection(self):
+        try:
+            return self.__idle.get_nowait(), True
+        except Empty:
+            pass
+        if self.__https:
+            connection = http.client.HTTPSConnection(
+                self.__host, self.__port, timeout=self.__timeout
+            )
+        else:
+            connection = http.client.HTTPConnection(
+                self.__host, self.__port, timeout=self.__timeout
+            )
+        return connection, False
+
+    # joins the content of the server-sent events ("data: {...}" lines, up to "data: [DONE]")
+    @staticmethod
+    def _read_stream(response):
+        parts = []
+        for line in response:
+            line = line.decode().strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:") :].strip()
+            if data == "[DONE]":
+                break
+            choices = json.loads(data).get("choices") or [{}]
+            parts.append(choices[0].get("delta", {}).get("content") or "")
+        # let the connection be reused
+        response.read()
+        return "".join(parts)
+
+    @staticmethod
+    def _read_completion(response):
+        completion = json.loads(response.read())
+        return completion["choices"][0]["message"]["content"]
+
+    # the gpt_scraper error for a failed request
+    @staticmethod
+    def _error(status, body):
+        try:
+            error = json.loads(body).get("error") or {}
+            if not isinstance(error, dict):
+                error = {"message": str(error)}
+        except ValueError:
+            error = {"message": body.decode(errors="replace")}
+        message = f"HTTP {status}: {error.get('message', '')}"
+        if (
+            error.get("code") == "context_length_exceeded"
+            or "maximum context length" in error.get("message", "")
+            or status == 413
+        ):
+            return gpt_scraper.PromptTooLongError(message)
+        if status == 429:
+            return gpt_scraper.HourlyLimitReachedError(message)
+        if status in (401, 403):
+            return gpt_scraper.InvalidCredentialsError(message)
+        if status >= 500:
+            return TimeoutError(message)
+        return RuntimeError(message)
+
+
+# several ChatGPT sessions (each one a Chrome instance, one or more per account) answering at the same time, every query
+# is handed to a session that is free
+# a session that runs into trouble is taken out of the pool on its own while the others keep answering: on
+# MultiplePromptsError it logs out and in again after busy_cooldown seconds, on HourlyLimitReachedError it rests for
+# limit_cooldown seconds (the query is tried again on another session in both cases), after PromptTooLongError it logs
+# out and in again right away, HourlyLimitReachedError is only raised when every session is over the limit
+# every account has its own message cap, so the pool's quota is the scraper's times the number of accounts
+class ChatGPTPool(ReplyBackend):
+    recovers_itself = True
+
+    # accounts: list of {'email': ..., 'password': ...}
+    def __init__(
+        self,
+        accounts,
+        sessions_per_account=1,
+        hidden=True,
+        limit_cooldown=30 * 60,
+        busy_cooldown=5 * 60,
+    ):
+        if len(accounts) == 0:
+            raise ValueError("'accounts' must hold at least one account")
+        if not isinstance(sessions_per_account, int) or sessions_per_account < 1:
+            raise ValueError("'sessions_per_account' must be an integer greater than 0")
+        self.__hidden = hidden
+        self.__limit_cooldown = limit_cooldown
+        self.__busy_cooldown = busy_cooldown
+        self.__sessions = [
+            {
+                "name": f"{account['email']}#{number}",
+                "account": account,
+                "backend": None,
+                "state": "down",  # idle, busy, down (logging in again), resting (over the hourly limit)
+                "created_at": time.time(),
+                "busy_since": None,
+                "busy_time": 0.0,
+                "queries": 0,
+                "errors": 0,
+                "restarts": 0,
+            }
+            for account in accounts
+            for number in range(sessions_per_account)
+        ]
+        self.max_concurrency = len(self.__sessions)
+        quota, window = ScraperBackend.query_quota
+        self.query_quota = (
+            quota * len({account["email"] for account in accounts}),
+            window,
+        )
+        self.limit_cooldown = limit_cooldown
+        self.__cond = threading.Condition()  # guards the sessions' state
+        self.__executor = None  # runs query_many()'s queries, started on login()
+        self.__logged_in = False
+        self.__closed = threading.Event()  # stops the sessions' recovery threads
+
+    # logs in every session, the ones that fail keep trying in the background, raises the error of the last one if none
+    # of them could log in (and stops trying then)
+    def login(self):
+        self.__closed.clear()
+        error = None
+        for session in self.__sessions:
+            try:
+                session["backend"] = self._new_session(session)
+                session["state"] = "idle"
+            except Exception as e:
+                error = e
+                session["state"] = "down"
+                self._recover(session, self.__busy_cooldown, relogin=True)
+        if all(session["state"] != "idle" for session in self.__sessions):
+            with self.__cond:
+                self.__logged_in = False
+                self.__closed.set()
+                self.__cond.notify_all()
+            raise error
+        self.__executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        self.__logged_in = True
+
+    def logged_in(self):
+        return self.__logged_in
+
+    def logout(self, clear_chats=True):
+        if not self.__logged_in:
+            raise gpt_scraper.IllegalLogoutError("Not logged in")
+        with self.__cond:
+            self.__logged_in = False
+            self.__closed.set()
+            self.__cond.notify_all()
+        self.__executor.shutdown(wait=True)
+        for session in self.__sessions:
+            self._logout_session(session["backend"], clear_chats)
+
+    def query(self, prompt):
+        while True:
+            session = self._acquire()
+            try:
+                response = session["backend"].query(prompt)
+            # the account is in use somewhere else, or over its hourly limit: try another session
+            except gpt_scraper.MultiplePromptsError:
+                self._release(session, failed=True, state="down")
+                self._recover(session, self.__busy_cooldown, relogin=True)
+                continue
+            except gpt_scraper.HourlyLimitReachedError:
+                self._release(session, failed=True, state="resting")
+                self._recover(session, self.__limit_cooldown, relogin=False)
+                continue
+            except gpt_scraper.PromptTooLongError:
+                self._release(session, failed=True, state="down")
+                self._recover(session, 0, relogin=True)
+                raise
+            except Exception:
+                self._release(session, failed=True)
+                raise
+            self._release(session)
+            return response
+
+    # runs the prompts on all the sessions at once
+    def query_many(self, prompts):
+        if not self.__logged_in:
+            raise gpt_scraper.IllegalQueryError("Login before sending a query")
+        futures = [self.__executor.submit(self.query, prompt) for prompt in prompts]
+        results = []
+        for future in futures:
+            error = future.exception()
+            results.append(error if error != None else future.result())
+        return results
+
+    # per session: its state, queries answered, errors, restarts and the share of its lifetime it spent answering
+    def stats(self):
+        with self.__cond:
+            now = time.time()
+            stats = {}
+            for session in self.__sessions:
+                busy_time = session["busy_time"]
+                if session["busy_since"] != None:
+                    busy_time += now - session["busy_since"]
+                stats[session["name"]] = {
+                    "state": session["state"],
+                    "queries": session["queries"],
+                    "errors": session["errors"],
+                    "restarts": session["restarts"],
+                    "busy_time": busy_time,
+                    "utilization": busy_time / max(now - session["created_at"], 1e-9),
+                }
+            return stats
+
+    # waits for a free session and marks it busy
+    # raises TimeoutError if no session is answering and none came back for a while (busy_cooldown * 2 seconds)
+    def _acquire(self):
+        deadline = None
+        with self.__cond:
+            while True:
+                if not self.__logged_in:
+                    raise gpt_scraper.IllegalQueryError("Login before sending a query")
+                states = [session["state"] for session in self.__sessions]
+                if "idle" in states:
+                    session = self.__sessions[states.index("idle")]
+                    session["state"] = "busy"
+                    session["busy_since"] = time.time()
+                    return session
+                if all(state == "resting" for state in states):
+                    raise gpt_scraper.HourlyLimitReachedError(
+                        "Every session of the pool reached its hourly limit"
+                    )
+                if "busy" in states:
+                    deadline = None
+                elif deadline == None:
+                    deadline = time.time() + self.__busy_cooldown * 2
+                elif time.time() >= deadline:
+                    raise TimeoutError("No session of the pool is logged in")
+                self.__cond.wait(
+                    timeout=None if deadline == None else deadline - time.time()
+                )
+
+    # hands the session back in the state it is in now: idle, or down/resting when it is taken out of the pool (in one
+    # go, so that no other query can pick it up in between)
+    def _release(self, session, failed=False, state="idle"):
+        with self.__cond:
+            session["busy_time"] += time.time() - session["busy_since"]
+            session["busy_since"] = None
+            if failed:
+                session["errors"] += 1
+            else:
+                session["queries"] += 1
+            session["state"] = state
+            self.__cond.notify_all()
+
+    # brings a session that was taken out of the pool (down or resting) back after 'cooldown' seconds, logging it out
+    # (and in again afterwards) if 'relogin', only the recovery thread sets it back to idle
+    def _recover(self, session, cooldown, relogin):
+        threading.Thread(
+            target=self._recover_thread,
+            args=(session, cooldown, relogin),
+            name=f"pool-recover-{session['name']}",
+            daemon=True,
+        ).start()
+
+    def _recover_thread(self, session, cooldown, relogin):
+        if relogin:
+            with self.__cond:
+                backend, session["backend"] = session["backend"], None
+            self._logout_session(backend, True)
+        backend = None
+        while True:
+            if self.__closed.wait(cooldown):
+                return
+            if not relogin:
+                break
+            try:
+                backend = self._new_session(session)
+                break
+            except Exception:
+                # try again after a while
+                cooldown = max(cooldown, 60)
+        with self.__cond:
+            if not self.__closed.is_set():
+                if backend != None:
+                    session["backend"] = backend
+                    session["restarts"] += 1
+                session["state"] = "idle"
+                self.__cond.notify_all()
+                return
+        # the pool was logged out while the session was logging in again
+        self._logout_session(backend, True)
+
+    def _new_session(self, session):
+        backend = ScraperBackend(hidden=self.__hidden)
+        backend.set_credentials(
+            session["account"]["email"], session["account"]["password"]
+        )
+        backend.login()
+        return backend
+
+    @staticmethod
+    def _logout_session(backend, clear_chats):
+        try:
+            if backend != None and backend.logged_in():
+                backend.logout(clear_chats=clear_chats)
+        except (
+            TimeoutError,
+            RuntimeError,
+        ):  # error clearing chats, the session is dropped anyway
+            pass
@@ -0,0 +1,115 @@
+import threading
+import time
+import json
+import os
+import hashlib
+from collections import OrderedDict
+from email.utils import parseaddr
+
+
+# remembers the bot's responses to recent mails, so that a repeated mail (same sender, subject and body, give or take
+# whitespace) is answered without querying the bot again
+# entries are evicted least recently used first once there are max_entries of them, and expire ttl seconds after
+# being stored, path (optional) is a JSON file the cache is loaded from and saved to, so that it survives restarts
+class ReplyCache:
+    def __init__(self, max_entries=1000, ttl=24 * 60 * 60, path=None, save_interval=60):
+        if not isinstance(max_entries, int) or max_entries < 1:
+            raise ValueError("'max_entries' must be an integer greater than 0")
+        self.__max_entries = max_entries
+        self.__ttl = ttl
+        self.__path = path
+        self.__save_interval = save_interval  # seconds between two saves done by put()
+        # key -> (stored at, response), least recently used first
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__save_lock = threading.Lock()  # one save at a time
+        self.__hits = 0
+        self.__misses = 0
+        self.__last_save = time.time()
+        if path is not None:
+            self._load()
+
+    # sha256 of the mail's sender address, subject and body, with the whitespace collapsed and the case of the
+    # sender and subject ignored
+    @staticmethod
+    def key(mail):
+        sender = parseaddr(mail["sender"])[1] or mail["sender"]
+        parts = (
+            sender.strip().lower(),
+            " ".join(mail["subject"].split()).lower(),
+            " ".join(mail["body"].split()),
+        )
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    # returns the response stored for the mail, or None
+    def get(self, mail):
+        key = self.key(mail)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry != None and time.time() - entry[0] > self.__ttl:
+                del self.__entries[key]
+                entry = None
+            if entry == None:
+                self.__misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return entry[1]
+
+    def put(self, mail, response):
+        key = self.key(mail)
+        with self.__lock:
+            self.__entries[key] = (time.time(), response)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+            save_due = (
+                self.__path is not None
+                and time.time() - self.__last_save >= self.__save_interval
+            )
+        if save_due:
+            self.save()
+
+    # hits, misses, hit rate and number of entries since the cache was created
+    def stats(self):
+        with self.__lock:
+            lookups = self.__hits + self.__misses
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "hit_rate": self.__hits / lookups if lookups != 0 else 0.0,
+                "entries": len(self.__entries),
+            }
+
+    # writes the entries that haven't expired to the file at path
+    def save(self):
+        if self.__path is None:
+            return
+        with self.__lock:
+            now = time.time()
+            entries = [
+                [key, stored_at, response]
+                for key, (stored_at, response) in self.__entries.items()
+                if now - stored_at <= self.__ttl
+            ]
+            self.__last_save = now
+        # write to a temporary file first, so that a crash mid-write can't leave a corrupted cache file behind
+        tmp_file = self.__path + ".tmp"
+        with self.__save_lock:
+            with open(tmp_file, "w") as file:
+                json.dump(entries, file)
+            os.replace(tmp_file, self.__path)
+
+    def _load(self):
+        if not os.path.exists(self.__path):
+            return
+        try:
+            with open(self.__path, "r") as file:
+                entries = json.load(file)
+        # unreadable/corrupted cache file, start empty
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, stored_at, response in entries[-self.__max_entries :]:
+            if now - stored_at <= self.__ttl:
+                self.__entries[key] = (stored_at, response)
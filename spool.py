@@ -0,0 +1,169 @@
+import threading
+import time
+import json
+import sqlite3
+
+
+# append-only, on-disk record of the mails pushed to the Outbox, so that queued replies survive a crash or a restart
+# mails are appended when pushed and marked done once sent, whatever is not done is replayed by the next Outbox.start()
+# mails the Outbox gave up on are marked dead instead, they stay in the spool as dead letters until revived
+# writes are handed to a writer thread and committed in groups (SQLite in WAL mode), so that a whole group of
+# appends/updates costs a single fsync and append() itself never waits for the disk
+# the mails marked done are deleted when the spool is opened, and every prune_interval seconds by the writer thread
+class Spool:
+    def __init__(self, path, commit_interval=0.005, prune_interval=60 * 60):
+        self.__path = path
+        # how long the writer thread waits for more writes to pile up before committing them together
+        self.__commit_interval = commit_interval
+        self.__prune_interval = prune_interval
+        self.__ops = []  # (sql, params) waiting to be committed
+        self.__submitted = 0
+        self.__committed = 0
+        self.__closing = False
+        self.__cond = threading.Condition()
+        self.__last_error = None
+
+        # create the table and find the id to continue from, before the writer thread takes over the database
+        db = self._connect()
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY, mail TEXT NOT NULL, done INTEGER NOT NULL DEFAULT 0)"
+            )
+            # done = 0: not sent yet, 1: sent, 2: dead letter (details in the dead_letters table)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS dead_letters (id INTEGER PRIMARY KEY, attempts INTEGER NOT NULL, error TEXT NOT NULL, failed_at REAL NOT NULL)"
+            )
+            # mails that were sent by a previous run are not needed anymore
+            db.execute("DELETE FROM spool WHERE done = 1")
+        self.__next_id = db.execute(
+            "SELECT COALESCE(MAX(id), 0) + 1 FROM spool"
+        ).fetchone()[0]
+        db.close()
+
+        self.__writer_thread = threading.Thread(target=self._writer_thread, daemon=True)
+        self.__writer_thread.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.__path)
+        db.execute("PRAGMA journal_mode=WAL")
+        # fsync on every commit, i.e. on every group of writes
+        db.execute("PRAGMA synchronous=FULL")
+        return db
+
+    # returns a list of (id, mail) of the mails that were appended but never marked done, oldest first
+    def pending(self):
+        self.flush()
+        db = self._connect()
+        rows = db.execute(
+            "SELECT id, mail FROM spool WHERE done = 0 ORDER BY id"
+        ).fetchall()
+        db.close()
+        return [(mail_id, json.loads(mail)) for mail_id, mail in rows]
+
+    # records a mail and returns its id, the mail reaches the disk with the next group commit
+    def append(self, mail):
+        with self.__cond:
+            mail_id = self.__next_id
+            self.__next_id += 1
+            self._submit(
+                "INSERT INTO spool (id, mail) VALUES (?, ?)",
+                (mail_id, json.dumps(mail)),
+            )
+        return mail_id
+
+    def mark_done(self, mail_id):
+        with self.__cond:
+            self._submit("UPDATE spool SET done = 1 WHERE id = ?", (mail_id,))
+
+    def mark_dead(self, mail_id, attempts, error, failed_at):
+        with self.__cond:
+            self._submit("UPDATE spool SET done = 2 WHERE id = ?", (mail_id,))
+            self._submit(
+                "INSERT OR REPLACE INTO dead_letters (id, attempts, error, failed_at) VALUES (?, ?, ?, ?)",
+                (mail_id, attempts, error, failed_at),
+            )
+
+    # makes a dead letter pending again
+    def revive(self, mail_id):
+        with self.__cond:
+            self._submit("UPDATE spool SET done = 0 WHERE id = ?", (mail_id,))
+            self._submit("DELETE FROM dead_letters WHERE id = ?", (mail_id,))
+
+    # returns a list of (id, mail, attempts, error, failed_at) of the dead letters, oldest first
+    def dead(self):
+        self.flush()
+        db = self._connect()
+        rows = db.execute(
+            "SELECT spool.id, mail, attempts, error, failed_at FROM spool JOIN dead_letters ON spool.id = dead_letters.id WHERE done = 2 ORDER BY failed_at"
+        ).fetchall()
+        db.close()
+        return [
+            (mail_id, json.loads(mail), attempts, error, failed_at)
+            for mail_id, mail, attempts, error, failed_at in rows
+        ]
+
+    # must be called with the __cond lock held
+    def _submit(self, sql, params):
+        if self.__closing:
+            raise IllegalSpoolAccessError("Spool was closed")
+        self.__ops.append((sql, params))
+        self.__submitted += 1
+        self.__cond.notify_all()
+
+    # blocks until everything appended/marked done so far has been committed
+    def flush(self):
+        with self.__cond:
+            target = self.__submitted
+            while self.__committed < target and self.__writer_thread.is_alive():
+                self.__cond.wait(timeout=1)
+
+    # commits the remaining writes and stops the writer thread
+    def close(self):
+        with self.__cond:
+            self.__closing = True
+            self.__cond.notify_all()
+        self.__writer_thread.join()
+
+    def last_error(self):
+        return self.__last_error
+
+    def _writer_thread(self):
+        db = self._connect()
+        last_prune = time.time()
+        while True:
+            with self.__cond:
+                while len(self.__ops) == 0 and not self.__closing:
+                    self.__cond.wait()
+                if len(self.__ops) == 0:  # closing and nothing left to write
+                    break
+            # let more writes pile up, they all go into the same transaction
+            if not self.__closing:
+                time.sleep(self.__commit_interval)
+            with self.__cond:
+                ops, self.__ops = self.__ops, []
+            try:
+                with db:
+                    for sql, params in ops:
+                        db.execute(sql, params)
+            # the mails are still in the Outbox's memory, they just won't survive a restart
+            except sqlite3.Error as e:
+                self.__last_error = str(e)
+            with self.__cond:
+                self.__committed += len(ops)
+                self.__cond.notify_all()
+            if time.time() - last_prune >= self.__prune_interval:
+                self._prune(db)
+                last_prune = time.time()
+        db.close()
+
+    # drops the mails that were sent, the bot may run for weeks without opening the spool again
+    def _prune(self, db):
+        try:
+            with db:
+                db.execute("DELETE FROM spool WHERE done = 1")
+        except sqlite3.Error as e:
+            self.__last_error = str(e)
+
+
+class IllegalSpoolAccessError(RuntimeError):
+    pass
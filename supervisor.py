@@ -0,0 +1,121 @@
+import threading
+import time
+
+
+# keeps the long running parts of the bot (browser session, mail boxes, ...) fresh without stopping the rest: every
+# component is refreshed on its own, when it gets older than its max_age or when its health check fails, while the
+# other components keep working
+# a component that can't be refreshed max_failures times in a row stops the supervisor, see wait() and error()
+class Supervisor:
+    def __init__(self, check_interval=30, max_failures=3):
+        self.__check_interval = check_interval
+        self.__max_failures = max_failures
+        self.__components = {}
+        self.__lock = threading.Lock()  # guards the components' stats
+        self.__thread = None
+        self.__stop = threading.Event()
+        self.__failed = threading.Event()
+        self.__error = None
+
+    # refresh() replaces the component with a new one (in place, the old one should keep working until the new one is
+    # ready), healthy() returns False when the component must be refreshed right away, max_age is in seconds
+    def add_component(self, name, refresh, healthy=None, max_age=None):
+        if name in self.__components:
+            raise IllegalSupervisorError(f"there already is a component named '{name}'")
+        self.__components[name] = {
+            "refresh": refresh,
+            "healthy": healthy,
+            "max_age": max_age,
+            "started_at": time.time(),
+            "refreshes": 0,
+            "failures": 0,  # in a row
+            "reason": None,  # why the refresh that keeps failing was needed
+            "last_error": None,
+        }
+
+    def start(self):
+        if self.__thread != None:
+            raise IllegalSupervisorError("the supervisor is already running")
+        self.__stop.clear()
+        self.__thread = threading.Thread(
+            target=self._supervise_thread, name="supervisor", daemon=True
+        )
+        self.__thread.start()
+
+    # waits for a refresh that is going on to finish
+    def stop(self):
+        if self.__thread == None:
+            raise IllegalSupervisorError("the supervisor is not running")
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
+
+    # blocks until a component couldn't be refreshed, or for 'timeout' seconds, returns True in the first case
+    def wait(self, timeout=None):
+        return self.__failed.wait(timeout)
+
+    # the error of the component that stopped the supervisor, None if there was none
+    def error(self):
+        return self.__error
+
+    # per component: seconds since it was (re)started, how many times it was refreshed, failed refreshes in a row and the
+    # last error
+    def stats(self):
+        with self.__lock:
+            now = time.time()
+            return {
+                name: {
+                    "age": now - component["started_at"],
+                    "refreshes": component["refreshes"],
+                    "failures": component["failures"],
+                    "last_error": component["last_error"],
+                }
+                for name, component in self.__components.items()
+            }
+
+    def _supervise_thread(self):
+        while not self.__stop.wait(self.__check_interval):
+            for name, component in self.__components.items():
+                if self.__stop.is_set():
+                    return
+                reason = self._refresh_reason(component)
+                if reason == None:
+                    continue
+                try:
+                    component["refresh"]()
+                except Exception as e:
+                    with self.__lock:
+                        component["failures"] += 1
+                        component["reason"] = reason
+                        component["last_error"] = str(e)
+                        given_up = component["failures"] >= self.__max_failures
+                    if given_up:
+                        self.__error = RuntimeError(
+                            f"couldn't refresh '{name}' ({reason}): {e}"
+                        )
+                        self.__failed.set()
+                        return
+                    continue
+                with self.__lock:
+                    component["started_at"] = time.time()
+                    component["refreshes"] += 1
+                    component["failures"] = 0
+
+    # why the component must be refreshed now, None if it doesn't have to be
+    def _refresh_reason(self, component):
+        if component["failures"] != 0:
+            return component["reason"]
+        if component["healthy"] != None:
+            try:
+                if not component["healthy"]():
+                    return "unhealthy"
+            except Exception:
+                return "unhealthy"
+        max_age = component["max_age"]
+        if max_age != None and time.time() - component["started_at"] >= max_age:
+            return "too old"
+        return None
+
+
+class IllegalSupervisorError(RuntimeError):
+    pass
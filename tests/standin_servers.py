@@ -0,0 +1,319 @@
+import asyncio
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# the path of a MAIL FROM/RCPT TO command, a bare address in angle brackets
+_ENVELOPE_ADDRESS = re.compile(r"^[A-Za-z]+ (?:FROM|TO):<([^<>\s@]+@[^<>\s@]+)>$", re.I)
+
+
+# a local IMAP server on asyncio streams, with just what an AsyncMailbox asks for: a single folder of text/plain mails,
+# UID SEARCH/FETCH/STORE and IDLE
+# every command received is kept in 'commands', add() reports the new mail to the connections that are idling
+class ImapStandIn:
+    def __init__(self):
+        self.mails = []  # dicts with keys 'uid', 'header', 'body' and 'seen'
+        self.commands = []
+        # mails that arrive just as the next IDLE is ended, they are reported along with the answer to the DONE
+        self.arriving_on_done = []
+        self.port = None
+        self.__next_uid = 1
+        self.__server = None
+        self.__writers = set()
+        self.__idling = set()
+
+    async def start(self):
+        self.__server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self.__server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.drop_connections()
+        self.__server.close()
+        await self.__server.wait_closed()
+
+    def add(self, subject, body, sender="john@example.com"):
+        self._append(subject, body, sender)
+        for writer in self.__idling:
+            writer.write(b"* %d EXISTS\r\n" % len(self.mails))
+
+    # the uids of the mails that were fetched (whole, or their text/plain part)
+    def fetched_uids(self):
+        uids = []
+        for command in self.commands:
+            match = re.match(
+                r"\S+ UID FETCH (\S+) \((?:RFC822|BODY\.PEEK\[1\])\)", command
+            )
+            if match != None:
+                uids += self._sequence_set(match.group(1))
+        return uids
+
+    def drop_connections(self):
+        for writer in list(self.__writers):
+            writer.close()
+
+    def _append(self, subject, body, sender):
+        header = f"From: {sender}\r\nSubject: {subject}\r\n\r\n"
+        self.mails.append(
+            {
+                "uid": self.__next_uid,
+                "header": header,
+                "body": body + "\r\n",
+                "seen": False,
+            }
+        )
+        self.__next_uid += 1
+
+    def _sequence_set(self, spec):
+        last = self.mails[-1]["uid"] if self.mails else 0
+        uids = []
+        for part in spec.split(","):
+            start, _, end = part.partition(":")
+            start = last if start == "*" else int(start)
+            end = start if end == "" else last if end == "*" else int(end)
+            uids += range(min(start, end), max(start, end) + 1)
+        return uids
+
+    async def _handle(self, reader, writer):
+        self.__writers.add(writer)
+        writer.write(b"* OK IMAP stand-in ready\r\n")
+        try:
+            while True:
+                line = await reader.readline()
+                if line == b"":
+                    return
+                command = line.decode().rstrip("\r\n")
+                self.commands.append(command)
+                tag, name, args = (command.split(" ", 2) + [""])[:3]
+                name = name.upper()
+                if name == "UID":
+                    name, _, args = args.partition(" ")
+                    name = "UID " + name.upper()
+                if name == "IDLE":
+                    await self._idle(tag, reader, writer)
+                    continue
+                if name == "LOGOUT":
+                    writer.write(b"* BYE\r\n" + tag.encode() + b" OK LOGOUT done\r\n")
+                    await writer.drain()
+                    return
+                writer.write(self._answer(name, args) + tag.encode() + b" OK done\r\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.__writers.discard(writer)
+            self.__idling.discard(writer)
+            writer.close()
+
+    async def _idle(self, tag, reader, writer):
+        writer.write(b"+ idling\r\n")
+        self.__idling.add(writer)
+        await reader.readline()  # DONE
+        self.__idling.discard(writer)
+        for subject, body in self.arriving_on_done:
+            self._append(subject, body, "john@example.com")
+            writer.write(b"* %d EXISTS\r\n" % len(self.mails))
+        self.arriving_on_done = []
+        writer.write(tag.encode() + b" OK IDLE done\r\n")
+        await writer.drain()
+
+    def _answer(self, name, args):
+        if name == "CAPABILITY":
+            return b"* CAPABILITY IMAP4rev1 IDLE\r\n"
+        if name == "SELECT":
+            return (
+                b"* %d EXISTS\r\n* 0 RECENT\r\n* OK [UIDVALIDITY 1] UIDs valid\r\n"
+                % len(self.mails)
+            )
+        if name == "UID SEARCH":
+            last_uid = int(re.search(r"UID (\d+):\*", args).group(1)) - 1
+            uids = [
+                mail["uid"]
+                for mail in self.mails
+                if not mail["seen"]
+                and (mail["uid"] > last_uid or mail is self.mails[-1])
+            ]
+            return b"* SEARCH" + b"".join(b" %d" % uid for uid in uids) + b"\r\n"
+        if name == "UID FETCH":
+            spec, _, items = args.partition(" ")
+            return self._fetch(self._sequence_set(spec), items)
+        if name == "UID STORE":
+            for mail in self.mails:
+                if mail["uid"] in self._sequence_set(args.split(" ")[0]):
+                    mail["seen"] = True
+        return b""
+
+    def _fetch(self, uids, items):
+        answer = b""
+        for number, mail in enumerate(self.mails, 1):
+            if mail["uid"] not in uids:
+                continue
+            header, body = mail["header"].encode(), mail["body"].encode()
+            parts = [b"UID %d" % mail["uid"]]
+            if items == "(RFC822)":
+                mail["seen"] = True
+                parts.append(b"RFC822 {%d}\r\n" % len(header + body) + header + body)
+            elif items.startswith("(BODYSTRUCTURE"):
+                parts.append(
+                    b'BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" %d %d NIL NIL NIL)'
+                    % (len(body), body.count(b"\n"))
+                )
+                parts.append(
+                    b"BODY[HEADER.FIELDS (FROM SUBJECT MESSAGE-ID)] {%d}\r\n"
+                    % len(header)
+                    + header
+                )
+            elif items == "(BODY.PEEK[1])":
+                parts.append(b"BODY[1] {%d}\r\n" % len(body) + body)
+            answer += b"* %d FETCH (" % number + b" ".join(parts) + b")\r\n"
+        return answer
+
+
+# a local SMTP server on asyncio streams, with just what an AsyncOutbox asks for (EHLO, AUTH PLAIN, MAIL/RCPT/DATA, NOOP,
+# RSET, QUIT)
+# the mails received are kept in 'received' as (recipient, data), the recipients in 'rejected' are refused (and so is
+# anything but a bare address in angle brackets), every login is refused while 'refuse_login' is set and turned away
+# for now (454) while 'throttle_login' is set, 'login_attempts' counts both
+class SmtpStandIn:
+    def __init__(self):
+        self.received = []
+        self.rejected = set()
+        self.refuse_login = False
+        self.throttle_login = False
+        self.logins = 0
+        self.login_attempts = 0
+        self.port = None
+        self.__server = None
+
+    async def start(self):
+        self.__server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self.__server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.__server.close()
+        await self.__server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        writer.write(b"220 SMTP stand-in ready\r\n")
+        recipient = None
+        try:
+            while True:
+                line = await reader.readline()
+                if line == b"":
+                    return
+                command = line.decode().rstrip("\r\n")
+                name = command.split(" ", 1)[0].upper()
+                if name == "EHLO":
+                    answer = "250-stand-in\r\n250 AUTH PLAIN"
+                elif name == "AUTH":
+                    self.login_attempts += 1
+                    if self.throttle_login:
+                        answer = "454 4.7.0 too many login attempts"
+                    elif self.refuse_login:
+                        answer = "535 authentication failed"
+                    else:
+                        self.logins += 1
+                        answer = "235 authenticated"
+                elif name in ("MAIL", "RCPT") and not _ENVELOPE_ADDRESS.match(command):
+                    answer = "501 syntax error in address"
+                elif name == "RCPT":
+                    recipient = _ENVELOPE_ADDRESS.match(command).group(1)
+                    answer = (
+                        "550 no such user" if recipient in self.rejected else "250 ok"
+                    )
+                elif name == "DATA":
+                    writer.write(b"354 go ahead\r\n")
+                    data = []
+                    while True:
+                        data_line = (await reader.readline()).decode()
+                        if data_line == ".\r\n":
+                            break
+                        data.append(data_line)
+                    self.received.append((recipient, "".join(data)))
+                    answer = "250 queued"
+                elif name == "QUIT":
+                    writer.write(b"221 bye\r\n")
+                    await writer.drain()
+                    return
+                elif name in ("MAIL", "NOOP", "RSET"):
+                    answer = "250 ok"
+                else:
+                    answer = "500 unknown command"
+                writer.write(answer.encode() + b"\r\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+# a local chat completions API (POST /v1/chat/completions) on a thread, with keep-alive connections, it answers every
+# request with 'reply' (streamed in 'chunks' pieces when the request asks for stream=True)
+# the (status, error body) pairs put in 'errors' are answered instead, one per request, the prompts and the port of the
+# connection every request came in on are kept in 'prompts' and 'client_ports'
+class ChatStandIn:
+    def __init__(self, reply="Subject: re\nBody: hello", chunks=3):
+        self.reply = reply
+        self.chunks = chunks
+        self.errors = []
+        self.prompts = []
+        self.client_ports = []
+        self.port = None
+        self.__server = None
+        self.__thread = None
+
+    def start(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                standin._answer(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.__server.daemon_threads = True
+        self.port = self.__server.server_address[1]
+        self.__thread = threading.Thread(
+            target=self.__server.serve_forever, name="chat-standin", daemon=True
+        )
+        self.__thread.start()
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+
+    def _answer(self, handler):
+        request = json.loads(handler.rfile.read(int(handler.headers["Content-Length"])))
+        self.prompts.append(request["messages"][-1]["content"])
+        self.client_ports.append(handler.client_address[1])
+        if handler.path != "/v1/chat/completions":
+            status, body = 404, {"error": {"message": "unknown path"}}
+        elif len(self.errors) != 0:
+            status, body = self.errors.pop(0)
+        elif request.get("stream", False):
+            status, body = 200, None
+        else:
+            status, body = 200, {"choices": [{"message": {"content": self.reply}}]}
+
+        if body != None:
+            data = json.dumps(body).encode()
+            content_type = "application/json"
+        else:
+            size = -(-len(self.reply) // self.chunks)
+            events = [
+                {"choices": [{"delta": {"content": self.reply[i : i + size]}}]}
+                for i in range(0, len(self.reply), size)
+            ]
+            data = "".join(f"data: {json.dumps(event)}\n\n" for event in events)
+            data = (data + "data: [DONE]\n\n").encode()
+            content_type = "text/event-stream"
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
@@ -0,0 +1,194 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from async_inbox import AsyncInbox
+from async_outbox import AsyncOutbox
+from tests.standin_servers import ImapStandIn, SmtpStandIn
+
+CREDENTIALS = {"email": "bot@example.com", "password": "secret"}
+
+
+class AsyncInboxTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = ImapStandIn()
+        await self.server.start()
+        self.inbox = None
+
+    async def asyncTearDown(self):
+        if self.inbox != None and self.inbox.logged_in():
+            await self.inbox.stop()
+        await self.server.stop()
+
+    async def start_inbox(self, max_queued=None, **options):
+        self.inbox = AsyncInbox(
+            max_queued=max_queued,
+            imap_server="127.0.0.1",
+            port=self.server.port,
+            use_ssl=False,
+        )
+        await self.inbox.start(30, [dict(CREDENTIALS)], **options)
+
+    async def pop_all(self, timeout=1):
+        mails = []
+        while True:
+            mail = await self.inbox.pop(timeout=timeout)
+            if mail == None:
+                return mails
+            mails.append(mail)
+
+    async def test_pops_the_unseen_mails(self):
+        self.server.add("first", "hello")
+        self.server.add("second", "hello again")
+        await self.start_inbox(partial_fetch=False)
+        mails = await self.pop_all()
+        self.assertEqual([mail["subject"] for mail in mails], ["first", "second"])
+        self.assertEqual(mails[0]["body"].strip(), "hello")
+        self.assertEqual(mails[0]["account"], CREDENTIALS["email"])
+        self.assertEqual(mails[0]["folder"], "INBOX")
+
+    async def test_partial_fetch_only_downloads_the_text_part(self):
+        self.server.add("partial", "just the text")
+        await self.start_inbox(partial_fetch=True)
+        mails = await self.pop_all()
+        self.assertEqual([mail["subject"] for mail in mails], ["partial"])
+        self.assertEqual(mails[0]["body"].strip(), "just the text")
+        self.assertFalse(any("RFC822" in command for command in self.server.commands))
+        self.assertTrue(self.server.mails[0]["seen"])
+
+    async def test_idle_reports_new_mail(self):
+        await self.start_inbox()
+        self.assertTrue(self.inbox.mailboxes()[0].idling())
+        await asyncio.sleep(0.2)
+        self.server.add("pushed", "sent while idling")
+        mail = await self.inbox.pop(timeout=2)
+        self.assertEqual(mail["subject"], "pushed")
+
+    async def test_mail_reported_while_idle_ends_is_not_lost(self):
+        await self.start_inbox(health_check_interval=1)
+        await asyncio.sleep(0.2)
+        # reported along with the answer to the DONE of the health check
+        self.server.arriving_on_done.append(("late", "arrived as the IDLE ended"))
+        mail = await self.inbox.pop(timeout=3)
+        self.assertEqual(mail != None and mail["subject"], "late")
+
+    async def test_max_queued_leaves_the_rest_on_the_server(self):
+        for i in range(5):
+            self.server.add(f"mail {i}", "hello")
+        await self.start_inbox(max_queued=2, partial_fetch=False)
+        await asyncio.sleep(0.5)
+        self.assertEqual(self.inbox.size(), 2)
+        self.assertEqual(self.server.fetched_uids(), [1, 2])
+        mails = await self.pop_all(timeout=2)
+        self.assertEqual(len(mails), 5)
+
+    async def test_reconnects_after_the_connection_drops(self):
+        await self.start_inbox()
+        await asyncio.sleep(0.2)
+        self.server.drop_connections()
+        await asyncio.sleep(0.2)
+        self.server.add("after", "sent after the drop")
+        mail = await self.inbox.pop(timeout=5)
+        self.assertEqual(mail != None and mail["subject"], "after")
+        stats = self.inbox.connection_stats()[(CREDENTIALS["email"], "INBOX")]
+        self.assertEqual(stats["reconnects"], 1)
+        self.assertTrue(stats["connected"])
+
+    async def test_resumes_from_the_state_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state_file = os.path.join(directory, "state.json")
+            self.server.add("first", "hello")
+            await self.start_inbox(state_file=state_file, partial_fetch=False)
+            self.assertEqual(len(await self.pop_all()), 1)
+            await self.inbox.stop()
+            # seen or not, a mail below the last processed UID isn't fetched again
+            self.server.mails[0]["seen"] = False
+            self.server.add("second", "hello again")
+            await self.start_inbox(state_file=state_file, partial_fetch=False)
+            mails = await self.pop_all()
+            self.assertEqual([mail["subject"] for mail in mails], ["second"])
+            await self.inbox.stop()
+
+
+class AsyncOutboxTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = SmtpStandIn()
+        await self.server.start()
+        self.outbox = AsyncOutbox(
+            smtp_server="127.0.0.1", smtp_port=self.server.port, use_ssl=False
+        )
+
+    async def asyncTearDown(self):
+        if self.outbox.is_working():
+            await self.outbox.stop()
+        await self.server.stop()
+
+    async def wait_until(self, condition, timeout=3):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not condition() and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.05)
+        return condition()
+
+    async def test_pushed_mails_are_sent(self):
+        await self.outbox.start(CREDENTIALS, sender_workers=2)
+        for i in range(5):
+            await self.outbox.push(
+                {"to": f"user{i}@example.com", "subject": "re", "body": ".dotted\nline"}
+            )
+        self.assertTrue(await self.wait_until(lambda: len(self.server.received) == 5))
+        self.assertEqual(self.outbox.delivery_stats()["sent"], 5)
+        # every sender keeps its session open for the next mails
+        self.assertLessEqual(self.server.logins, 2)
+        recipient, data = self.server.received[0]
+        self.assertIn("\r\n..dotted\r\n", data)
+
+    async def test_display_name_is_left_out_of_the_envelope(self):
+        await self.outbox.start(CREDENTIALS)
+        await self.outbox.push(
+            {"to": "John Doe <john@example.com>", "subject": "re", "body": "b"}
+        )
+        self.assertTrue(await self.wait_until(lambda: len(self.server.received) == 1))
+        self.assertEqual(self.server.received[0][0], "john@example.com")
+        self.assertEqual(self.outbox.dead_letters(), [])
+
+    async def test_refused_recipient_becomes_a_dead_letter(self):
+        self.server.rejected.add("nobody@example.com")
+        await self.outbox.start(
+            CREDENTIALS, max_attempts=2, retry_base_delay=0.05, retry_max_delay=0.1
+        )
+        await self.outbox.push(
+            {"to": "nobody@example.com", "subject": "re", "body": "b"}
+        )
+        self.assertTrue(await self.wait_until(lambda: self.outbox.dead_letters()))
+        letter = self.outbox.dead_letters()[0]
+        self.assertEqual(letter["attempts"], 2)
+        self.assertEqual(self.outbox.delivery_stats()["failed"], 1)
+
+    async def test_refused_login_is_reported(self):
+        self.server.refuse_login = True
+        await self.outbox.start(
+            CREDENTIALS, retry_base_delay=0.05, retry_max_delay=0.1, max_auth_failures=2
+        )
+        await self.outbox.push({"to": "user@example.com", "subject": "re", "body": "b"})
+        self.assertTrue(await self.wait_until(self.outbox.smtp_error_occurred))
+        self.assertEqual(self.server.received, [])
+        # the mail was kept, and goes out once the login works again
+        self.server.refuse_login = False
+        self.assertTrue(await self.wait_until(lambda: len(self.server.received) == 1))
+        self.assertFalse(self.outbox.smtp_error_occurred())
+
+    async def test_throttled_login_is_not_reported(self):
+        self.server.throttle_login = True
+        await self.outbox.start(
+            CREDENTIALS, retry_base_delay=0.05, retry_max_delay=0.1, max_auth_failures=2
+        )
+        await self.outbox.push({"to": "user@example.com", "subject": "re", "body": "b"})
+        self.assertTrue(await self.wait_until(lambda: self.server.login_attempts >= 4))
+        self.assertFalse(self.outbox.smtp_error_occurred())
+        self.server.throttle_login = False
+        self.assertTrue(await self.wait_until(lambda: len(self.server.received) == 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+
+import gpt_scraper
+from reply_backends import HttpChatBackend, ReplyBackend
+from tests.standin_servers import ChatStandIn
+
+
+class HttpChatBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ChatStandIn(reply="Subject: re\nBody: thanks for writing")
+        self.server.start()
+        self.bot = None
+
+    def tearDown(self):
+        if self.bot != None and self.bot.logged_in():
+            self.bot.logout()
+        self.server.stop()
+
+    def start_bot(self, **options):
+        self.bot = HttpChatBackend(
+            base_url=f"http://127.0.0.1:{self.server.port}/v1",
+            api_key="test-key",
+            **options,
+        )
+        self.bot.login()
+        return self.bot
+
+    def test_streamed_reply(self):
+        bot = self.start_bot(stream=True)
+        self.assertEqual(bot.query("hello"), self.server.reply)
+        self.assertEqual(self.server.prompts, ["hello"])
+
+    def test_whole_reply(self):
+        bot = self.start_bot(stream=False)
+        self.assertEqual(bot.query("hello"), self.server.reply)
+
+    def test_connection_is_reused(self):
+        bot = self.start_bot(max_concurrency=1)
+        for _ in range(3):
+            self.assertEqual(bot.query("hello"), self.server.reply)
+        self.assertEqual(len(set(self.server.client_ports)), 1)
+
+    def test_query_many_keeps_the_order(self):
+        bot = self.start_bot(max_concurrency=2)
+        self.server.errors.append((500, {"error": {"message": "overloaded"}}))
+        results = bot.query_many(["first", "second", "third"])
+        self.assertEqual(len(results), 3)
+        self.assertEqual(sum(isinstance(result, TimeoutError) for result in results), 1)
+        self.assertEqual(results.count(self.server.reply), 2)
+
+    def test_rate_limit(self):
+        bot = self.start_bot()
+        self.server.errors.append((429, {"error": {"message": "slow down"}}))
+        with self.assertRaises(gpt_scraper.HourlyLimitReachedError):
+            bot.query("hello")
+        # the connection is still good for the next query
+        self.assertEqual(bot.query("hello"), self.server.reply)
+
+    def test_context_length_exceeded(self):
+        bot = self.start_bot()
+        self.server.errors.append(
+            (
+                400,
+                {
+                    "error": {
+                        "code": "context_length_exceeded",
+                        "message": "too long",
+                    }
+                },
+            )
+        )
+        with self.assertRaises(gpt_scraper.PromptTooLongError):
+            bot.query("a very long prompt")
+
+    def test_server_error(self):
+        bot = self.start_bot()
+        self.server.errors.append((503, {"error": {"message": "unavailable"}}))
+        with self.assertRaises(TimeoutError):
+            bot.query("hello")
+
+    def test_login_needs_an_api_key(self):
+        self.bot = HttpChatBackend(base_url=f"http://127.0.0.1:{self.server.port}/v1")
+        with self.assertRaises(gpt_scraper.InvalidCredentialsError):
+            self.bot.login()
+
+
+class ReplyBackendTest(unittest.TestCase):
+    def test_is_abstract(self):
+        with self.assertRaises(TypeError):
+            ReplyBackend()
+
+
+if __name__ == "__main__":
+    unittest.main()